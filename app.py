@@ -1,8 +1,9 @@
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
 from flask_login import LoginManager, login_required, current_user
 from datetime import datetime, timedelta
-from decimal import Decimal
+import json
 import os
+from sqlalchemy.exc import IntegrityError
 from werkzeug.security import generate_password_hash
 from dotenv import load_dotenv
 
@@ -11,10 +12,23 @@ load_dotenv()
 
 # استيراد النماذج والوحدات
 from models import db, User, Product, Invoice, InvoiceItem, TaxType, UserRole, SystemSettings
-from forms import ProductForm, InvoiceForm, InvoiceItemForm, SearchForm, SettingsForm
-from auth import auth_bp, init_default_users, permission_required
+from forms import ProductForm, InvoiceForm, InvoiceItemForm, InvoiceItemsBatchForm, SearchForm, SettingsForm
+from passwords import configure_password_hashing, DEFAULT_SETTINGS as PASSWORD_SETTINGS
+from auth import auth_bp, init_default_users, permission_required, load_cached_user
+from invoice_service import (bulk_create_invoices, allocate_invoice_numbers, save_invoice_items, start_product_rerating, read_rerate_job,
+                             summarize_invoice_list,
+                             add_item_to_invoice, remove_item_from_invoice, schedule_totals_verification,
+                             InvoiceValidationError)
 from reports import reports_bp
+from migrations import upgrade_database
+from search import search_filter
+from pagination import keyset_paginate, cached_summary
+from customers import get_or_create_customer, autocomplete_customers
+from catalog import get_catalog, CATALOG_FIELDS
+from dashboard_service import get_dashboard_stats
+from live_events import broadcaster, TooManyConnections
 from backup import backup_bp, init_backup_system
+from scheduler import start_scheduler
 
 def create_app():
     app = Flask(__name__)
@@ -33,6 +47,12 @@ def create_app():
     app.config['WTF_CSRF_ENABLED'] = True
     app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(hours=8)  # انتهاء الجلسة بعد 8 ساعات
     
+    # إعدادات تجزئة كلمات المرور (PASSWORD_HASHER وتكلفة كل خوارزمية، انظر passwords.py)
+    for key in PASSWORD_SETTINGS:
+        if os.environ.get(key):
+            app.config[key] = os.environ[key]
+    configure_password_hashing(app.config)
+    
     # إنشاء مجلد instance إذا لم يكن موجوداً
     os.makedirs('instance', exist_ok=True)
     
@@ -49,28 +69,13 @@ def create_app():
     
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        return load_cached_user(user_id)
     
     # تسجيل البلوبرينتس
     app.register_blueprint(auth_bp, url_prefix='/auth')
     app.register_blueprint(reports_bp, url_prefix='/reports')
     app.register_blueprint(backup_bp, url_prefix='/backup')
 
-    # إضافة فلاتر مخصصة للقوالب
-    @app.template_filter('vat_base')
-    def vat_base_filter(amount):
-        """حساب المبلغ قبل ضريبة القيمة المضافة"""
-        if amount and amount > 0:
-            return float(Decimal(str(amount)) / Decimal('0.14'))
-        return 0
-
-    @app.template_filter('withholding_base')
-    def withholding_base_filter(amount):
-        """حساب المبلغ قبل ضريبة الخصم والإضافة"""
-        if amount and amount > 0:
-            return float(Decimal(str(amount)) / Decimal('0.05'))
-        return 0
-    
     # إنشاء الجداول وتهيئة البيانات الأساسية
     # معالج الأخطاء
     @app.errorhandler(404)
@@ -98,82 +103,18 @@ def create_app():
     @login_required
     def dashboard():
         """لوحة التحكم الرئيسية"""
-        # إحصائيات سريعة
-        today = datetime.now().date()
-        current_month_start = today.replace(day=1)
-        
-        # إحصائيات اليوم
-        today_invoices = Invoice.query.filter(
-            Invoice.invoice_date == today
-        ).all()
-        
-        today_total = sum(invoice.total_amount for invoice in today_invoices)
-        today_vat = sum(invoice.vat_amount for invoice in today_invoices)
-        today_withholding = sum(invoice.withholding_amount for invoice in today_invoices)
-        
-        # إحصائيات الشهر الحالي
-        month_invoices = Invoice.query.filter(
-            Invoice.invoice_date >= current_month_start
-        ).all()
-        
-        month_total = sum(invoice.total_amount for invoice in month_invoices)
-        month_vat = sum(invoice.vat_amount for invoice in month_invoices)
-        month_withholding = sum(invoice.withholding_amount for invoice in month_invoices)
+        # إحصائيات اليوم والشهر والرسم البياني من خدمة لوحة التحكم
+        stats, etag = get_dashboard_stats()
+        chart_data = [{'date': day['date'], 'total': day['total_amount']} for day in stats['daily']]
         
         # أحدث الفواتير
-        recent_invoices = Invoice.query.order_by(Invoice.created_at.desc()).limit(5).all()
-        
-        # إحصائيات المنتجات
-        total_products = Product.query.count()
-        
-        # بيانات الرسم البياني (آخر 7 أيام)
-        chart_data = []
-        for i in range(6, -1, -1):
-            date = today - timedelta(days=i)
-            day_invoices = Invoice.query.filter(Invoice.invoice_date == date).all()
-            day_total = sum(invoice.total_amount for invoice in day_invoices)
-            chart_data.append({
-                'date': date.strftime('%Y-%m-%d'),
-                'total': float(day_total)
-            })
-        
-        stats = {
-            'today': {
-                'invoices_count': len(today_invoices),
-                'total_amount': today_total,
-                'vat_amount': today_vat,
-                'withholding_amount': today_withholding
-            },
-            'month': {
-                'invoices_count': len(month_invoices),
-                'total_amount': month_total,
-                'vat_amount': month_vat,
-                'withholding_amount': month_withholding
-            },
-            'products_count': total_products
-        }
+        recent_invoices = Invoice.query.order_by(Invoice.created_at.desc(), Invoice.id.desc()).limit(5).all()
         
         return render_template('dashboard.html', 
                              stats=stats, 
                              recent_invoices=recent_invoices,
                              chart_data=chart_data)
     
-    # إدارة المنتجات
-    @app.route('/products')
-    @login_required
-    def products_list():
-        """قائمة المنتجات"""
-        products = Product.query.all()
-        return render_template('products/list.html', products=products)
-    
-    # إدارة الفواتير
-    @app.route('/invoices')
-    @login_required
-    def invoices_list():
-        """قائمة الفواتير"""
-        invoices = Invoice.query.all()
-        return render_template('invoices/list.html', invoices=invoices)
-    
     # التقارير
     @app.route('/reports')
     @login_required
@@ -181,18 +122,18 @@ def create_app():
         """لوحة تحكم التقارير"""
         return render_template('reports/dashboard.html')
     
-    # الإعدادات
-    @app.route('/settings')
-    @login_required
-    def system_settings():
-        """إعدادات النظام"""
-        return render_template('settings.html')
-    
     with app.app_context():
         db.create_all()
+        upgrade_database()
         init_default_users()
         init_default_settings()
         init_backup_system(app)
+        schedule_totals_verification(app)
+    
+    # المجدول يعمل في كل عامل، والقائد وحده (إيجار في القاعدة) يشغل المهام
+    start_scheduler(app)
+    # كل عامل يستطلع جدول الأحداث ليصل لاتصالاته ما ينشره العمال الآخرون
+    broadcaster.start(app)
     
     return app
 
@@ -230,7 +171,9 @@ def products_list():
     query = Product.query
     
     if search:
-        query = query.filter(Product.name.contains(search))
+        criterion = search_filter(Product, search)
+        if criterion is not None:
+            query = query.filter(criterion)
     
     if tax_type:
         query = query.filter(Product.tax_type == TaxType(tax_type))
@@ -275,6 +218,9 @@ def edit_product(product_id):
     form = ProductForm(obj=product)
     
     if form.validate_on_submit():
+        old_price = product.price
+        old_tax = (product.tax_type, product.tax_rate)
+        
         product.name = form.name.data
         product.description = form.description.data
         product.price = form.price.data
@@ -284,10 +230,26 @@ def edit_product(product_id):
         
         db.session.commit()
         flash(f'تم تحديث المنتج "{product.name}" بنجاح.', 'success')
+        
+        # إعادة حساب الفواتير المفتوحة في الخلفية عند تغيير السعر أو الضريبة
+        if old_price != product.price or old_tax != (product.tax_type, product.tax_rate):
+            job = start_product_rerating(app, product.id, old_price=old_price)
+            flash('جاري تحديث ضرائب الفواتير المفتوحة التي تحتوي على المنتج في الخلفية.', 'info')
+            return redirect(url_for('products_list', rerate_job=job['id']))
         return redirect(url_for('products_list'))
     
     return render_template('products/form.html', form=form, product=product, title='تعديل المنتج')
 
+@app.route('/api/products/rerate/<job_id>')
+@login_required
+@permission_required('edit_product')
+def product_rerate_status(job_id):
+    """حالة مهمة إعادة حساب فواتير المنتج"""
+    job = read_rerate_job(job_id)
+    if not job:
+        return jsonify({'error': 'المهمة غير موجودة'}), 404
+    return jsonify(job)
+
 @app.route('/products/<int:product_id>/delete', methods=['POST'])
 @login_required
 @permission_required('delete_product')
@@ -313,37 +275,43 @@ def delete_product(product_id):
 @permission_required('view_invoice')
 def invoices_list():
     """قائمة الفواتير"""
-    page = request.args.get('page', 1, type=int)
     search_form = SearchForm()
     
-    query = Invoice.query
+    # شروط الفلترة مشتركة بين استعلام الصفحة واستعلام الإجماليات
+    criteria = []
     
     # تطبيق فلاتر البحث
     if request.args.get('query'):
-        search_term = request.args.get('query')
-        query = query.filter(
-            db.or_(
-                Invoice.invoice_number.contains(search_term),
-                Invoice.customer_name.contains(search_term)
-            )
-        )
+        criterion = search_filter(Invoice, request.args.get('query'))
+        if criterion is not None:
+            criteria.append(criterion)
     
     if request.args.get('date_from'):
         date_from = datetime.strptime(request.args.get('date_from'), '%Y-%m-%d').date()
-        query = query.filter(Invoice.invoice_date >= date_from)
+        criteria.append(Invoice.invoice_date >= date_from)
     
     if request.args.get('date_to'):
         date_to = datetime.strptime(request.args.get('date_to'), '%Y-%m-%d').date()
-        query = query.filter(Invoice.invoice_date <= date_to)
+        criteria.append(Invoice.invoice_date <= date_to)
     
     if not request.args.get('include_cancelled'):
-        query = query.filter(Invoice.is_cancelled == False)
+        criteria.append(Invoice.is_cancelled == False)
     
-    invoices = query.order_by(Invoice.created_at.desc()).paginate(
-        page=page, per_page=20, error_out=False
+    # ترقيم بالمؤشرات على (created_at, id) بدلاً من OFFSET
+    invoices = keyset_paginate(
+        Invoice.query.filter(*criteria), Invoice, per_page=20,
+        after=request.args.get('after'), before=request.args.get('before')
+    )
+    
+    # العدد والإجماليات لكل الفواتير المطابقة (مخزنة مؤقتاً لكل مجموعة فلاتر)
+    filter_args = {key: value for key, value in request.args.items() if key not in ('after', 'before', 'page')}
+    summary = cached_summary(
+        ('invoices_list', tuple(sorted(filter_args.items()))),
+        lambda: summarize_invoice_list(*criteria)
     )
     
-    return render_template('invoices/list.html', invoices=invoices, search_form=search_form)
+    return render_template('invoices/list.html', invoices=invoices, summary=summary,
+                         filter_args=filter_args, search_form=search_form)
 
 @app.route('/invoices/new', methods=['GET', 'POST'])
 @login_required
@@ -354,16 +322,16 @@ def create_invoice():
     
     if form.validate_on_submit():
         # إنشاء رقم فاتورة تلقائي
-        invoice_prefix = SystemSettings.get_setting('invoice_prefix', 'INV')
-        last_invoice = Invoice.query.order_by(Invoice.id.desc()).first()
-        next_number = (last_invoice.id + 1) if last_invoice else int(SystemSettings.get_setting('invoice_start_number', '1'))
-        invoice_number = f"{invoice_prefix}-{next_number:06d}"
+        invoice_number = allocate_invoice_numbers(1)[0]
+        customer = get_or_create_customer(form.customer_name.data, form.customer_tax_id.data,
+                                          form.customer_address.data)
         
         invoice = Invoice(
             invoice_number=invoice_number,
+            customer=customer,
             customer_name=form.customer_name.data,
             customer_tax_id=form.customer_tax_id.data,
-            customer_address=form.customer_address.data,
+            customer_address=form.customer_address.data or None,
             invoice_date=form.invoice_date.data,
             due_date=form.due_date.data,
             notes=form.notes.data,
@@ -371,13 +339,31 @@ def create_invoice():
         )
         
         db.session.add(invoice)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            flash('تعارض مع فاتورة محفوظة (رقم مكرر)، لم تُحفظ الفاتورة. أعد المحاولة.', 'error')
+            return render_template('invoices/form.html', form=form, title='إنشاء فاتورة جديدة')
         
         flash(f'تم إنشاء الفاتورة "{invoice.invoice_number}" بنجاح.', 'success')
         return redirect(url_for('edit_invoice', invoice_id=invoice.id))
     
     return render_template('invoices/form.html', form=form, title='إنشاء فاتورة جديدة')
 
+@app.route('/api/customers/autocomplete')
+@login_required
+@permission_required('create_invoice')
+def customers_autocomplete():
+    """اقتراح العملاء لنموذج الفاتورة حسب بداية الاسم أو الرقم الضريبي"""
+    customers = autocomplete_customers(request.args.get('q', ''))
+    return jsonify([{
+        'id': customer.id,
+        'name': customer.name,
+        'tax_id': customer.tax_id,
+        'address': customer.address
+    } for customer in customers])
+
 @app.route('/invoices/<int:invoice_id>')
 @login_required
 @permission_required('view_invoice')
@@ -398,11 +384,16 @@ def edit_invoice(invoice_id):
         return redirect(url_for('view_invoice', invoice_id=invoice_id))
     
     form = InvoiceForm(obj=invoice)
+    if request.method == 'GET':
+        form.customer_address.data = invoice.get_customer_address()
     
     if form.validate_on_submit():
+        # العنوان المدخل يصبح العنوان الافتراضي للعميل، ولقطة الفاتورة تحفظه لها وحدها
+        invoice.customer = get_or_create_customer(form.customer_name.data, form.customer_tax_id.data,
+                                                  form.customer_address.data)
         invoice.customer_name = form.customer_name.data
         invoice.customer_tax_id = form.customer_tax_id.data
-        invoice.customer_address = form.customer_address.data
+        invoice.customer_address = form.customer_address.data or None
         invoice.invoice_date = form.invoice_date.data
         invoice.due_date = form.due_date.data
         invoice.notes = form.notes.data
@@ -427,25 +418,59 @@ def add_invoice_item(invoice_id):
     form = InvoiceItemForm()
     
     if form.validate_on_submit():
-        item = InvoiceItem(
-            invoice_id=invoice_id,
-            product_id=form.product_id.data,
-            quantity=form.quantity.data,
-            unit_price=form.unit_price.data,
-            discount_percentage=form.discount_percentage.data or 0
-        )
-        
-        db.session.add(item)
-        
-        # إعادة حساب إجماليات الفاتورة
-        invoice.calculate_totals()
-        db.session.commit()
+        try:
+            # تحديث إجماليات الفاتورة بفرق السطر الجديد فقط
+            add_item_to_invoice(invoice, {
+                'product_id': form.product_id.data,
+                'quantity': form.quantity.data,
+                'unit_price': form.unit_price.data,
+                'discount_percentage': form.discount_percentage.data or 0
+            })
+        except InvoiceValidationError as e:
+            flash(str(e), 'error')
+            return render_template('invoices/add_item.html', form=form, invoice=invoice)
         
         flash('تم إضافة المنتج للفاتورة بنجاح.', 'success')
         return redirect(url_for('view_invoice', invoice_id=invoice_id))
     
     return render_template('invoices/add_item.html', form=form, invoice=invoice)
 
+@app.route('/invoices/<int:invoice_id>/items/batch', methods=['GET', 'POST'])
+@login_required
+@permission_required('edit_invoice')
+def batch_invoice_items(invoice_id):
+    """إضافة عدة منتجات للفاتورة دفعة واحدة"""
+    invoice = Invoice.query.get_or_404(invoice_id)
+    
+    if invoice.is_cancelled:
+        flash('لا يمكن تعديل فاتورة ملغاة.', 'error')
+        return redirect(url_for('view_invoice', invoice_id=invoice_id))
+    
+    products = Product.query.filter_by(is_active=True).order_by(Product.name).all()
+    form = InvoiceItemsBatchForm(products=products)
+    
+    if form.validate_on_submit():
+        items_data = [
+            {
+                'product_id': entry.product_id.data,
+                'quantity': entry.quantity.data,
+                'unit_price': entry.unit_price.data,
+                'discount_percentage': entry.discount_percentage.data
+            }
+            for entry in form.items
+        ]
+        
+        errors = save_invoice_items(invoice, items_data, replace=form.replace_existing.data)
+        
+        if not errors:
+            flash(f'تم حفظ {len(items_data)} منتج في الفاتورة بنجاح.', 'success')
+            return redirect(url_for('view_invoice', invoice_id=invoice_id))
+        
+        for error in errors:
+            flash(f"السطر {error['line']}: {error['error']}", 'error')
+    
+    return render_template('invoices/batch_items.html', form=form, invoice=invoice, products=products)
+
 @app.route('/invoices/<int:invoice_id>/items/<int:item_id>/delete', methods=['POST'])
 @login_required
 @permission_required('edit_invoice')
@@ -462,11 +487,8 @@ def delete_invoice_item(invoice_id, item_id):
         flash('المنتج غير موجود في هذه الفاتورة.', 'error')
         return redirect(url_for('view_invoice', invoice_id=invoice_id))
     
-    db.session.delete(item)
-    
-    # إعادة حساب إجماليات الفاتورة
-    invoice.calculate_totals()
-    db.session.commit()
+    # طرح مبالغ السطر من إجماليات الفاتورة
+    remove_item_from_invoice(item)
     
     flash('تم حذف المنتج من الفاتورة بنجاح.', 'success')
     return redirect(url_for('view_invoice', invoice_id=invoice_id))
@@ -489,6 +511,25 @@ def cancel_invoice(invoice_id):
     return redirect(url_for('invoices_list'))
 
 # API endpoints
+@app.route('/api/products/catalog')
+@login_required
+def api_products_catalog():
+    """كتالوج المنتجات النشطة بإصدار (ETag) ليخزنه المتصفح ويعيد التحقق منه فقط"""
+    catalog = get_catalog()
+    
+    if catalog['version'] in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        response = jsonify({
+            'version': catalog['version'],
+            'fields': CATALOG_FIELDS,
+            'products': catalog['products']
+        })
+    
+    response.set_etag(catalog['version'])
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
 @app.route('/api/products/<int:product_id>')
 @login_required
 def api_get_product(product_id):
@@ -502,31 +543,99 @@ def api_get_product(product_id):
         'tax_rate': float(product.tax_rate)
     })
 
+@app.route('/api/invoices/bulk', methods=['POST'])
+@login_required
+@permission_required('create_invoice')
+def api_bulk_create_invoices():
+    """إنشاء مجموعة فواتير دفعة واحدة (للمزامنة مع نقاط البيع)"""
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({'error': 'يجب إرسال بيانات JSON صالحة.'}), 400
+    
+    try:
+        created, errors = bulk_create_invoices(payload.get('invoices'), current_user.id)
+    except InvoiceValidationError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if not created:
+        status_code = 400
+    elif errors:
+        status_code = 207
+    else:
+        status_code = 201
+    
+    return jsonify({
+        'created_count': len(created),
+        'error_count': len(errors),
+        'created': created,
+        'errors': errors
+    }), status_code
+
+@app.route('/api/invoices/<int:invoice_id>/items', methods=['POST', 'PUT'])
+@login_required
+@permission_required('edit_invoice')
+def api_save_invoice_items(invoice_id):
+    """حفظ أسطر الفاتورة دفعة واحدة (POST للتعديل والإضافة، PUT للاستبدال الكامل)"""
+    invoice = Invoice.query.get_or_404(invoice_id)
+    
+    if invoice.is_cancelled:
+        return jsonify({'error': 'لا يمكن تعديل فاتورة ملغاة.'}), 400
+    
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict):
+        return jsonify({'error': 'يجب إرسال بيانات JSON صالحة.'}), 400
+    
+    try:
+        errors = save_invoice_items(invoice, payload.get('items'), replace=request.method == 'PUT')
+    except InvoiceValidationError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if errors:
+        return jsonify({'errors': errors}), 400
+    
+    return jsonify({
+        'id': invoice.id,
+        'subtotal': float(invoice.subtotal),
+        'vat_amount': float(invoice.vat_amount),
+        'withholding_amount': float(invoice.withholding_amount),
+        'total_amount': float(invoice.total_amount)
+    })
+
 @app.route('/api/dashboard/stats')
 @login_required
 def api_dashboard_stats():
-    """إحصائيات لوحة التحكم"""
-    today = datetime.now().date()
-    current_month_start = today.replace(day=1)
-    
-    # بيانات آخر 7 أيام
-    daily_stats = []
-    for i in range(7):
-        date = today - timedelta(days=i)
-        day_invoices = Invoice.query.filter(
-            Invoice.invoice_date == date,
-            Invoice.is_cancelled == False
-        ).all()
-        
-        daily_stats.append({
-            'date': date.isoformat(),
-            'invoices_count': len(day_invoices),
-            'total_sales': float(sum(inv.total_amount for inv in day_invoices)),
-            'vat_amount': float(sum(inv.vat_amount for inv in day_invoices)),
-            'withholding_amount': float(sum(inv.withholding_amount for inv in day_invoices))
-        })
+    """إحصائيات لوحة التحكم (اليوم، الشهر، آخر 7 أيام) في رد واحد يدعم الطلب المشروط"""
+    stats, etag = get_dashboard_stats()
     
-    return jsonify(list(reversed(daily_stats)))
+    if etag in request.if_none_match:
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(stats)
+    
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/api/dashboard/events')
+@login_required
+def api_dashboard_events():
+    """بث فروق إحصائيات لوحة التحكم (Server-Sent Events) بدلاً من الاستطلاع المتكرر"""
+    try:
+        broadcaster.acquire()
+    except TooManyConnections:
+        response = jsonify({'error': 'عدد الاتصالات المباشرة بلغ الحد الأقصى، حاول لاحقاً.'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+    
+    # المتصفح يرسل Last-Event-ID تلقائياً عند إعادة الاتصال
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    
+    response = app.response_class(broadcaster.stream(last_event_id), mimetype='text/event-stream')
+    response.call_on_close(broadcaster.release)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 # إعدادات النظام
 @app.route('/settings', methods=['GET', 'POST'])
@@ -549,6 +658,8 @@ def system_settings():
         form.backup_frequency.data = SystemSettings.get_setting('backup_frequency', 'weekly')
         form.invoice_prefix.data = SystemSettings.get_setting('invoice_prefix', 'INV')
         form.invoice_start_number.data = int(SystemSettings.get_setting('invoice_start_number', '1'))
+        locked_until = SystemSettings.get_setting('invoices_locked_until')
+        form.invoices_locked_until.data = datetime.strptime(locked_until, '%Y-%m-%d').date() if locked_until else None
     
     if form.validate_on_submit():
         # حفظ الإعدادات
@@ -563,7 +674,8 @@ def system_settings():
             ('auto_backup_enabled', str(form.auto_backup_enabled.data).lower()),
             ('backup_frequency', form.backup_frequency.data),
             ('invoice_prefix', form.invoice_prefix.data),
-            ('invoice_start_number', str(form.invoice_start_number.data))
+            ('invoice_start_number', str(form.invoice_start_number.data)),
+            ('invoices_locked_until', form.invoices_locked_until.data.isoformat() if form.invoices_locked_until.data else '')
         ]
         
         for key, value in settings_to_save:
@@ -572,10 +684,11 @@ def system_settings():
         flash('تم حفظ الإعدادات بنجاح.', 'success')
         return redirect(url_for('system_settings'))
     
-    return render_template('settings.html', form=form)
-
-# إنشاء التطبيق
-app = create_app()
+    # تقرير آخر تحقق من إجماليات الفواتير (الانحرافات في الفواتير القديمة لا تُصحح تلقائياً)
+    totals_report = SystemSettings.get_setting('invoice_totals_report')
+    totals_report = json.loads(totals_report) if totals_report else None
+    
+    return render_template('settings.html', form=form, totals_report=totals_report)
 
 if __name__ == '__main__':
     # تكوين البورت للإنتاج (Railway) أو التطوير
@@ -1,12 +1,68 @@
 from functools import wraps
+import time
 from flask import Blueprint, render_template, redirect, url_for, flash, request, session
 from flask_login import login_user, logout_user, login_required, current_user
-from models import User, UserRole, db
+from sqlalchemy import event
+from sqlalchemy.orm import make_transient_to_detached
+from models import User, UserRole, ROLE_PERMISSIONS, db
+from passwords import PasswordHashingBusy
 from forms import LoginForm, UserForm, ChangePasswordForm
 from datetime import datetime
 
 auth_bp = Blueprint('auth', __name__)
 
+# مدة الاعتماد على بيانات المستخدم المخزنة في العملية قبل إعادة قراءتها (بالثواني)
+# ختم الأمان يُقرأ من القاعدة في كل طلب، فتغيير الدور أو كلمة المرور أو التفعيل من
+# أي عملية يظهر فوراً؛ هذه المدة تخص الحقول الأخرى (الاسم، البريد) فقط
+USER_CACHE_TTL = 30
+
+_user_cache = {}
+
+def load_cached_user(session_user_id):
+    """تحميل مستخدم الجلسة باستعلام عمود واحد (ختم الأمان) ما دام مخزناً
+
+    معرف الجلسة بالصيغة "id:security_stamp"؛ الجلسات القديمة بلا ختم أو بختم
+    قديم تُرفض فيُطلب تسجيل الدخول مجدداً، وكذلك المستخدم غير المفعل. الختم
+    يتجدد مع كل تغيير في الدور أو كلمة المرور أو التفعيل (bump_security_stamp).
+    """
+    try:
+        user_id, stamp = session_user_id.split(':', 1)
+        user_id = int(user_id)
+    except (AttributeError, ValueError):
+        return None
+    
+    current_stamp = db.session.query(User.security_stamp).filter(User.id == user_id).scalar()
+    if current_stamp is None or current_stamp != stamp:
+        _user_cache.pop(user_id, None)
+        return None
+    
+    now = time.monotonic()
+    cached = _user_cache.get(user_id)
+    user = None
+    if cached is None or cached[1]['security_stamp'] != current_stamp or now - cached[0] >= USER_CACHE_TTL:
+        user = db.session.get(User, user_id)
+        if user is None:
+            _user_cache.pop(user_id, None)
+            return None
+        cached = (now, {attr.key: getattr(user, attr.key) for attr in User.__mapper__.column_attrs})
+        _user_cache[user_id] = cached
+    
+    values = cached[1]
+    if values['security_stamp'] != stamp or not values['is_active']:
+        return None
+    
+    if user is None:
+        # نسخة مرتبطة بجلسة الطلب الحالي من القيم المخزنة (merge بدون تحميل لا ينفذ استعلاماً)
+        user = User(**values)
+        make_transient_to_detached(user)
+        user = db.session.merge(user, load=False)
+    return user
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def forget_cached_user(mapper, connection, target):
+    _user_cache.pop(target.id, None)
+
 def permission_required(permission):
     """ديكوريتر للتحقق من الصلاحيات"""
     def decorator(f):
@@ -43,7 +99,13 @@ def login():
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
         
-        if user and user.check_password(form.password.data) and user.is_active:
+        try:
+            password_valid = user is not None and user.check_password(form.password.data)
+        except PasswordHashingBusy:
+            flash('الخادم مشغول حالياً بعمليات تسجيل دخول كثيرة، حاول مرة أخرى بعد لحظات.', 'warning')
+            return render_template('auth/login.html', form=form), 503
+        
+        if password_valid and user.is_active:
             # تحديث آخر تسجيل دخول
             user.last_login = datetime.utcnow()
             db.session.commit()
@@ -94,7 +156,11 @@ def create_user():
             role=UserRole(form.role.data),
             is_active=form.is_active.data
         )
-        user.set_password(form.password.data)
+        try:
+            user.set_password(form.password.data)
+        except PasswordHashingBusy:
+            flash('الخادم مشغول حالياً بعمليات تسجيل دخول كثيرة، حاول مرة أخرى بعد لحظات.', 'warning')
+            return render_template('auth/user_form.html', form=form, title='إنشاء مستخدم جديد'), 503
         
         db.session.add(user)
         db.session.commit()
@@ -163,13 +229,21 @@ def change_password():
     form = ChangePasswordForm()
     
     if form.validate_on_submit():
-        if not current_user.check_password(form.current_password.data):
-            flash('كلمة المرور الحالية غير صحيحة.', 'error')
-            return render_template('auth/change_password.html', form=form)
-        
-        current_user.set_password(form.new_password.data)
+        try:
+            if not current_user.check_password(form.current_password.data):
+                flash('كلمة المرور الحالية غير صحيحة.', 'error')
+                return render_template('auth/change_password.html', form=form)
+            
+            current_user.set_password(form.new_password.data)
+        except PasswordHashingBusy:
+            db.session.rollback()
+            flash('الخادم مشغول حالياً بعمليات تسجيل دخول كثيرة، حاول مرة أخرى بعد لحظات.', 'warning')
+            return render_template('auth/change_password.html', form=form), 503
         db.session.commit()
         
+        # تغيير كلمة المرور يجدد ختم الأمان، فتُحدَّث جلسة المستخدم الحالية بالختم الجديد
+        login_user(current_user._get_current_object())
+        
         flash('تم تغيير كلمة المرور بنجاح.', 'success')
         return redirect(url_for('auth.profile'))
     
@@ -184,7 +258,11 @@ def reset_user_password(user_id):
     
     # كلمة مرور مؤقتة
     temp_password = f"temp{user.id}123"
-    user.set_password(temp_password)
+    try:
+        user.set_password(temp_password)
+    except PasswordHashingBusy:
+        flash('الخادم مشغول حالياً بعمليات تسجيل دخول كثيرة، حاول مرة أخرى بعد لحظات.', 'warning')
+        return redirect(url_for('auth.users_list'))
     db.session.commit()
     
     flash(f'تم إعادة تعيين كلمة مرور المستخدم {user.username}. كلمة المرور المؤقتة: {temp_password}', 'info')
@@ -242,23 +320,4 @@ def get_user_permissions(user):
     if not user or not user.is_authenticated:
         return []
     
-    permissions_map = {
-        UserRole.ADMIN: [
-            'create_invoice', 'edit_invoice', 'delete_invoice', 'view_invoice',
-            'create_product', 'edit_product', 'delete_product', 'view_product',
-            'create_user', 'edit_user', 'delete_user', 'view_user',
-            'view_reports', 'export_reports', 'backup_system', 'restore_system',
-            'manage_settings'
-        ],
-        UserRole.ACCOUNTANT: [
-            'create_invoice', 'edit_invoice', 'view_invoice',
-            'create_product', 'edit_product', 'view_product',
-            'view_reports', 'export_reports'
-        ],
-        UserRole.USER: [
-            'create_invoice', 'view_invoice',
-            'view_product'
-        ]
-    }
-    
-    return permissions_map.get(user.role, [])
+    return sorted(ROLE_PERMISSIONS.get(user.role, ()))
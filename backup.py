@@ -1,20 +1,163 @@
 import os
 import shutil
+import hashlib
 import sqlite3
 import json
 import zipfile
-from datetime import datetime
-from flask import Blueprint, render_template, request, flash, redirect, url_for, send_file, current_app
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from flask import Blueprint, render_template, request, flash, redirect, url_for, send_file, current_app, jsonify
 from flask_login import login_required, current_user
-from models import db, BackupLog, SystemSettings, User, Product, Invoice, InvoiceItem, TaxReport
+from enum import Enum
+from sqlalchemy import select, event, func
+from sqlalchemy.exc import DisconnectionError
+from sqlalchemy.pool import Pool
+from models import db, BackupLog, SystemSettings, DeletedRecord, User, Customer, Product, Invoice, InvoiceItem, TaxReport
 from forms import BackupForm, RestoreForm
+from restore_engine import restore_tables, apply_table_changes, read_ndjson, RestoreError
+from backup_repository import BackupRepository, MANIFEST_SUFFIX, new_manifest, read_manifest
+from parallel_zip import ParallelZipWriter, METHODS, LEVELS, benchmark_compression
+from backup_jobs import BackupJob, JobProgress, JobBusy, JobCancelled, start_job, run_job, read_job, current_job, request_cancel
+from backup_retention import (apply_retention, sync_backup_catalog, remove_backup_files, get_retention_policy,
+                              catalog_size, restore_candidates, RETENTION_DEFAULTS)
+from scheduler import register_job, get_job_state, utc_to_local, daily_at, weekly_at, monthly_at, RetryLater
+from migrations import upgrade_database
+from pagination import invalidate_summaries
+from live_events import broadcaster
 from auth import admin_required
-import schedule
 import time
-import threading
 
 backup_bp = Blueprint('backup', __name__)
 
+# عدد صفحات SQLite المنسوخة في كل خطوة من النسخ الحي، والاستراحة بين الخطوات
+# حتى لا يُحجز قفل القراءة طويلاً فتتأخر كتابة الفواتير
+SNAPSHOT_PAGES_PER_STEP = 1024
+SNAPSHOT_STEP_SLEEP = 0.01
+
+# في غير وضع WAL: بعد هذا العدد من إعادة البدء (بسبب الكتابة أثناء النسخ) يُنسخ الباقي في خطوة واحدة
+SNAPSHOT_MAX_RESTARTS = 3
+
+# جداول نسخة البيانات بترتيب المفاتيح الأجنبية (الجدول المرجعي قبل الجدول التابع)
+DATA_BACKUP_MODELS = [User, Customer, Product, Invoice, InvoiceItem, TaxReport]
+
+# عدد الصفوف المقروءة من قاعدة البيانات والمكتوبة في الأرشيف في كل دفعة
+DATA_BACKUP_BATCH_SIZE = 2000
+
+# ملفات قاعدة البيانات ومرافقاتها التي لا تُنسخ كملفات عادية
+DATABASE_FILE_SUFFIXES = ('.db', '.db-wal', '.db-shm', '.db-journal', '.tmp')
+
+# حجم القطعة المقروءة من الملفات وأعضاء الأرشيف عند النسخ والاستعادة
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# لاحقة الملف الجانبي الذي تُكتب فيه الاستعادة قبل استبدال الملف الأصلي
+RESTORE_SIDE_SUFFIX = '.restore-tmp'
+
+# أقصى عدد نسخ في السلسلة (الأساسية + التزايدية) قبل أخذ نسخة أساسية جديدة
+INCREMENTAL_CHAIN_LENGTH = 7
+
+# هامش زمني تبدأ منه النسخة التزايدية قبل وقت سابقتها، حتى تُلتقط الصفوف التي
+# كُتب وقتها قبل بدء النسخة السابقة ولم تكتمل معاملتها إلا بعده
+INCREMENTAL_OVERLAP = timedelta(minutes=5)
+
+# جداول تُنسخ تزايدياً مع أصلها: كل أسطر الفاتورة المتغيرة تُنسخ وتُستبدل معاً
+INCREMENTAL_CHILD_TABLES = {'invoice_items': ('invoice_id', 'invoices')}
+
+# أعمدة وقت التغيير بالترتيب، يُستخدم أول عمود غير فارغ منها لكل صف
+CHANGE_TIME_COLUMNS = ('updated_at', 'created_at', 'generated_at')
+
+# مستودع النسخ بدون تكرار (قطع مشتركة بين النسخ) داخل مجلد النسخ
+REPOSITORY_DIR = os.path.join('instance', 'backups', 'repository')
+
+# حجم عينة قاعدة البيانات المستخدمة في قياس خوارزميات الضغط
+COMPRESSION_BENCHMARK_SAMPLE = 16 * 1024 * 1024
+
+def get_sqlite_path():
+    """المسار الفعلي لملف قاعدة بيانات SQLite كما يستخدمه المحرك (None لغير SQLite)
+
+    Flask-SQLAlchemy يحوّل المسار النسبي في sqlite:/// إلى مجلد instance، لذلك
+    يُقرأ المسار من المحرك وليس من نص الإعداد.
+    """
+    url = db.engine.url
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        return None
+    return url.database
+
+@event.listens_for(Pool, 'connect')
+def remember_sqlite_file(dbapi_connection, connection_record):
+    """حفظ هوية ملف قاعدة SQLite التي فُتح عليها الاتصال"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        row = dbapi_connection.execute("SELECT file FROM pragma_database_list WHERE name = 'main'").fetchone()
+        if row and row[0] and os.path.exists(row[0]):
+            connection_record.info['sqlite_file'] = (row[0], os.stat(row[0]).st_ino)
+
+@event.listens_for(Pool, 'checkout')
+def detect_replaced_sqlite_file(dbapi_connection, connection_record, connection_proxy):
+    """إعادة الاتصال إذا استُبدل ملف القاعدة من خارج التطبيق (نسخه يدوياً مثلاً)
+
+    الاستعادة تكتب في الملف الحي نفسه (swap_database_file)، أما استبدال الملف
+    فيُبقي الاتصالات القديمة مفتوحة على الملف المحذوف؛ تغير رقم inode يكشف ذلك
+    فيُفتح اتصال جديد.
+    """
+    sqlite_file = connection_record.info.get('sqlite_file')
+    if not sqlite_file:
+        return
+    path, inode = sqlite_file
+    try:
+        replaced = os.stat(path).st_ino != inode
+    except OSError:
+        replaced = True
+    if replaced:
+        raise DisconnectionError('تم استبدال ملف قاعدة البيانات')
+
+class SnapshotRestarted(Exception):
+    """أعادت SQLite بدء النسخ مرات كثيرة بسبب الكتابة المستمرة"""
+
+def snapshot_database(target_path, pages=SNAPSHOT_PAGES_PER_STEP, step_sleep=SNAPSHOT_STEP_SLEEP, progress=None):
+    """لقطة متسقة من قاعدة البيانات الحية باستخدام SQLite Online Backup API
+
+    في وضع WAL تُثبَّت معاملة قراءة على اتصال المصدر فتُنسخ حالة ملتزمة واحدة
+    على خطوات صغيرة مع استراحة بينها، بينما تستمر كتابة الفواتير دون انتظار.
+    في وضع journal العادي تعيد SQLite البدء عند أي كتابة، فبعد عدة محاولات
+    يُنسخ الباقي في خطوة واحدة حتى لا يستمر النسخ بلا نهاية.
+    progress (JobProgress) يُبلَّغ بعد كل خطوة، فتُلغى المهمة بين الخطوات.
+    """
+    progress = progress or JobProgress()
+    db_path = get_sqlite_path()
+    if not db_path or not os.path.exists(db_path):
+        return False
+    
+    state = {'remaining': None, 'restarts': 0}
+    
+    def step(status, remaining, total):
+        progress.changed()
+        # عدم تناقص المتبقي يعني أن SQLite أعادت البدء بسبب كتابة من اتصال آخر
+        if state['remaining'] is not None and remaining >= state['remaining']:
+            state['restarts'] += 1
+            if state['restarts'] >= SNAPSHOT_MAX_RESTARTS:
+                raise SnapshotRestarted()
+        state['remaining'] = remaining
+        if remaining:
+            time.sleep(step_sleep)
+    
+    source = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    target = sqlite3.connect(target_path)
+    try:
+        if source.execute('PRAGMA journal_mode').fetchone()[0].lower() == 'wal':
+            # تثبيت لقطة القراءة طوال النسخ
+            source.execute('BEGIN')
+            source.execute('SELECT count(*) FROM sqlite_master').fetchone()
+        try:
+            source.backup(target, pages=pages, progress=step)
+        except SnapshotRestarted:
+            source.backup(target, pages=-1)
+        if source.in_transaction:
+            source.execute('COMMIT')
+    finally:
+        target.close()
+        source.close()
+    return True
+
 @backup_bp.route('/backup')
 @login_required
 @admin_required
@@ -29,14 +172,34 @@ def backup_dashboard():
     failed_backups = BackupLog.query.filter_by(status='failed').count()
     
     # حجم قاعدة البيانات
-    db_path = current_app.config.get('SQLALCHEMY_DATABASE_URI', '').replace('sqlite:///', '')
+    db_path = get_sqlite_path()
     db_size = 0
-    if os.path.exists(db_path):
+    if db_path and os.path.exists(db_path):
         db_size = os.path.getsize(db_path)
     
     # إعدادات النسخ الاحتياطي التلقائي
     auto_backup_enabled = SystemSettings.get_setting('auto_backup_enabled', 'false') == 'true'
     backup_frequency = SystemSettings.get_setting('backup_frequency', 'weekly')
+    auto_backup_type = SystemSettings.get_setting('auto_backup_type', 'incremental')
+    backup_compression, backup_compression_level = get_compression_settings()
+    
+    # آخر تشغيل والموعد التالي للنسخ التلقائي (من حالة المجدول المشتركة بين العمال)
+    backup_schedule = None
+    schedule_state = get_job_state('automatic_backup')
+    if schedule_state is not None:
+        backup_schedule = {
+            'next_run': utc_to_local(schedule_state.next_run_at) if schedule_state.next_run_at else None,
+            'last_run': utc_to_local(schedule_state.last_run_at) if schedule_state.last_run_at else None,
+            'last_status': schedule_state.last_status,
+            'last_error': schedule_state.last_error
+        }
+    
+    # حالة سلسلة النسخ التزايدية الحالية
+    chain_status = get_backup_chain_status()
+    
+    # سياسة الاحتفاظ والحجم الحالي للنسخ حسب السجل
+    retention_policy = get_retention_policy()
+    backups_size = catalog_size()
     
     return render_template('backup/dashboard.html',
                          recent_backups=recent_backups,
@@ -45,7 +208,15 @@ def backup_dashboard():
                          failed_backups=failed_backups,
                          db_size=db_size,
                          auto_backup_enabled=auto_backup_enabled,
-                         backup_frequency=backup_frequency)
+                         backup_frequency=backup_frequency,
+                         auto_backup_type=auto_backup_type,
+                         backup_compression=backup_compression,
+                         backup_compression_level=backup_compression_level,
+                         compression_levels={method: list(LEVELS[method]) for method in ('deflate', 'bz2', 'lzma')},
+                         backup_schedule=backup_schedule,
+                         chain_status=chain_status,
+                         retention_policy=retention_policy,
+                         backups_size=backups_size)
 
 @backup_bp.route('/backup/create', methods=['GET', 'POST'])
 @login_required
@@ -55,20 +226,23 @@ def create_backup():
     form = BackupForm()
     
     if form.validate_on_submit():
+        if form.backup_type.data == 'repository' and not get_sqlite_path():
+            flash('نسخ المستودع متاحة لقاعدة SQLite فقط.', 'error')
+            return render_template('backup/create.html', form=form)
+        
+        params = {
+            'backup_type': form.backup_type.data,
+            'include_files': form.include_files.data,
+            'compress': form.compress.data
+        }
         try:
-            backup_path = perform_backup(
-                backup_type=form.backup_type.data,
-                include_files=form.include_files.data,
-                compress=form.compress.data,
-                user_id=current_user.id
-            )
-            
-            if backup_path:
-                flash('تم إنشاء النسخة الاحتياطية بنجاح.', 'success')
-                return redirect(url_for('backup.backup_dashboard'))
-            else:
-                flash('فشل في إنشاء النسخة الاحتياطية.', 'error')
+            start_job(current_app._get_current_object(), 'backup', params, backup_job_target(params, current_user.id),
+                      user_id=current_user.id)
+            flash('بدأ إنشاء النسخة الاحتياطية في الخلفية، ويظهر تقدمه في لوحة النسخ.', 'info')
+            return redirect(url_for('backup.backup_dashboard'))
         
+        except JobBusy as e:
+            flash(f'{str(e)}، انتظر حتى تنتهي أو ألغها.', 'error')
         except Exception as e:
             flash(f'خطأ في إنشاء النسخة الاحتياطية: {str(e)}', 'error')
     
@@ -81,24 +255,17 @@ def restore_backup():
     """استعادة نسخة احتياطية"""
     form = RestoreForm()
     
-    # قائمة النسخ الاحتياطية المتاحة
-    backups_dir = os.path.join('instance', 'backups')
-    available_backups = []
-    
-    if os.path.exists(backups_dir):
-        for filename in os.listdir(backups_dir):
-            if filename.endswith(('.zip', '.sql', '.json')):
-                filepath = os.path.join(backups_dir, filename)
-                file_size = os.path.getsize(filepath)
-                file_date = datetime.fromtimestamp(os.path.getmtime(filepath))
-                available_backups.append({
-                    'filename': filename,
-                    'filepath': filepath,
-                    'size': file_size,
-                    'date': file_date
-                })
-    
-    available_backups.sort(key=lambda x: x['date'], reverse=True)
+    # قائمة النسخ الاحتياطية المتاحة من سجل النسخ (لنسخ المستودع: ملف الوصف هو ما يُختار للاستعادة)
+    available_backups = [
+        {
+            'filename': os.path.basename(backup.file_path),
+            'filepath': backup.file_path,
+            'kind': backup.backup_kind,
+            'size': backup.file_size or 0,
+            'date': utc_to_local(backup.created_at)
+        }
+        for backup in restore_candidates()
+    ]
     
     if form.validate_on_submit():
         try:
@@ -109,18 +276,14 @@ def restore_backup():
                 flash('ملف النسخة الاحتياطية غير موجود.', 'error')
                 return render_template('backup/restore.html', form=form, backups=available_backups)
             
-            success = perform_restore(
-                backup_file=backup_file,
-                restore_type=restore_type,
-                user_id=current_user.id
-            )
-            
-            if success:
-                flash('تم استعادة النسخة الاحتياطية بنجاح.', 'success')
-                return redirect(url_for('backup.backup_dashboard'))
-            else:
-                flash('فشل في استعادة النسخة الاحتياطية.', 'error')
+            params = {'backup_file': backup_file, 'restore_type': restore_type}
+            start_job(current_app._get_current_object(), 'restore', params, restore_job_target(params),
+                      user_id=current_user.id)
+            flash('بدأت الاستعادة في الخلفية، ويظهر تقدمها في لوحة النسخ.', 'info')
+            return redirect(url_for('backup.backup_dashboard'))
         
+        except JobBusy as e:
+            flash(f'{str(e)}، انتظر حتى تنتهي أو ألغها.', 'error')
         except Exception as e:
             flash(f'خطأ في استعادة النسخة الاحتياطية: {str(e)}', 'error')
     
@@ -137,6 +300,10 @@ def download_backup(backup_id):
         flash('ملف النسخة الاحتياطية غير موجود.', 'error')
         return redirect(url_for('backup.backup_dashboard'))
     
+    if backup_log.file_path.endswith(MANIFEST_SUFFIX):
+        flash('نسخ المستودع مكونة من قطع مشتركة وتُستعاد من الخادم مباشرة، ولا يمكن تحميلها كملف واحد.', 'warning')
+        return redirect(url_for('backup.backup_dashboard'))
+    
     return send_file(
         backup_log.file_path,
         as_attachment=True,
@@ -150,10 +317,26 @@ def delete_backup(backup_id):
     """حذف نسخة احتياطية"""
     backup_log = BackupLog.query.get_or_404(backup_id)
     
+    # جمع قطع المستودع أثناء نسخة جارية قد يحذف قطعاً كتبتها ولم يُحفظ ملف وصفها بعد
+    lock = BackupJob('delete', {'backup_id': backup_id}, current_user.id)
+    try:
+        lock.acquire()
+    except JobBusy as e:
+        flash(f'{str(e)}، انتظر حتى تنتهي ثم احذف النسخة.', 'error')
+        return redirect(url_for('backup.backup_dashboard'))
+    
     try:
-        # حذف الملف
-        if os.path.exists(backup_log.file_path):
-            os.remove(backup_log.file_path)
+        # حذف الملف (أو المجلد للنسخ غير المضغوطة)
+        if backup_log.file_path:
+            remove_backup_files(backup_log.file_path)
+        
+        # حذف قطع المستودع التي لم تعد أي نسخة تشير إليها
+        if backup_log.file_path.endswith(MANIFEST_SUFFIX):
+            removed, freed = BackupRepository(REPOSITORY_DIR).collect_garbage()
+            print(f'مستودع النسخ: حُذفت {removed} قطعة ({freed} بايت)')
+        
+        # النسخ التزايدية المبنية عليها تصبح سلسلة مقطوعة
+        BackupLog.query.filter_by(parent_id=backup_log.id).update({'parent_id': None})
         
         # حذف السجل من قاعدة البيانات
         db.session.delete(backup_log)
@@ -163,6 +346,8 @@ def delete_backup(backup_id):
     
     except Exception as e:
         flash(f'خطأ في حذف النسخة الاحتياطية: {str(e)}', 'error')
+    finally:
+        lock.release()
     
     return redirect(url_for('backup.backup_dashboard'))
 
@@ -173,152 +358,588 @@ def update_backup_settings():
     """تحديث إعدادات النسخ الاحتياطي"""
     auto_backup_enabled = request.form.get('auto_backup_enabled') == 'on'
     backup_frequency = request.form.get('backup_frequency', 'weekly')
+    auto_backup_type = request.form.get('auto_backup_type', 'incremental')
+    if auto_backup_type not in ('incremental', 'repository'):
+        auto_backup_type = 'incremental'
+    if auto_backup_type == 'repository' and not get_sqlite_path():
+        flash('نسخ المستودع متاحة لقاعدة SQLite فقط، سيُستخدم النسخ التزايدي.', 'warning')
+        auto_backup_type = 'incremental'
+    backup_compression = request.form.get('backup_compression', 'deflate')
+    if backup_compression not in METHODS or backup_compression == 'stored':
+        backup_compression = 'deflate'
+    backup_compression_level = request.form.get('backup_compression_level', '')
+    if not backup_compression_level.isdigit() or int(backup_compression_level) not in LEVELS[backup_compression]:
+        backup_compression_level = str(METHODS[backup_compression][2])
     
     SystemSettings.set_setting('auto_backup_enabled', str(auto_backup_enabled).lower(), user_id=current_user.id)
     SystemSettings.set_setting('backup_frequency', backup_frequency, user_id=current_user.id)
+    SystemSettings.set_setting('auto_backup_type', auto_backup_type, user_id=current_user.id)
+    SystemSettings.set_setting('backup_compression', backup_compression, user_id=current_user.id)
+    SystemSettings.set_setting('backup_compression_level', backup_compression_level, user_id=current_user.id)
     
-    # إعادة جدولة النسخ الاحتياطي التلقائي
-    schedule_automatic_backups()
+    # سياسة الاحتفاظ: تُطبق بعد النسخة التالية
+    for key, default in RETENTION_DEFAULTS.items():
+        value = request.form.get(key, '').strip()
+        SystemSettings.set_setting(key, value if value.isdigit() else str(default), user_id=current_user.id)
     
     flash('تم تحديث إعدادات النسخ الاحتياطي بنجاح.', 'success')
     return redirect(url_for('backup.backup_dashboard'))
 
-def perform_backup(backup_type='full', include_files=True, compress=True, user_id=None):
-    """تنفيذ عملية النسخ الاحتياطي"""
+@backup_bp.route('/backup/compression-benchmark', methods=['POST'])
+@login_required
+@admin_required
+def compression_benchmark():
+    """قياس خوارزميات ومستويات الضغط على عينة من قاعدة البيانات الحالية"""
+    db_path = get_sqlite_path()
+    if not db_path or not os.path.exists(db_path):
+        return jsonify({'error': 'القياس متاح لقاعدة SQLite فقط'}), 400
+    
+    with open(db_path, 'rb') as f:
+        sample = f.read(COMPRESSION_BENCHMARK_SAMPLE)
+    if not sample:
+        return jsonify({'error': 'قاعدة البيانات فارغة'}), 400
+    
+    report = benchmark_compression(sample)
+    report['sample_size'] = len(sample)
+    report['workers'] = os.cpu_count()
+    return jsonify(report)
+
+@backup_bp.route('/backup/jobs/current')
+@login_required
+@admin_required
+def backup_job_current():
+    """المهمة الجارية (أو آخر مهمة منتهية) لعرض تقدمها في لوحة النسخ"""
+    return jsonify({'job': current_job()})
+
+@backup_bp.route('/backup/jobs/<job_id>')
+@login_required
+@admin_required
+def backup_job_status(job_id):
+    """حالة مهمة نسخ أو استعادة"""
+    job = read_job(job_id) if job_id.isalnum() else None
+    if not job:
+        return jsonify({'error': 'المهمة غير موجودة'}), 404
+    return jsonify({'job': job})
+
+@backup_bp.route('/backup/jobs/<job_id>/cancel', methods=['POST'])
+@login_required
+@admin_required
+def cancel_backup_job(job_id):
+    """طلب إلغاء مهمة جارية؛ تتوقف عند نقطة التقدم التالية"""
+    if not job_id.isalnum() or not request_cancel(job_id):
+        return jsonify({'error': 'لا توجد مهمة جارية بهذا المعرف'}), 404
+    return jsonify({'cancelling': True})
+
+def backup_job_target(params, user_id=None):
+    """دالة مهمة النسخ الخلفية"""
+    def target(job):
+        backup_path = perform_backup(
+            backup_type=params['backup_type'],
+            include_files=params['include_files'],
+            compress=params['compress'],
+            user_id=user_id,
+            progress=job
+        )
+        result = {'backup_file': os.path.basename(backup_path)}
+        
+        # النسخة نجحت حتى لو فشل تطبيق سياسة الاحتفاظ؛ يُعاد التطبيق بعد النسخة التالية
+        try:
+            result.update(apply_retention(job))
+        except Exception as e:
+            db.session.rollback()
+            print(f'خطأ في تطبيق سياسة الاحتفاظ: {str(e)}')
+        return result
+    return target
+
+def restore_job_target(params):
+    """دالة مهمة الاستعادة الخلفية"""
+    def target(job):
+        restore_backup_file(params['backup_file'], params['restore_type'], progress=job)
+        
+        # الاستعادة الكاملة تستبدل سجل النسخ بنسخته القديمة، فتُسجل النسخ الأحدث منها من جديد
+        try:
+            sync_backup_catalog()
+        except Exception as e:
+            db.session.rollback()
+            print(f'خطأ في مطابقة سجل النسخ: {str(e)}')
+        return {'backup_file': os.path.basename(params['backup_file'])}
+    return target
+
+def perform_backup(backup_type='full', include_files=True, compress=True, user_id=None, progress=None):
+    """تنفيذ عملية النسخ الاحتياطي
+
+    النسخة التزايدية تُبنى على آخر نسخة في السلسلة الحالية؛ وإذا لم توجد سلسلة
+    صالحة (أو بلغت أقصى طول) تؤخذ نسخة أساسية جديدة بدلاً منها.
+    progress (JobProgress أو BackupJob) يتلقى التقدم، ومنه تُسجل مدة النسخ وسرعته.
+    """
+    progress = progress or JobProgress()
+    backups_dir = os.path.join('instance', 'backups')
+    backup_name = None
     try:
         # إنشاء مجلد النسخ الاحتياطي
-        backups_dir = os.path.join('instance', 'backups')
         os.makedirs(backups_dir, exist_ok=True)
         
+        parent = None
+        if backup_type == 'incremental':
+            parent = find_chain_parent()
+            if parent is None:
+                backup_type = 'full' if get_sqlite_path() else 'data_only'
+        
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
         backup_name = f'backup_{backup_type}_{timestamp}'
+        # نسختان في نفس الثانية (يدوية وتلقائية) لا تكتب إحداهما فوق الأخرى
+        suffix = 1
+        while any(os.path.exists(os.path.join(backups_dir, backup_name + ext)) for ext in ('', '.zip', '.sql')) \
+                or os.path.exists(BackupRepository(os.path.join(backups_dir, 'repository')).manifest_path(backup_name)):
+            suffix += 1
+            backup_name = f'backup_{backup_type}_{timestamp}_{suffix}'
+        # وقت بدء القراءة، تبدأ منه النسخة التزايدية التالية
+        snapshot_at = datetime.utcnow()
         
         if backup_type == 'full':
-            backup_path = create_full_backup(backups_dir, backup_name, include_files, compress)
+            backup_path = create_full_backup(backups_dir, backup_name, include_files, compress, progress)
         elif backup_type == 'data_only':
-            backup_path = create_data_backup(backups_dir, backup_name, compress)
+            backup_path = create_data_backup(backups_dir, backup_name, compress, progress)
         elif backup_type == 'structure_only':
-            backup_path = create_structure_backup(backups_dir, backup_name, compress)
+            backup_path = create_structure_backup(backups_dir, backup_name, compress, progress)
+        elif backup_type == 'incremental':
+            backup_path = create_incremental_backup(backups_dir, backup_name, parent, snapshot_at, include_files, compress,
+                                                    progress)
+        elif backup_type == 'repository':
+            backup_path = create_repository_backup(backups_dir, backup_name, include_files, progress)
         else:
             raise ValueError(f'نوع النسخ الاحتياطي غير مدعوم: {backup_type}')
         
-        # حساب حجم الملف
-        file_size = os.path.getsize(backup_path) if os.path.exists(backup_path) else 0
+        # حساب حجم الملف (لنسخ المستودع: حجم القطع الجديدة التي كتبتها النسخة)
+        if backup_path.endswith(MANIFEST_SUFFIX):
+            file_size = read_manifest(backup_path)['stats']['stored_bytes']
+        else:
+            file_size = os.path.getsize(backup_path) if os.path.exists(backup_path) else 0
+        
+        # النسخ الكاملة ونسخ البيانات المضغوطة تبدأ سلسلة تزايدية جديدة
+        chain_id = None
+        if parent is not None:
+            chain_id = parent.chain_id
+        elif backup_type in ('full', 'data_only') and backup_path.endswith('.zip'):
+            chain_id = uuid.uuid4().hex
+        
+        # بعد اكتمال الملف لا يُلغى النسخ (يبقى التسجيل فقط)
+        progress.set_phase('تسجيل النسخة', cancellable=False)
         
         # تسجيل النسخة الاحتياطية
         backup_log = BackupLog(
-            backup_type='manual',
+            backup_type='manual' if user_id else 'automatic',
+            backup_kind=backup_type,
             file_path=backup_path,
             file_size=file_size,
             status='success',
-            created_by=user_id
+            created_by=user_id,
+            chain_id=chain_id,
+            parent_id=parent.id if parent is not None else None,
+            snapshot_at=snapshot_at if chain_id else None,
+            duration=progress.elapsed(),
+            throughput=progress.throughput()
         )
         db.session.add(backup_log)
         db.session.commit()
         
+        if chain_id and parent is None:
+            start_new_chain(snapshot_at)
+        
         return backup_path
     
     except Exception as e:
+        db.session.rollback()
+        if backup_name:
+            remove_partial_backup(backups_dir, backup_name)
         # تسجيل الخطأ
         backup_log = BackupLog(
-            backup_type='manual',
+            backup_type='manual' if user_id else 'automatic',
+            backup_kind=backup_type,
             file_path='',
             file_size=0,
-            status='failed',
+            status='cancelled' if isinstance(e, JobCancelled) else 'failed',
             error_message=str(e),
-            created_by=user_id
+            created_by=user_id,
+            duration=progress.elapsed()
         )
         db.session.add(backup_log)
         db.session.commit()
         
         raise e
 
-def create_full_backup(backups_dir, backup_name, include_files=True, compress=True):
-    """إنشاء نسخة احتياطية كاملة"""
+def remove_partial_backup(backups_dir, backup_name):
+    """حذف ملفات نسخة لم تكتمل (فشلت أو أُلغيت)؛ قطع المستودع الجديدة يحذفها جمع القطع لاحقاً"""
+    for suffix in ('.zip', '.sql', '.sql.zip', '.db.tmp'):
+        path = os.path.join(backups_dir, backup_name + suffix)
+        if os.path.exists(path):
+            os.remove(path)
+    if os.path.isdir(os.path.join(backups_dir, backup_name)):
+        shutil.rmtree(os.path.join(backups_dir, backup_name))
+
+def find_chain_parent():
+    """آخر نسخة في السلسلة الحالية إذا كان يمكن البناء عليها، وإلا None"""
+    if SystemSettings.get_setting('backup_chain_reset', 'false') == 'true':
+        return None
+    
+    last = BackupLog.query.filter(
+        BackupLog.status == 'success', BackupLog.chain_id.isnot(None)
+    ).order_by(BackupLog.id.desc()).first()
+    if last is None or last.snapshot_at is None:
+        return None
+    
+    chain = BackupLog.query.filter_by(chain_id=last.chain_id, status='success').all()
+    if len(chain) >= INCREMENTAL_CHAIN_LENGTH or not all(os.path.exists(item.file_path) for item in chain):
+        return None
+    return last
+
+def start_new_chain(snapshot_at):
+    """بعد نسخة أساسية: سجل الحذف الأقدم منها لم يعد لازماً لأي نسخة تزايدية قادمة"""
+    DeletedRecord.query.filter(DeletedRecord.deleted_at < snapshot_at - INCREMENTAL_OVERLAP).delete(synchronize_session=False)
+    SystemSettings.set_setting('backup_chain_reset', 'false')
+
+def get_backup_chain_status():
+    """ملخص السلسلة الحالية للوحة التحكم: النسخة الأساسية، عدد التزايدية، الحجم والسلامة"""
+    last = BackupLog.query.filter(
+        BackupLog.status == 'success', BackupLog.chain_id.isnot(None)
+    ).order_by(BackupLog.id.desc()).first()
+    if last is None:
+        return None
+    
+    chain = BackupLog.query.filter_by(chain_id=last.chain_id, status='success').order_by(BackupLog.id).all()
+    missing = [item for item in chain if not os.path.exists(item.file_path)]
+    broken_links = [
+        item for previous, item in zip(chain, chain[1:]) if item.parent_id != previous.id
+    ]
+    reset_required = SystemSettings.get_setting('backup_chain_reset', 'false') == 'true'
+    healthy = chain[0].backup_kind != 'incremental' and not missing and not broken_links
+    
+    return {
+        'base': chain[0],
+        'last': chain[-1],
+        'incrementals': len(chain) - 1,
+        'total_size': sum(item.file_size or 0 for item in chain),
+        'missing': len(missing),
+        'broken_links': len(broken_links),
+        'healthy': healthy,
+        'reset_required': reset_required,
+        'next_is_base': not healthy or reset_required or len(chain) >= INCREMENTAL_CHAIN_LENGTH
+    }
+
+def create_full_backup(backups_dir, backup_name, include_files=True, compress=True, progress=None):
+    """إنشاء نسخة احتياطية كاملة
+
+    قاعدة البيانات تُنسخ أولاً كلقطة متسقة إلى ملف مؤقت ثم تُضغط، بدلاً من
+    نسخ الملف الحي مباشرة أثناء الكتابة فيه.
+    """
+    progress = progress or JobProgress()
     if compress:
         backup_path = os.path.join(backups_dir, f'{backup_name}.zip')
+        snapshot_path = os.path.join(backups_dir, f'{backup_name}.db.tmp')
         
-        with zipfile.ZipFile(backup_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            # نسخ قاعدة البيانات
-            db_path = current_app.config.get('SQLALCHEMY_DATABASE_URI', '').replace('sqlite:///', '')
-            if os.path.exists(db_path):
-                zipf.write(db_path, 'database.db')
+        try:
+            progress.set_phase('لقطة قاعدة البيانات')
+            database_included = snapshot_database(snapshot_path, progress=progress)
             
-            # نسخ الملفات المرفقة
+            # الملفات المرفقة
+            instance_files = []
             if include_files:
                 instance_dir = 'instance'
                 if os.path.exists(instance_dir):
                     for root, dirs, files in os.walk(instance_dir):
+                        # النسخ الاحتياطية السابقة لا تُنسخ داخل الجديدة
+                        if root == instance_dir and 'backups' in dirs:
+                            dirs.remove('backups')
                         for file in files:
-                            if not file.endswith('.db'):  # تجنب نسخ قاعدة البيانات مرتين
-                                file_path = os.path.join(root, file)
-                                arcname = os.path.relpath(file_path, '.')
-                                zipf.write(file_path, arcname)
+                            # تجنب نسخ قاعدة البيانات مرتين
+                            if file.endswith(DATABASE_FILE_SUFFIXES):
+                                continue
+                            file_path = os.path.join(root, file)
+                            instance_files.append((file_path, os.path.relpath(file_path, '.').replace(os.sep, '/')))
+            
+            progress.set_phase('ضغط قاعدة البيانات والملفات')
+            progress.set_totals(bytes_total=sum(os.path.getsize(path) for path, _ in instance_files)
+                                + (os.path.getsize(snapshot_path) if database_included else 0))
             
-            # إضافة معلومات النسخة الاحتياطية
-            backup_info = {
-                'created_at': datetime.now().isoformat(),
-                'backup_type': 'full',
-                'include_files': include_files,
-                'database_version': get_database_version()
-            }
-            zipf.writestr('backup_info.json', json.dumps(backup_info, indent=2))
+            with open_backup_archive(backup_path, progress=progress) as zipf:
+                # بصمة SHA-256 لكل ملف، يُتحقق منها أثناء الاستعادة
+                checksums = {}
+                
+                # نسخ قاعدة البيانات
+                if database_included:
+                    checksums['database.db'] = zipf.write(snapshot_path, 'database.db')
+                
+                # نسخ الملفات المرفقة
+                for file_path, arcname in instance_files:
+                    checksums[arcname] = zipf.write(file_path, arcname)
+                
+                # إضافة معلومات النسخة الاحتياطية
+                backup_info = {
+                    'created_at': datetime.now().isoformat(),
+                    'backup_type': 'full',
+                    'include_files': include_files,
+                    'database_included': database_included,
+                    'database_version': get_database_version(),
+                    'checksums': checksums
+                }
+                zipf.writestr('backup_info.json', json.dumps(backup_info, indent=2))
+        finally:
+            if os.path.exists(snapshot_path):
+                os.remove(snapshot_path)
     
     else:
         # نسخ بدون ضغط
         backup_dir = os.path.join(backups_dir, backup_name)
         os.makedirs(backup_dir, exist_ok=True)
         
-        # نسخ قاعدة البيانات
-        db_path = current_app.config.get('SQLALCHEMY_DATABASE_URI', '').replace('sqlite:///', '')
-        if os.path.exists(db_path):
-            shutil.copy2(db_path, os.path.join(backup_dir, 'database.db'))
+        # لقطة قاعدة البيانات
+        snapshot_database(os.path.join(backup_dir, 'database.db'))
         
         # نسخ الملفات المرفقة
         if include_files:
             instance_dir = 'instance'
             if os.path.exists(instance_dir):
-                shutil.copytree(instance_dir, os.path.join(backup_dir, 'instance'), dirs_exist_ok=True)
+                shutil.copytree(
+                    instance_dir, os.path.join(backup_dir, 'instance'), dirs_exist_ok=True,
+                    ignore=shutil.ignore_patterns(*[f'*{suffix}' for suffix in DATABASE_FILE_SUFFIXES], 'backups')
+                )
         
         backup_path = backup_dir
     
     return backup_path
 
-def create_data_backup(backups_dir, backup_name, compress=True):
-    """إنشاء نسخة احتياطية للبيانات فقط"""
-    backup_path = os.path.join(backups_dir, f'{backup_name}.json')
-    
-    # تصدير البيانات إلى JSON
-    data = {
-        'users': export_table_data(User),
-        'products': export_table_data(Product),
-        'invoices': export_table_data(Invoice),
-        'invoice_items': export_table_data(InvoiceItem),
-        'tax_reports': export_table_data(TaxReport),
-        'backup_info': {
+def open_backup_archive(backup_path, compress=True, progress=None):
+    """فتح أرشيف نسخة احتياطية للكتابة بخوارزمية ومستوى الضغط المحددين في الإعدادات
+
+    الضغط يعمل على كل أنوية المعالج (انظر parallel_zip)، والناتج ZIP قياسي.
+    write تعيد بصمة SHA-256 للملف المضاف.
+    """
+    on_bytes = progress.add_bytes if progress is not None else None
+    if not compress:
+        return ParallelZipWriter(backup_path, 'stored', progress=on_bytes)
+    method, level = get_compression_settings()
+    return ParallelZipWriter(backup_path, method, level, progress=on_bytes)
+
+def get_compression_settings():
+    """خوارزمية ومستوى ضغط النسخ الاحتياطية (الافتراضي deflate بمستواه الافتراضي)"""
+    method = SystemSettings.get_setting('backup_compression', 'deflate')
+    if method not in METHODS or method == 'stored':
+        method = 'deflate'
+    level = SystemSettings.get_setting('backup_compression_level', '')
+    if not level.isdigit() or int(level) not in LEVELS[method]:
+        level = METHODS[method][2]
+    return method, int(level)
+
+def create_repository_backup(backups_dir, backup_name, include_files=True, progress=None):
+    """نسخة كاملة في مستودع القطع: قاعدة البيانات والملفات المرفقة دون تكرار
+
+    لقطة القاعدة تُقطع على حدود صفحاتها فلا تُكتب إلا الصفحات التي تغيرت منذ
+    أي نسخة سابقة، والملفات تُقطع حسب المحتوى وتُستخدم قطعها السابقة مباشرة إذا
+    لم يتغير حجمها ووقت تعديلها. يعيد مسار ملف الوصف.
+    متاحة لقاعدة SQLite فقط، فلا تُسجل نسخة ناجحة بدون قاعدة البيانات.
+    """
+    if not get_sqlite_path():
+        raise ValueError('نسخ المستودع متاحة لقاعدة SQLite فقط')
+    progress = progress or JobProgress()
+    repository = BackupRepository(os.path.join(backups_dir, 'repository'))
+    previous = repository.latest_manifest() or {}
+    manifest = new_manifest(backup_name, 'repository')
+    stats = manifest['stats']
+    
+    snapshot_path = os.path.join(backups_dir, f'{backup_name}.db.tmp')
+    try:
+        progress.set_phase('لقطة قاعدة البيانات')
+        if not snapshot_database(snapshot_path, progress=progress):
+            raise ValueError('ملف قاعدة البيانات غير موجود')
+        progress.set_phase('تخزين قطع قاعدة البيانات')
+        progress.set_totals(bytes_total=os.path.getsize(snapshot_path))
+        manifest['database'] = repository.store_database(snapshot_path, stats, progress.add_bytes)
+    finally:
+        if os.path.exists(snapshot_path):
+            os.remove(snapshot_path)
+    
+    if include_files and os.path.exists('instance'):
+        progress.set_phase('تخزين الملفات المرفقة')
+        previous_files = previous.get('files', {})
+        for root, dirs, files in os.walk('instance'):
+            if root == 'instance' and 'backups' in dirs:
+                dirs.remove('backups')
+            for file in files:
+                if file.endswith(DATABASE_FILE_SUFFIXES):
+                    continue
+                file_path = os.path.join(root, file)
+                arcname = os.path.relpath(file_path, '.').replace(os.sep, '/')
+                manifest['files'][arcname] = repository.store_regular_file(
+                    file_path, stats, previous_files.get(arcname), progress.add_bytes
+                )
+    
+    return repository.save_manifest(backup_name, manifest)
+
+def create_data_backup(backups_dir, backup_name, compress=True, progress=None):
+    """إنشاء نسخة احتياطية للبيانات فقط
+
+    كل جدول يُكتب كملف NDJSON (صف JSON في كل سطر) داخل الأرشيف مباشرة أثناء
+    القراءة على دفعات، فلا تُحمَّل الجداول في الذاكرة ولا يُكتب ملف وسيط.
+    """
+    progress = progress or JobProgress()
+    backup_path = os.path.join(backups_dir, f'{backup_name}.zip')
+    
+    progress.set_phase('تصدير الجداول')
+    progress.set_totals(rows_total=sum(
+        db.session.execute(select(func.count()).select_from(model_class.__table__)).scalar()
+        for model_class in DATA_BACKUP_MODELS
+    ))
+    
+    row_counts = {}
+    with open_backup_archive(backup_path, compress, progress) as zipf:
+        for model_class in DATA_BACKUP_MODELS:
+            table = model_class.__table__
+            with zipf.open(f'data/{table.name}.ndjson') as entry:
+                row_counts[table.name] = write_table_ndjson(table, entry, progress=progress.add_rows)
+        
+        backup_info = {
             'created_at': datetime.now().isoformat(),
             'backup_type': 'data_only',
+            'format': 'ndjson',
+            'tables': row_counts,
             'database_version': get_database_version()
         }
-    }
+        zipf.writestr('backup_info.json', json.dumps(backup_info, indent=2))
     
-    with open(backup_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+    return backup_path
+
+def create_incremental_backup(backups_dir, backup_name, parent, snapshot_at, include_files=True, compress=True,
+                              progress=None):
+    """نسخة تزايدية: الصفوف المتغيرة والمحذوفة والملفات المعدلة منذ النسخة السابقة
+
+    الصف المتغير هو الذي وقت تعديله (أو إنشائه) بعد بدء النسخة السابقة بهامش
+    INCREMENTAL_OVERLAP، فحجم النسخة وزمنها يتبعان حجم التغيير وليس حجم البيانات.
+    """
+    progress = progress or JobProgress()
+    since = parent.snapshot_at - INCREMENTAL_OVERLAP
+    since_timestamp = since.replace(tzinfo=timezone.utc).timestamp()
+    backup_path = os.path.join(backups_dir, f'{backup_name}.zip')
     
-    if compress:
-        compressed_path = f'{backup_path}.zip'
-        with zipfile.ZipFile(compressed_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-            zipf.write(backup_path, os.path.basename(backup_path))
-        os.remove(backup_path)
-        backup_path = compressed_path
+    progress.set_phase('تصدير التغييرات')
+    row_counts = {}
+    checksums = {}
+    with open_backup_archive(backup_path, compress, progress) as zipf:
+        for model_class in DATA_BACKUP_MODELS:
+            table = model_class.__table__
+            with zipf.open(f'data/{table.name}.ndjson') as entry:
+                row_counts[table.name] = write_table_ndjson(
+                    table, entry, where=changed_rows_criteria(table, since), progress=progress.add_rows
+                )
+        
+        # الصفوف المحذوفة
+        deleted = db.session.execute(
+            select(DeletedRecord.table_name, DeletedRecord.record_id)
+            .where(DeletedRecord.deleted_at >= since)
+            .order_by(DeletedRecord.id)
+        ).all()
+        zipf.writestr('deleted.ndjson', ''.join(
+            json.dumps({'table': row.table_name, 'id': row.record_id}) + '\n' for row in deleted
+        ))
+        
+        # الملفات المرفقة المعدلة (الملفات المحذوفة تبقى عند الاستعادة)
+        if include_files and os.path.exists('instance'):
+            for root, dirs, files in os.walk('instance'):
+                if root == 'instance' and 'backups' in dirs:
+                    dirs.remove('backups')
+                for file in files:
+                    file_path = os.path.join(root, file)
+                    if file.endswith(DATABASE_FILE_SUFFIXES) or os.path.getmtime(file_path) < since_timestamp:
+                        continue
+                    arcname = os.path.relpath(file_path, '.').replace(os.sep, '/')
+                    checksums[arcname] = zipf.write(file_path, arcname)
+        
+        backup_info = {
+            'created_at': datetime.now().isoformat(),
+            'backup_type': 'incremental',
+            'format': 'ndjson',
+            'chain_id': parent.chain_id,
+            'parent': os.path.basename(parent.file_path),
+            'since': since.isoformat(),
+            'snapshot_at': snapshot_at.isoformat(),
+            'tables': row_counts,
+            'deleted': len(deleted),
+            'checksums': checksums,
+            'database_version': get_database_version()
+        }
+        zipf.writestr('backup_info.json', json.dumps(backup_info, indent=2))
     
     return backup_path
 
-def create_structure_backup(backups_dir, backup_name, compress=True):
+def changed_rows_criteria(table, since):
+    """شرط الصفوف المتغيرة منذ وقت معين؛ الجداول التابعة تتبع تغير أصلها"""
+    if table.name in INCREMENTAL_CHILD_TABLES:
+        column_name, parent_name = INCREMENTAL_CHILD_TABLES[table.name]
+        parent = db.metadata.tables[parent_name]
+        return table.c[column_name].in_(
+            select(parent.c.id).where(changed_rows_criteria(parent, since))
+        )
+    
+    columns = [table.c[name] for name in CHANGE_TIME_COLUMNS if name in table.c]
+    changed_at = func.coalesce(*columns) if len(columns) > 1 else columns[0]
+    return changed_at >= since
+
+def column_json_converter(column):
+    """دالة تحويل قيم العمود إلى JSON حسب نوعه (None للأنواع التي لا تحتاج تحويلاً)
+
+    التحويل يُحدد مرة لكل عمود بدلاً من فحص نوع كل قيمة في كل صف.
+    """
+    column_type = column.type
+    if isinstance(column_type, db.Enum):
+        return lambda value: value.value if isinstance(value, Enum) else value
+    if isinstance(column_type, db.Numeric) and column_type.asdecimal:
+        return str
+    if isinstance(column_type, (db.DateTime, db.Date, db.Time)):
+        return lambda value: value.isoformat()
+    return None
+
+def write_table_ndjson(table, stream, batch_size=DATA_BACKUP_BATCH_SIZE, where=None, progress=None):
+    """كتابة صفوف جدول كأسطر JSON في ملف مفتوح، ويعيد عدد الصفوف
+
+    القراءة بـ yield_per (مؤشر من جهة الخادم في PostgreSQL) فتبقى الذاكرة ثابتة.
+    where: شرط اختياري لكتابة جزء من الصفوف فقط (النسخ التزايدية).
+    progress(اسم الجدول، عدد الصفوف المكتوبة حتى الآن) تُستدعى بعد كل دفعة.
+    """
+    columns = [column.name for column in table.columns]
+    converters = [
+        (index, converter) for index, converter in enumerate(map(column_json_converter, table.columns))
+        if converter is not None
+    ]
+    encode = json.JSONEncoder(ensure_ascii=False).encode
+    
+    query = select(table)
+    if where is not None:
+        query = query.where(where)
+    result = db.session.execute(
+        query.order_by(*table.primary_key.columns).execution_options(yield_per=batch_size)
+    )
+    
+    count = 0
+    for rows in result.partitions():
+        lines = []
+        for row in rows:
+            values = list(row)
+            for index, converter in converters:
+                if values[index] is not None:
+                    values[index] = converter(values[index])
+            lines.append(encode(dict(zip(columns, values))))
+        stream.write(('\n'.join(lines) + '\n').encode('utf-8'))
+        count += len(rows)
+        if progress:
+            progress(table.name, count)
+    return count
+
+def create_structure_backup(backups_dir, backup_name, compress=True, progress=None):
     """إنشاء نسخة احتياطية لهيكل قاعدة البيانات فقط"""
+    progress = progress or JobProgress()
+    progress.set_phase('تصدير هيكل قاعدة البيانات')
     backup_path = os.path.join(backups_dir, f'{backup_name}.sql')
     
-    db_path = current_app.config.get('SQLALCHEMY_DATABASE_URI', '').replace('sqlite:///', '')
+    db_path = get_sqlite_path()
     
     with sqlite3.connect(db_path) as conn:
         with open(backup_path, 'w', encoding='utf-8') as f:
@@ -329,81 +950,371 @@ def create_structure_backup(backups_dir, backup_name, compress=True):
     
     if compress:
         compressed_path = f'{backup_path}.zip'
-        with zipfile.ZipFile(compressed_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
+        with open_backup_archive(compressed_path, progress=progress) as zipf:
             zipf.write(backup_path, os.path.basename(backup_path))
         os.remove(backup_path)
         backup_path = compressed_path
     
     return backup_path
 
-def perform_restore(backup_file, restore_type='full', user_id=None):
-    """تنفيذ عملية الاستعادة"""
+def perform_restore(backup_file, restore_type='full', user_id=None, progress=None):
+    """تنفيذ عملية الاستعادة؛ يعيد False ويطبع الخطأ عند الفشل"""
     try:
-        if backup_file.endswith('.zip'):
-            return restore_from_zip(backup_file, restore_type)
-        elif backup_file.endswith('.json'):
-            return restore_from_json(backup_file, restore_type)
-        elif backup_file.endswith('.sql'):
-            return restore_from_sql(backup_file, restore_type)
-        else:
-            raise ValueError('تنسيق ملف النسخة الاحتياطية غير مدعوم')
+        return restore_backup_file(backup_file, restore_type, progress)
     
     except Exception as e:
         print(f'خطأ في الاستعادة: {str(e)}')
         return False
 
-def restore_from_zip(backup_file, restore_type):
-    """استعادة من ملف ZIP"""
-    import tempfile
+def restore_backup_file(backup_file, restore_type='full', progress=None):
+    """استعادة ملف نسخة حسب صيغته (ترفع الأخطاء)
+
+    بعد أي استعادة لم تعد القاعدة مطابقة لسلسلة النسخ التزايدية، فتكون النسخة
+    التالية نسخة أساسية جديدة.
+    """
+    progress = progress or JobProgress()
+    if backup_file.endswith(MANIFEST_SUFFIX):
+        success = restore_from_repository(backup_file, restore_type, progress)
+    elif backup_file.endswith('.zip'):
+        success = restore_from_zip(backup_file, restore_type, progress)
+    elif backup_file.endswith('.json'):
+        success = restore_from_json(backup_file, restore_type, progress)
+    elif backup_file.endswith('.sql'):
+        success = restore_from_sql(backup_file, restore_type)
+    else:
+        raise ValueError('تنسيق ملف النسخة الاحتياطية غير مدعوم')
     
-    with tempfile.TemporaryDirectory() as temp_dir:
-        with zipfile.ZipFile(backup_file, 'r') as zipf:
-            zipf.extractall(temp_dir)
+    SystemSettings.set_setting('backup_chain_reset', 'true')
+    return success
+
+def restore_from_zip(backup_file, restore_type, progress=None):
+    """استعادة من ملف ZIP
+
+    أعضاء الأرشيف تُقرأ مباشرة إلى وجهاتها دون فك الأرشيف في مجلد مؤقت.
+    """
+    progress = progress or JobProgress()
+    with zipfile.ZipFile(backup_file, 'r') as zipf:
+        names = zipf.namelist()
+        info = read_backup_info(zipf)
+        if info.get('backup_type') == 'incremental':
+            return restore_backup_chain(backup_file, restore_type, progress)
         
-        # قراءة معلومات النسخة الاحتياطية
-        info_file = os.path.join(temp_dir, 'backup_info.json')
-        if os.path.exists(info_file):
-            with open(info_file, 'r', encoding='utf-8') as f:
-                backup_info = json.load(f)
+        if any(name.startswith('data/') and name.endswith('.ndjson') for name in names):
+            progress.set_totals(rows_total=sum(info.get('tables', {}).values()) or None)
+            return restore_from_ndjson_zip(zipf, restore_type, progress)
+        
+        # نسخ البيانات القديمة: ملف JSON واحد مضغوط
+        legacy_json = [name for name in names if name.endswith('.json') and name != 'backup_info.json']
+        if legacy_json and 'database.db' not in names:
+            with zipf.open(legacy_json[0]) as f:
+                return restore_json_data(json.load(f), restore_type, progress)
         
         if restore_type == 'full':
-            # استعادة قاعدة البيانات
-            db_file = os.path.join(temp_dir, 'database.db')
-            if os.path.exists(db_file):
-                db_path = current_app.config.get('SQLALCHEMY_DATABASE_URI', '').replace('sqlite:///', '')
-                shutil.copy2(db_file, db_path)
-            
-            # استعادة الملفات
-            instance_backup = os.path.join(temp_dir, 'instance')
-            if os.path.exists(instance_backup):
-                if os.path.exists('instance'):
-                    shutil.rmtree('instance')
-                shutil.copytree(instance_backup, 'instance')
+            restore_full_zip(zipf, progress)
         
         return True
 
-def restore_from_json(backup_file, restore_type):
-    """استعادة من ملف JSON"""
+def restore_full_zip(zipf, progress=None):
+    """استعادة نسخة كاملة: قاعدة البيانات والملفات المرفقة
+
+    قاعدة البيانات تُكتب أولاً في ملف جانبي بجوار الأصلية ويُتحقق من بصمتها،
+    ثم تُستعاد الملفات، وأخيراً يُنسخ الملف الجانبي إلى القاعدة الحية في معاملة
+    واحدة (swap_database_file) فلا تُرى قاعدة نصف مكتوبة. إذا فشل التحقق لا
+    تتغير القاعدة الحالية.
+    """
+    progress = progress or JobProgress()
+    names = set(zipf.namelist())
+    checksums = read_backup_info(zipf).get('checksums', {})
+    progress.set_totals(bytes_total=sum(
+        info.file_size for info in zipf.infolist()
+        if info.filename == 'database.db' or info.filename.startswith('instance/')
+    ))
+    
+    db_side_file = None
+    if 'database.db' in names:
+        db_path = get_sqlite_path()
+        if not db_path:
+            raise RestoreError('استعادة ملف قاعدة البيانات متاحة لقاعدة SQLite فقط')
+        db_side_file = db_path + RESTORE_SIDE_SUFFIX
+    
+    try:
+        if db_side_file:
+            progress.set_phase('استخراج قاعدة البيانات')
+            extract_member(zipf, 'database.db', db_side_file, checksums.get('database.db'), progress.add_bytes)
+        
+        # من هنا تتغير الملفات الحالية فلا يمكن الإلغاء
+        progress.set_phase('استعادة الملفات وقاعدة البيانات', cancellable=False)
+        restore_instance_files(zipf, checksums, progress)
+        
+        if db_side_file:
+            swap_database_file(db_side_file, db_path)
+            db_side_file = None
+    finally:
+        if db_side_file and os.path.exists(db_side_file):
+            os.remove(db_side_file)
+    
+    if 'database.db' in names:
+        # النسخ الأقدم قد تنقصها أعمدة أو بيانات مشتقة أُضيفت لاحقاً
+        upgrade_database()
+        invalidate_summaries('dashboard')
+        invalidate_summaries('invoices_list')
+        broadcaster.publish('stats_reset', {})
+
+def restore_from_repository(manifest_path, restore_type, progress=None):
+    """استعادة نسخة من مستودع القطع بإعادة تجميع ملفاتها من ملف الوصف
+
+    مثل restore_full_zip: القاعدة تُجمع في ملف جانبي وتُستبدل في النهاية،
+    و"البيانات فقط" تستعيد القاعدة دون الملفات المرفقة.
+    """
+    if restore_type == 'merge':
+        raise RestoreError('نسخ المستودع تُستعاد كاملة ولا تدعم الدمج')
+    
+    progress = progress or JobProgress()
+    repository = BackupRepository(os.path.dirname(os.path.dirname(manifest_path)))
+    manifest = read_manifest(manifest_path)
+    files = manifest.get('files', {}) if restore_type == 'full' else {}
+    progress.set_totals(bytes_total=(manifest['database'] or {}).get('size', 0)
+                        + sum(entry['size'] for entry in files.values()))
+    
+    db_side_file = None
+    if manifest.get('database'):
+        db_path = get_sqlite_path()
+        if not db_path:
+            raise RestoreError('استعادة ملف قاعدة البيانات متاحة لقاعدة SQLite فقط')
+        db_side_file = db_path + RESTORE_SIDE_SUFFIX
+    
+    try:
+        if db_side_file:
+            progress.set_phase('تجميع قاعدة البيانات من القطع')
+            repository.restore_file(manifest['database'], db_side_file, progress.add_bytes)
+        
+        progress.set_phase('استعادة الملفات وقاعدة البيانات', cancellable=False)
+        for name, entry in sorted(files.items()):
+            destination = os.path.normpath(name)
+            if not destination.startswith('instance' + os.sep):
+                raise RestoreError(f'مسار غير صالح في النسخة الاحتياطية: {name}')
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            repository.restore_file(entry, destination + RESTORE_SIDE_SUFFIX, progress.add_bytes)
+            os.replace(destination + RESTORE_SIDE_SUFFIX, destination)
+        
+        if db_side_file:
+            swap_database_file(db_side_file, db_path)
+            db_side_file = None
+    finally:
+        if db_side_file and os.path.exists(db_side_file):
+            os.remove(db_side_file)
+    
+    if manifest.get('database'):
+        upgrade_database()
+        invalidate_summaries('dashboard')
+        invalidate_summaries('invoices_list')
+        broadcaster.publish('stats_reset', {})
+    return True
+
+def read_backup_info(zipf):
+    """معلومات النسخة من backup_info.json داخل الأرشيف (قاموس فارغ للنسخ القديمة)"""
+    if 'backup_info.json' not in zipf.namelist():
+        return {}
+    with zipf.open('backup_info.json') as f:
+        return json.load(f)
+
+def restore_instance_files(zipf, checksums, progress=None):
+    """استعادة الملفات المرفقة: كل ملف يُكتب بجوار وجهته ثم يستبدلها
+
+    مجلد النسخ الاحتياطية وملفات القاعدة لا تُستبدل، والملفات غير الموجودة في النسخة تبقى.
+    """
+    for name in sorted(zipf.namelist()):
+        if not name.startswith('instance/') or name.endswith('/'):
+            continue
+        if name.startswith('instance/backups/') or name.endswith(DATABASE_FILE_SUFFIXES):
+            continue
+        destination = os.path.normpath(name)
+        if not destination.startswith('instance' + os.sep):
+            raise RestoreError(f'مسار غير صالح في النسخة الاحتياطية: {name}')
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        extract_member(zipf, name, destination + RESTORE_SIDE_SUFFIX, checksums.get(name),
+                       progress.add_bytes if progress is not None else None)
+        os.replace(destination + RESTORE_SIDE_SUFFIX, destination)
+
+def resolve_backup_chain(backup_file):
+    """ملفات السلسلة من النسخة الأساسية حتى النسخة المطلوبة، مع التحقق من ترابطها
+
+    السلسلة تُقرأ من backup_info.json في الملفات نفسها (وليس من سجل النسخ في
+    القاعدة) لأن استعادة النسخة الأساسية تستبدل هذا السجل.
+    """
+    chain = []
+    current = backup_file
+    while True:
+        if not os.path.exists(current):
+            raise RestoreError(f'ملف في سلسلة النسخ غير موجود: {os.path.basename(current)}')
+        with zipfile.ZipFile(current, 'r') as zipf:
+            info = read_backup_info(zipf)
+        if chain and info.get('chain_id') not in (None, chain[0][1].get('chain_id')):
+            raise RestoreError(f'الملف {os.path.basename(current)} من سلسلة نسخ أخرى')
+        chain.insert(0, (current, info))
+        if info.get('backup_type') != 'incremental':
+            return chain
+        if len(chain) > INCREMENTAL_CHAIN_LENGTH * 4:
+            raise RestoreError('سلسلة النسخ التزايدية طويلة بشكل غير متوقع')
+        current = os.path.join(os.path.dirname(backup_file), info['parent'])
+
+def restore_backup_chain(backup_file, restore_type, progress=None):
+    """استعادة نسخة تزايدية: النسخة الأساسية ثم كل نسخة تزايدية بالترتيب
+
+    الإلغاء ممكن أثناء استعادة النسخة الأساسية فقط، فلا تبقى القاعدة على نسخة
+    أساسية طُبق عليها جزء من السلسلة.
+    """
+    if restore_type == 'merge':
+        raise RestoreError('النسخة التزايدية تُستعاد مع سلسلتها كاملة ولا تدعم الدمج')
+    
+    progress = progress or JobProgress()
+    chain = resolve_backup_chain(backup_file)
+    base_file = chain[0][0]
+    restore_from_zip(base_file, 'full', progress)
+    
+    for incremental_file, info in chain[1:]:
+        progress.set_phase(f'تطبيق {os.path.basename(incremental_file)}', cancellable=False)
+        with zipfile.ZipFile(incremental_file, 'r') as zipf:
+            counts = apply_incremental_zip(zipf, info, progress)
+        print(f'تم تطبيق النسخة التزايدية {os.path.basename(incremental_file)}: {counts}')
+    
+    upgrade_database()
+    invalidate_summaries('dashboard')
+    invalidate_summaries('invoices_list')
+    broadcaster.publish('stats_reset', {})
+    return True
+
+def apply_incremental_zip(zipf, info, progress=None):
+    """تطبيق نسخة تزايدية واحدة: الحذف ثم الصفوف المتغيرة ثم الملفات المعدلة"""
+    def member_rows(member):
+        with zipf.open(member) as entry:
+            yield from read_ndjson(entry)
+    
+    names = set(zipf.namelist())
+    sources = {
+        model_class.__tablename__: member_rows(f'data/{model_class.__tablename__}.ndjson')
+        for model_class in DATA_BACKUP_MODELS
+        if f'data/{model_class.__tablename__}.ndjson' in names
+    }
+    
+    deletions = defaultdict(list)
+    if 'deleted.ndjson' in names:
+        with zipf.open('deleted.ndjson') as entry:
+            for row in read_ndjson(entry):
+                deletions[row['table']].append(row['id'])
+    
+    counts = apply_table_changes(sources, deletions, INCREMENTAL_CHILD_TABLES,
+                                 progress=progress.add_rows if progress is not None else None)
+    restore_instance_files(zipf, info.get('checksums', {}), progress)
+    return counts
+
+def extract_member(zipf, name, target_path, expected_sha256=None, progress=None):
+    """كتابة عضو من الأرشيف إلى ملف على قطع مع التحقق من سلامته أثناء القراءة
+
+    zipfile يتحقق من CRC-32 عند نهاية العضو، وتُقارن بصمة SHA-256 إذا كانت
+    مسجلة في backup_info.json (النسخ الأحدث). progress(عدد البايتات) بعد كل قطعة.
+    """
+    digest = hashlib.sha256()
+    try:
+        with zipf.open(name) as source, open(target_path, 'wb') as target:
+            for chunk in iter(lambda: source.read(STREAM_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                target.write(chunk)
+                if progress:
+                    progress(len(chunk))
+            target.flush()
+            os.fsync(target.fileno())
+    except zipfile.BadZipFile as e:
+        os.remove(target_path)
+        raise RestoreError(f'الملف {name} تالف في النسخة الاحتياطية: {e}') from e
+    except BaseException:
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        raise
+    
+    if expected_sha256 and digest.hexdigest() != expected_sha256:
+        os.remove(target_path)
+        raise RestoreError(f'بصمة الملف {name} لا تطابق المسجلة في النسخة الاحتياطية')
+
+def swap_database_file(side_file, db_path):
+    """إحلال محتوى ملف القاعدة المستعاد محل القاعدة الحية
+
+    النسخ بـ SQLite Online Backup API إلى الملف الحي نفسه في خطوة واحدة (معاملة
+    كتابة واحدة)، فلا يُحذف الملف: اتصالات كل العمليات المفتوحة تبقى على نفس
+    الملف وترى القاعدة المستعادة كاملة بعد الالتزام، ولا تكتب أي منها في ملف
+    محذوف. الكتابة من العمليات الأخرى تنتظر (أو تفشل بانتهاء المهلة) أثناء النسخ.
+    """
+    db.session.remove()
+    db.engine.dispose()
+    
+    source = sqlite3.connect(side_file)
+    target = sqlite3.connect(db_path, timeout=60)
+    try:
+        # في وضع WAL لا يمكن للنسخ تغيير حجم صفحة القاعدة الحية، فيُوحَّد في الملف المستعاد
+        page_size = target.execute('PRAGMA page_size').fetchone()[0]
+        if source.execute('PRAGMA page_size').fetchone()[0] != page_size:
+            source.execute('PRAGMA journal_mode=DELETE')
+            source.execute(f'PRAGMA page_size={int(page_size)}')
+            source.execute('VACUUM')
+        source.backup(target, pages=-1)
+    finally:
+        target.close()
+        source.close()
+    os.remove(side_file)
+
+def restore_from_json(backup_file, restore_type, progress=None):
+    """استعادة من ملف JSON (صيغة نسخ البيانات القديمة)"""
     with open(backup_file, 'r', encoding='utf-8') as f:
         data = json.load(f)
     
-    if restore_type == 'full':
-        # حذف البيانات الحالية
-        db.drop_all()
-        db.create_all()
+    return restore_json_data(data, restore_type, progress)
+
+def restore_json_data(data, restore_type, progress=None):
+    """استعادة نسخة بيانات بالصيغة القديمة (قاموس من اسم الجدول إلى قائمة صفوفه)"""
+    sources = {
+        model_class.__tablename__: data[model_class.__tablename__]
+        for model_class in DATA_BACKUP_MODELS if model_class.__tablename__ in data
+    }
+    return restore_data(sources, restore_type, progress)
+
+def restore_from_ndjson_zip(zipf, restore_type, progress=None):
+    """استعادة نسخة البيانات (ملف NDJSON لكل جدول) بقراءة الأسطر من الأرشيف مباشرة"""
+    def member_rows(member):
+        with zipf.open(member) as entry:
+            yield from read_ndjson(entry)
+    
+    names = set(zipf.namelist())
+    sources = {
+        model_class.__tablename__: member_rows(f'data/{model_class.__tablename__}.ndjson')
+        for model_class in DATA_BACKUP_MODELS
+        if f'data/{model_class.__tablename__}.ndjson' in names
+    }
+    return restore_data(sources, restore_type, progress)
+
+def restore_data(sources, restore_type, progress=None):
+    """استعادة الجداول بمحرك الاستعادة المجمّعة ثم تحديث البيانات المشتقة
+
+    الدمج يضيف الصفوف غير الموجودة فقط، وباقي الأنواع تستبدل صفوف الجداول المستعادة.
+    الاستعادة معاملة واحدة، فإلغاؤها قبل الالتزام لا يغير القاعدة.
+    """
+    progress = progress or JobProgress()
+    progress.set_phase('استعادة الجداول')
+    counts = restore_tables(sources, replace=restore_type != 'merge', progress=progress.add_rows)
+    progress.set_phase('تحديث البيانات المشتقة', cancellable=False)
+    
+    # إكمال الأعمدة المشتقة للنسخ القديمة وإعادة بناء فهرس البحث
+    upgrade_database()
     
-    # استعادة البيانات
-    restore_table_data(User, data.get('users', []))
-    restore_table_data(Product, data.get('products', []))
-    restore_table_data(Invoice, data.get('invoices', []))
-    restore_table_data(InvoiceItem, data.get('invoice_items', []))
-    restore_table_data(TaxReport, data.get('tax_reports', []))
+    invalidate_summaries('dashboard')
+    invalidate_summaries('invoices_list')
+    broadcaster.publish('stats_reset', {})
     
+    print(f'تمت استعادة البيانات: {counts}')
     return True
 
 def restore_from_sql(backup_file, restore_type):
     """استعادة من ملف SQL"""
-    db_path = current_app.config.get('SQLALCHEMY_DATABASE_URI', '').replace('sqlite:///', '')
+    db_path = get_sqlite_path()
     
     with sqlite3.connect(db_path) as conn:
         with open(backup_file, 'r', encoding='utf-8') as f:
@@ -418,40 +1329,6 @@ def restore_from_sql(backup_file, restore_type):
     
     return True
 
-def export_table_data(model_class):
-    """تصدير بيانات جدول إلى قاموس"""
-    items = model_class.query.all()
-    data = []
-    
-    for item in items:
-        item_dict = {}
-        for column in model_class.__table__.columns:
-            value = getattr(item, column.name)
-            if isinstance(value, datetime):
-                value = value.isoformat()
-            elif hasattr(value, 'value'):  # Enum values
-                value = value.value
-            item_dict[column.name] = value
-        data.append(item_dict)
-    
-    return data
-
-def restore_table_data(model_class, data):
-    """استعادة بيانات جدول من قاموس"""
-    for item_data in data:
-        # تحويل التواريخ
-        for key, value in item_data.items():
-            if isinstance(value, str) and 'T' in value:
-                try:
-                    item_data[key] = datetime.fromisoformat(value.replace('Z', '+00:00'))
-                except:
-                    pass
-        
-        item = model_class(**item_data)
-        db.session.add(item)
-    
-    db.session.commit()
-
 def get_database_version():
     """الحصول على إصدار قاعدة البيانات"""
     try:
@@ -460,49 +1337,43 @@ def get_database_version():
     except:
         return "unknown"
 
-def schedule_automatic_backups():
-    """جدولة النسخ الاحتياطي التلقائي"""
-    schedule.clear()  # مسح الجدولة السابقة
-    
-    auto_backup_enabled = SystemSettings.get_setting('auto_backup_enabled', 'false') == 'true'
-    if not auto_backup_enabled:
-        return
+def automatic_backup_schedule():
+    """جدولة النسخ التلقائي حسب الإعدادات (None إذا كان معطلاً)
+
+    الإعدادات تُقرأ في كل دورة للمجدول، فتغييرها يعيد حساب الموعد التالي دون إعادة تشغيل.
+    """
+    if SystemSettings.get_setting('auto_backup_enabled', 'false') != 'true':
+        return None
     
     backup_frequency = SystemSettings.get_setting('backup_frequency', 'weekly')
-    
     if backup_frequency == 'daily':
-        schedule.every().day.at("02:00").do(automatic_backup_job)
-    elif backup_frequency == 'weekly':
-        schedule.every().sunday.at("02:00").do(automatic_backup_job)
-    elif backup_frequency == 'monthly':
-        schedule.every().month.do(automatic_backup_job)
-
-def automatic_backup_job():
-    """مهمة النسخ الاحتياطي التلقائي"""
-    try:
-        with current_app.app_context():
-            perform_backup(
-                backup_type='full',
-                include_files=True,
-                compress=True,
-                user_id=None  # نسخة تلقائية
-            )
-    except Exception as e:
-        print(f'خطأ في النسخ الاحتياطي التلقائي: {str(e)}')
+        return daily_at(2)
+    if backup_frequency == 'monthly':
+        return monthly_at(1, 2)
+    return weekly_at(6, 2)  # الأحد
 
-def start_backup_scheduler():
-    """بدء مجدول النسخ الاحتياطي"""
-    def run_scheduler():
-        while True:
-            schedule.run_pending()
-            time.sleep(60)  # فحص كل دقيقة
+def automatic_backup_job(app):
+    """مهمة النسخ الاحتياطي التلقائي (يشغلها المجدول داخل سياق التطبيق)
+
+    تعمل كمهمة بنفس قفل التشغيل الوحيد فيظهر تقدمها في لوحة النسخ، وإذا كانت
+    هناك عملية نسخ أو استعادة جارية يعيد المجدول المحاولة لاحقاً.
+    """
+    params = {
+        'backup_type': SystemSettings.get_setting('auto_backup_type', 'incremental'),
+        'include_files': True,
+        'compress': True
+    }
+    job = BackupJob('backup', params)
+    try:
+        job.acquire()
+    except JobBusy as e:
+        raise RetryLater(str(e)) from e
     
-    scheduler_thread = threading.Thread(target=run_scheduler, daemon=True)
-    scheduler_thread.start()
+    # user_id=None: نسخة تلقائية
+    state = run_job(app, job, backup_job_target(params))
+    if state['status'] != 'completed':
+        raise RuntimeError(state['error'] or 'فشل النسخ الاحتياطي التلقائي')
 
-# تهيئة الجدولة عند تحميل الوحدة
 def init_backup_system(app):
-    """تهيئة نظام النسخ الاحتياطي"""
-    with app.app_context():
-        schedule_automatic_backups()
-        start_backup_scheduler()
+    """تسجيل مهمة النسخ التلقائي في المجدول"""
+    register_job('automatic_backup', automatic_backup_job, automatic_backup_schedule)
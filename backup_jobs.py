@@ -0,0 +1,303 @@
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime
+from models import db
+
+try:
+    import fcntl
+    FCNTL_AVAILABLE = True
+except ImportError:
+    FCNTL_AVAILABLE = False
+
+# ملفات حالة المهام والقفل، داخل مجلد النسخ حتى لا تُنسخ أو تُستعاد مع الملفات المرفقة
+JOBS_DIR = os.path.join('instance', 'backups', 'jobs')
+LOCK_FILE = '.lock'
+
+# أقل مدة بين كتابتين لملف حالة المهمة وبين فحصين لطلب الإلغاء (بالثواني)
+PROGRESS_SAVE_INTERVAL = 0.5
+
+# عدد ملفات المهام المنتهية التي تُحفظ لعرض آخر النتائج
+FINISHED_JOBS_KEPT = 20
+
+# قفل داخل العملية عندما لا يتوفر fcntl (ويندوز)؛ لا يمنع التشغيل من عمليات أخرى
+_process_lock = threading.Lock()
+
+
+class JobCancelled(Exception):
+    """ألغى المستخدم المهمة"""
+
+
+class JobBusy(Exception):
+    """توجد عملية نسخ أو استعادة جارية"""
+
+
+class JobProgress:
+    """عدادات التقدم لعملية نسخ أو استعادة
+
+    add_bytes و add_rows تُمرر كدوال تقدم لطبقات الضغط والاستعادة. العمليات
+    التي تعمل بدون مهمة خلفية (النسخ التلقائي مثلاً) تستخدمها لقياس المدة والسرعة.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.bytes_done = 0
+        self.bytes_total = None
+        self.rows_done = 0
+        self.rows_total = None
+        self.table_rows = {}
+        self.phase = None
+        self.cancellable = True
+
+    def add_bytes(self, count):
+        self.bytes_done += count
+        self.changed()
+
+    def add_rows(self, table, count):
+        """عدد الصفوف المكتملة حتى الآن في جدول (تراكمي، مثل progress في restore_tables)"""
+        self.rows_done += count - self.table_rows.get(table, 0)
+        self.table_rows[table] = count
+        self.changed()
+
+    def set_totals(self, bytes_total=None, rows_total=None):
+        if bytes_total is not None:
+            self.bytes_total = bytes_total
+        if rows_total is not None:
+            self.rows_total = rows_total
+        self.changed(force=True)
+
+    def set_phase(self, phase, cancellable=True):
+        """المرحلة الحالية؛ cancellable=False بعد نقطة لا يمكن التراجع عنها (استبدال القاعدة)"""
+        self.phase = phase
+        self.cancellable = cancellable
+        self.changed(force=True)
+
+    def elapsed(self):
+        return time.monotonic() - self.started
+
+    def throughput(self):
+        """متوسط السرعة بالبايت في الثانية"""
+        elapsed = self.elapsed()
+        return self.bytes_done / elapsed if elapsed > 0 else None
+
+    def changed(self, force=False):
+        pass
+
+
+class BackupJob(JobProgress):
+    """مهمة نسخ أو استعادة في الخلفية
+
+    الحالة تُكتب في ملف JSON داخل JOBS_DIR فيقرؤها أي عامل (worker)، والإلغاء
+    ملف علامة يُنشئه أي عامل وتفحصه المهمة أثناء التقدم.
+    """
+
+    def __init__(self, operation, params, user_id=None):
+        super().__init__()
+        self.id = uuid.uuid4().hex
+        self.state = {
+            'id': self.id,
+            'operation': operation,  # backup, restore
+            'params': params,
+            'status': 'pending',
+            'phase': None,
+            'cancellable': True,
+            'bytes_done': 0,
+            'bytes_total': None,
+            'rows_done': 0,
+            'rows_total': None,
+            'throughput': None,
+            'result': None,
+            'error': None,
+            'created_by': user_id,
+            'started_at': datetime.utcnow().isoformat(),
+            'finished_at': None,
+            'elapsed': 0
+        }
+        self.last_saved = 0
+        self.lock_file = None
+
+    def changed(self, force=False):
+        now = time.monotonic()
+        if not force and now - self.last_saved < PROGRESS_SAVE_INTERVAL:
+            return
+        self.last_saved = now
+        self.check_cancelled()
+        self.save()
+
+    def check_cancelled(self):
+        if self.cancellable and os.path.exists(cancel_marker_path(self.id)):
+            raise JobCancelled('تم إلغاء العملية')
+
+    def save(self):
+        self.state.update({
+            'phase': self.phase,
+            'cancellable': self.cancellable,
+            'bytes_done': self.bytes_done,
+            'bytes_total': self.bytes_total,
+            'rows_done': self.rows_done,
+            'rows_total': self.rows_total,
+            'throughput': self.throughput(),
+            'elapsed': round(self.elapsed(), 1)
+        })
+        write_job_state(self.state)
+
+    def finish(self, status, result=None, error=None):
+        self.state.update({
+            'status': status,
+            'result': result,
+            'error': error,
+            'finished_at': datetime.utcnow().isoformat()
+        })
+        self.save()
+
+    def acquire(self):
+        """حجز قفل التشغيل الوحيد؛ يرفع JobBusy إذا كانت هناك مهمة جارية"""
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        if not FCNTL_AVAILABLE:
+            if not _process_lock.acquire(blocking=False):
+                raise JobBusy('توجد عملية نسخ أو استعادة جارية')
+            return
+        lock_file = open(os.path.join(JOBS_DIR, LOCK_FILE), 'a+')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            raise JobBusy('توجد عملية نسخ أو استعادة جارية')
+        lock_file.seek(0)
+        lock_file.truncate()
+        lock_file.write(self.id)
+        lock_file.flush()
+        self.lock_file = lock_file
+
+    def release(self):
+        if os.path.exists(cancel_marker_path(self.id)):
+            os.remove(cancel_marker_path(self.id))
+        if not FCNTL_AVAILABLE:
+            _process_lock.release()
+            return
+        if self.lock_file is not None:
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+
+
+def job_state_path(job_id):
+    return os.path.join(JOBS_DIR, f'{job_id}.json')
+
+
+def cancel_marker_path(job_id):
+    return os.path.join(JOBS_DIR, f'{job_id}.cancel')
+
+
+def write_job_state(state):
+    path = job_state_path(state['id'])
+    temp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+def is_lock_held():
+    """هل يوجد عامل يحمل قفل التشغيل الآن"""
+    if not FCNTL_AVAILABLE:
+        return _process_lock.locked()
+    path = os.path.join(JOBS_DIR, LOCK_FILE)
+    if not os.path.exists(path):
+        return False
+    with open(path, 'a+') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return True
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+        return False
+
+
+def read_job(job_id):
+    """حالة مهمة من ملفها، أو None
+
+    المهمة المسجلة كجارية بينما القفل غير محجوز توقف عاملها (إعادة تشغيل الخادم
+    مثلاً) فتُسجل كمنقطعة.
+    """
+    try:
+        with open(job_state_path(job_id), 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state['status'] in ('pending', 'running') and not is_lock_held():
+        state.update({'status': 'failed', 'error': 'انقطعت العملية قبل اكتمالها', 'finished_at': datetime.utcnow().isoformat()})
+        write_job_state(state)
+    return state
+
+
+def list_jobs():
+    """معرفات المهام من الأحدث للأقدم"""
+    if not os.path.exists(JOBS_DIR):
+        return []
+    paths = [
+        os.path.join(JOBS_DIR, filename)
+        for filename in os.listdir(JOBS_DIR) if filename.endswith('.json')
+    ]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    return [os.path.basename(path)[:-len('.json')] for path in paths]
+
+
+def current_job():
+    """المهمة الجارية إن وجدت، وإلا آخر مهمة منتهية"""
+    for index, job_id in enumerate(list_jobs()):
+        state = read_job(job_id)
+        if state and (state['status'] in ('pending', 'running') or index == 0):
+            return state
+    return None
+
+
+def request_cancel(job_id):
+    """طلب إلغاء مهمة جارية؛ يعيد False إذا كانت منتهية أو غير موجودة"""
+    state = read_job(job_id)
+    if not state or state['status'] not in ('pending', 'running'):
+        return False
+    open(cancel_marker_path(job_id), 'w').close()
+    return True
+
+
+def prune_finished_jobs(keep=FINISHED_JOBS_KEPT):
+    for job_id in list_jobs()[keep:]:
+        state = read_job(job_id)
+        if state and state['status'] not in ('pending', 'running'):
+            os.remove(job_state_path(job_id))
+
+
+def run_job(app, job, target):
+    """تنفيذ target(job) داخل سياق التطبيق مع تسجيل النتيجة، ثم تحرير القفل"""
+    with app.app_context():
+        job.state['status'] = 'running'
+        job.save()
+        try:
+            result = target(job)
+            job.finish('completed', result=result)
+        except JobCancelled as e:
+            job.finish('cancelled', error=str(e))
+        except Exception as e:
+            job.finish('failed', error=str(e))
+            print(f'خطأ في مهمة {job.state["operation"]}: {str(e)}')
+        finally:
+            db.session.remove()
+            job.release()
+            prune_finished_jobs()
+    return job.state
+
+
+def start_job(app, operation, params, target, user_id=None):
+    """بدء مهمة خلفية بعد حجز قفل التشغيل الوحيد (يرفع JobBusy إن لم يتوفر)"""
+    job = BackupJob(operation, params, user_id)
+    job.acquire()
+    try:
+        job.save()
+        thread = threading.Thread(target=run_job, args=(app, job, target), daemon=True)
+        thread.start()
+    except BaseException:
+        job.release()
+        raise
+    return job.state
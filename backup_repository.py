@@ -0,0 +1,293 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import zlib
+from datetime import datetime
+
+# حدود أحجام القطع في التقطيع حسب المحتوى (بالبايت)
+CDC_MIN_SIZE = 16 * 1024
+CDC_AVG_SIZE = 64 * 1024
+CDC_MAX_SIZE = 256 * 1024
+
+# عدد البايتات الأخيرة التي تحدد قيمة البصمة المتدحرجة (عرض نافذة Gear hash)
+CDC_WINDOW = 64
+
+# حجم القطعة في ملف قاعدة SQLite (مجموعة صفحات كاملة)
+SQLITE_CHUNK_SIZE = 16 * 1024
+
+# مستوى ضغط zlib لكل قطعة
+CHUNK_COMPRESSION_LEVEL = 6
+
+# القطع غير المستخدمة الأحدث من هذه المدة لا تُحذف (قد تكون لنسخة جارية)
+GARBAGE_GRACE_SECONDS = 3600
+
+# لاحقة ملفات الوصف (manifest) داخل المستودع
+MANIFEST_SUFFIX = '.manifest.json'
+
+READ_SIZE = 4 * 1024 * 1024
+MASK_64 = (1 << 64) - 1
+
+# جدول Gear: قيمة عشوائية ثابتة لكل بايت
+GEAR = [int.from_bytes(hashlib.sha256(bytes([value])).digest()[:8], 'big') for value in range(256)]
+
+
+class RepositoryError(Exception):
+    """قطعة مفقودة أو تالفة في مستودع النسخ"""
+
+
+def find_chunk_end(data, start, end, min_size=CDC_MIN_SIZE, avg_size=CDC_AVG_SIZE, max_size=CDC_MAX_SIZE):
+    """نهاية القطعة التي تبدأ عند start حسب المحتوى (Gear hash متدحرج)
+
+    الحد يقع حيث تكون البتات العليا من البصمة أصفاراً، والبصمة تعتمد على آخر
+    CDC_WINDOW بايت فقط؛ فإدراج بيانات في وسط الملف لا يغير إلا القطع حوله.
+    أول min_size بايت من كل قطعة لا تُفحص (إلا آخر نافذة منها) لتسريع التقطيع.
+    """
+    limit = min(end, start + max_size)
+    if limit - start <= min_size:
+        return limit
+
+    bits = (avg_size - min_size).bit_length() - 1
+    threshold = 1 << (64 - bits)
+    gear = GEAR
+    h = 0
+    position = start + min_size - CDC_WINDOW
+    for byte in data[position:start + min_size]:
+        h = ((h << 1) + gear[byte]) & MASK_64
+    position = start + min_size
+    for byte in data[position:limit]:
+        h = ((h << 1) + gear[byte]) & MASK_64
+        position += 1
+        if h < threshold:
+            return position
+    return limit
+
+
+def content_defined_chunks(stream, **sizes):
+    """تقطيع ملف مفتوح إلى قطع متغيرة الحجم حسب المحتوى"""
+    max_size = sizes.get('max_size', CDC_MAX_SIZE)
+    data = b''
+    start = 0
+    eof = False
+    while True:
+        if not eof and len(data) - start < max_size:
+            block = stream.read(READ_SIZE)
+            eof = not block
+            data = data[start:] + block
+            start = 0
+        if start >= len(data):
+            return
+        end = find_chunk_end(data, start, len(data), **sizes)
+        yield data[start:end]
+        start = end
+
+
+def fixed_chunks(stream, size):
+    """تقطيع بحجم ثابت (لملفات SQLite المكونة من صفحات ثابتة الحجم)"""
+    for chunk in iter(lambda: stream.read(size), b''):
+        yield chunk
+
+
+def sqlite_chunk_size(path):
+    """حجم قطعة من مضاعفات حجم صفحة قاعدة SQLite، فالصفحة المتغيرة تغير قطعة واحدة"""
+    with open(path, 'rb') as f:
+        header = f.read(100)
+    if len(header) < 18 or not header.startswith(b'SQLite format 3\x00'):
+        return None
+    page_size = int.from_bytes(header[16:18], 'big')
+    page_size = 65536 if page_size == 1 else page_size
+    return max(page_size, SQLITE_CHUNK_SIZE // page_size * page_size)
+
+
+class BackupRepository:
+    """مستودع نسخ احتياطية بقطع مخزنة مرة واحدة
+
+    كل قطعة تُخزن مضغوطة في chunks/<أول حرفين>/<SHA-256 للمحتوى>، وكل نسخة
+    هي ملف وصف في manifests يذكر قطع كل ملف بالترتيب. النسخة الجديدة تكتب
+    القطع غير الموجودة فقط، والاستعادة تعيد تجميع الملفات من ملف الوصف.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.chunks_dir = os.path.join(root, 'chunks')
+        self.manifests_dir = os.path.join(root, 'manifests')
+
+    def chunk_path(self, digest):
+        return os.path.join(self.chunks_dir, digest[:2], digest)
+
+    def manifest_path(self, name):
+        return os.path.join(self.manifests_dir, name + MANIFEST_SUFFIX)
+
+    def put_chunk(self, data):
+        """تخزين قطعة إذا لم تكن موجودة؛ يعيد (البصمة، عدد البايتات المكتوبة)"""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.chunk_path(digest)
+        if os.path.exists(path):
+            # تحديث الوقت يحمي القطعة من جمع القطع غير المستخدمة أثناء هذه النسخة
+            try:
+                os.utime(path)
+                return digest, 0
+            except FileNotFoundError:
+                # حُذفت بين الفحص والتحديث (جمع القطع)، فتُكتب من جديد
+                pass
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        compressed = zlib.compress(data, CHUNK_COMPRESSION_LEVEL)
+        temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(compressed)
+        os.replace(temp_path, path)
+        return digest, len(compressed)
+
+    def get_chunk(self, digest):
+        """قراءة قطعة مع التحقق من بصمتها"""
+        try:
+            with open(self.chunk_path(digest), 'rb') as f:
+                data = zlib.decompress(f.read())
+        except (OSError, zlib.error) as e:
+            raise RepositoryError(f'القطعة {digest[:12]} مفقودة أو تالفة: {e}') from e
+        if hashlib.sha256(data).hexdigest() != digest:
+            raise RepositoryError(f'بصمة القطعة {digest[:12]} لا تطابق محتواها')
+        return data
+
+    def store_file(self, chunks, stats, progress=None):
+        """تخزين قطع ملف؛ يعيد مدخل الملف في ملف الوصف ويحدّث الإحصائيات
+
+        progress(عدد البايتات) تُستدعى بعد كل قطعة.
+        """
+        digests = []
+        size = 0
+        for chunk in chunks:
+            digest, written = self.put_chunk(chunk)
+            digests.append(digest)
+            size += len(chunk)
+            if progress:
+                progress(len(chunk))
+            stats['chunks'] += 1
+            if written:
+                stats['new_chunks'] += 1
+                stats['stored_bytes'] += written
+        stats['logical_size'] += size
+        return {'size': size, 'chunks': digests}
+
+    def store_database(self, path, stats, progress=None):
+        """تخزين لقطة قاعدة SQLite مقطعة على حدود صفحاتها"""
+        chunk_size = sqlite_chunk_size(path)
+        with open(path, 'rb') as f:
+            chunks = fixed_chunks(f, chunk_size) if chunk_size else content_defined_chunks(f)
+            return self.store_file(chunks, stats, progress)
+
+    def store_regular_file(self, path, stats, previous=None, progress=None):
+        """تخزين ملف عادي بالتقطيع حسب المحتوى
+
+        إذا لم يتغير حجم الملف ووقت تعديله عن النسخة السابقة تُستخدم قطعه
+        المسجلة دون قراءته (إذا كانت كلها موجودة).
+        """
+        status = os.stat(path)
+        if previous and previous.get('size') == status.st_size and previous.get('mtime_ns') == status.st_mtime_ns:
+            if all(os.path.exists(self.chunk_path(digest)) for digest in previous['chunks']):
+                for digest in previous['chunks']:
+                    os.utime(self.chunk_path(digest))
+                stats['chunks'] += len(previous['chunks'])
+                stats['logical_size'] += status.st_size
+                if progress:
+                    progress(status.st_size)
+                return dict(previous)
+
+        with open(path, 'rb') as f:
+            entry = self.store_file(content_defined_chunks(f), stats, progress)
+        entry['mtime_ns'] = status.st_mtime_ns
+        return entry
+
+    def save_manifest(self, name, manifest):
+        os.makedirs(self.manifests_dir, exist_ok=True)
+        path = self.manifest_path(name)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+        return path
+
+    def list_manifests(self):
+        """مسارات ملفات الوصف من الأحدث للأقدم"""
+        if not os.path.exists(self.manifests_dir):
+            return []
+        paths = [
+            os.path.join(self.manifests_dir, filename)
+            for filename in os.listdir(self.manifests_dir) if filename.endswith(MANIFEST_SUFFIX)
+        ]
+        return sorted(paths, key=os.path.getmtime, reverse=True)
+
+    def latest_manifest(self):
+        paths = self.list_manifests()
+        return read_manifest(paths[0]) if paths else None
+
+    def restore_file(self, entry, target_path, progress=None):
+        """إعادة تجميع ملف من قطعه في target_path"""
+        written = 0
+        try:
+            with open(target_path, 'wb') as f:
+                for digest in entry['chunks']:
+                    data = self.get_chunk(digest)
+                    f.write(data)
+                    written += len(data)
+                    if progress:
+                        progress(len(data))
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            if os.path.exists(target_path):
+                os.remove(target_path)
+            raise
+        if written != entry['size']:
+            os.remove(target_path)
+            raise RepositoryError(f'حجم الملف المستعاد ({written}) لا يطابق المسجل ({entry["size"]})')
+
+    def collect_garbage(self, grace_seconds=GARBAGE_GRACE_SECONDS):
+        """حذف القطع التي لا يشير إليها أي ملف وصف؛ يعيد (عدد القطع، البايتات المحررة)"""
+        referenced = set()
+        for path in self.list_manifests():
+            manifest = read_manifest(path)
+            for entry in [manifest.get('database')] + list(manifest.get('files', {}).values()):
+                if entry:
+                    referenced.update(entry['chunks'])
+
+        cutoff = time.time() - grace_seconds
+        removed = freed = 0
+        if not os.path.exists(self.chunks_dir):
+            return removed, freed
+        for root, dirs, files in os.walk(self.chunks_dir):
+            for filename in files:
+                path = os.path.join(root, filename)
+                if filename in referenced:
+                    continue
+                status = os.stat(path)
+                if status.st_mtime < cutoff:
+                    os.remove(path)
+                    removed += 1
+                    freed += status.st_size
+        return removed, freed
+
+
+def new_stats():
+    return {'logical_size': 0, 'chunks': 0, 'new_chunks': 0, 'stored_bytes': 0}
+
+
+def new_manifest(name, backup_type):
+    return {
+        'format': 1,
+        'name': name,
+        'backup_type': backup_type,
+        'created_at': datetime.now().isoformat(),
+        'database': None,
+        'files': {},
+        'stats': new_stats()
+    }
+
+
+def read_manifest(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
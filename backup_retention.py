@@ -0,0 +1,312 @@
+import json
+import os
+import shutil
+import time
+import zipfile
+from datetime import datetime
+from sqlalchemy import or_
+from models import db, BackupLog, SystemSettings, TaxReport
+from backup_repository import BackupRepository, MANIFEST_SUFFIX, read_manifest
+from scheduler import local_to_utc, utc_to_local
+
+BACKUPS_DIR = os.path.join('instance', 'backups')
+REPORTS_DIR = os.path.join('instance', 'reports')
+
+# ملفات النسخ التي يمكن استعادتها من مجلد النسخ (إضافة لملفات وصف المستودع)
+BACKUP_FILE_SUFFIXES = ('.zip', '.sql', '.json')
+
+BACKUP_KINDS = ('full', 'data_only', 'structure_only', 'incremental', 'repository')
+
+# القيم الافتراضية لسياسة الاحتفاظ (0 في الحد الأقصى للحجم أو لعمر التقارير = بلا حد)
+RETENTION_DEFAULTS = {
+    'backup_keep_daily': 7,
+    'backup_keep_weekly': 4,
+    'backup_keep_monthly': 12,
+    'backup_max_size_mb': 0,
+    'reports_keep_days': 90,
+    'reports_max_size_mb': 0
+}
+
+# عدد النسخ المعروضة في صفحة الاستعادة (الأحدث أولاً)
+RESTORE_PICKER_LIMIT = 100
+
+
+def get_retention_policy():
+    """سياسة الاحتفاظ من الإعدادات؛ القيم غير الصالحة تعود لافتراضيها"""
+    policy = {}
+    for key, default in RETENTION_DEFAULTS.items():
+        value = SystemSettings.get_setting(key, str(default))
+        policy[key] = int(value) if value.isdigit() else default
+    return policy
+
+
+def backup_family(backup):
+    """نسخ الهيكل فقط لا تكفي للاستعادة وحدها، فتُطبق عليها القواعد منفصلة عن نسخ البيانات"""
+    return 'structure' if backup.backup_kind == 'structure_only' else 'data'
+
+
+def with_ancestors(keep, by_id):
+    """النسخ المحتفظ بها مع كل ما تحتاجه من سلاسلها (النسخة الأساسية والتزايدية السابقة)"""
+    result = set()
+    for backup_id in keep:
+        while backup_id in by_id and backup_id not in result:
+            result.add(backup_id)
+            backup_id = by_id[backup_id].parent_id
+    return result
+
+
+def select_backups_to_keep(backups, policy):
+    """اختيار النسخ التي تبقى حسب قواعد الجد والأب والابن (GFS) ثم حد الحجم
+
+    لكل عائلة: أحدث نسخة دائماً، ثم أحدث نسخة في كل يوم من آخر keep_daily
+    يوماً فيها نسخ، وكذلك للأسابيع والأشهر. النسخة التزايدية المحتفظ بها تُبقي
+    سلسلتها حتى النسخة الأساسية، وآخر سلسلة تبقى كاملة لتُبنى عليها النسخة التالية.
+    إذا تجاوز المجموع حد الحجم تُحذف الأقدم (مع ما بُني عليها) ما عدا أحدث نسخة.
+    يعيد مجموعة المعرفات.
+    """
+    backups = sorted(backups, key=lambda backup: backup.created_at, reverse=True)
+    by_id = {backup.id: backup for backup in backups}
+    rules = (
+        ('backup_keep_daily', lambda moment: moment.date()),
+        ('backup_keep_weekly', lambda moment: moment.isocalendar()[:2]),
+        ('backup_keep_monthly', lambda moment: (moment.year, moment.month))
+    )
+
+    keep = set()
+    protected = set()
+    for family in ('data', 'structure'):
+        points = [backup for backup in backups if backup_family(backup) == family]
+        if not points:
+            continue
+        protected.add(points[0].id)
+        for key, period in rules:
+            periods = set()
+            for point in points:
+                if len(periods) >= policy[key]:
+                    break
+                bucket = period(utc_to_local(point.created_at))
+                if bucket not in periods:
+                    periods.add(bucket)
+                    keep.add(point.id)
+
+    chain_tail = next((backup for backup in backups if backup.chain_id), None)
+    if chain_tail is not None:
+        keep.add(chain_tail.id)
+
+    protected = with_ancestors(protected, by_id)
+    keep = with_ancestors(keep | protected, by_id)
+
+    max_size = policy['backup_max_size_mb'] * 1024 * 1024
+    total = sum(by_id[backup_id].file_size or 0 for backup_id in keep)
+    if max_size and total > max_size:
+        children = {}
+        for backup in backups:
+            if backup.parent_id in by_id:
+                children.setdefault(backup.parent_id, []).append(backup.id)
+
+        for backup in reversed(backups):
+            if total <= max_size:
+                break
+            if backup.id not in keep:
+                continue
+            # حذف نسخة أساسية يحذف ما بُني عليها، فلا تبقى نسخ تزايدية بلا أساس
+            group = []
+            pending = [backup.id]
+            while pending:
+                backup_id = pending.pop()
+                if backup_id in keep:
+                    group.append(backup_id)
+                    pending.extend(children.get(backup_id, []))
+            if protected.intersection(group):
+                continue
+            keep.difference_update(group)
+            total -= sum(by_id[backup_id].file_size or 0 for backup_id in group)
+
+    return keep
+
+
+def remove_backup_files(file_path):
+    """حذف ملف نسخة أو مجلدها (النسخ غير المضغوطة)"""
+    if os.path.isdir(file_path):
+        shutil.rmtree(file_path)
+    elif os.path.exists(file_path):
+        os.remove(file_path)
+
+
+def list_backup_files():
+    """ملفات النسخ الموجودة على القرص: ملفات مجلد النسخ وملفات وصف المستودع"""
+    paths = []
+    if os.path.exists(BACKUPS_DIR):
+        for filename in os.listdir(BACKUPS_DIR):
+            if filename.endswith(BACKUP_FILE_SUFFIXES):
+                paths.append(os.path.join(BACKUPS_DIR, filename))
+    paths.extend(BackupRepository(os.path.join(BACKUPS_DIR, 'repository')).list_manifests())
+    return paths
+
+
+def describe_backup_file(path):
+    """بيانات سجل لملف نسخة غير مسجل: النوع ووقت الإنشاء والحجم والسلسلة"""
+    filename = os.path.basename(path)
+    entry = {
+        'backup_kind': next((kind for kind in BACKUP_KINDS if filename.startswith(f'backup_{kind}_')), None),
+        'created_at': datetime.utcfromtimestamp(os.path.getmtime(path)),
+        'file_size': os.path.getsize(path),
+        'chain_id': None,
+        'parent': None
+    }
+
+    info = {}
+    if path.endswith(MANIFEST_SUFFIX):
+        info = read_manifest(path)
+        entry['file_size'] = info['stats']['stored_bytes']
+    elif path.endswith('.zip'):
+        with zipfile.ZipFile(path, 'r') as zipf:
+            if 'backup_info.json' in zipf.namelist():
+                with zipf.open('backup_info.json') as f:
+                    info = json.load(f)
+
+    if info.get('backup_type') in BACKUP_KINDS:
+        entry['backup_kind'] = info['backup_type']
+    if info.get('created_at'):
+        # وقت الإنشاء في ملف النسخة بالتوقيت المحلي
+        entry['created_at'] = local_to_utc(datetime.fromisoformat(info['created_at']))
+    entry['chain_id'] = info.get('chain_id')
+    entry['parent'] = info.get('parent')
+    return entry
+
+
+def sync_backup_catalog():
+    """مطابقة سجل النسخ مع الملفات الموجودة على القرص
+
+    الاستعادة تستبدل جدول السجل بنسخته القديمة، فالنسخ الأحدث منها تُسجل هنا
+    (كنسخ مستوردة) والنسخ المسجلة التي لم تعد ملفاتها موجودة تُعلَّم كمفقودة.
+    يعيد (عدد المسجلة، عدد المفقودة).
+    """
+    known = {backup.file_path: backup for backup in BackupLog.query.filter(BackupLog.file_path != '').all()}
+
+    missing = 0
+    for backup in known.values():
+        if backup.status == 'success' and not os.path.exists(backup.file_path):
+            backup.status = 'missing'
+            missing += 1
+
+    adopted = []
+    for path in list_backup_files():
+        if path in known:
+            continue
+        try:
+            entry = describe_backup_file(path)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+            print(f'تعذر قراءة ملف النسخة {path}: {str(e)}')
+            continue
+        backup = BackupLog(
+            backup_type='imported',
+            backup_kind=entry['backup_kind'],
+            file_path=path,
+            file_size=entry['file_size'],
+            status='success',
+            created_at=entry['created_at'],
+            chain_id=entry['chain_id']
+        )
+        db.session.add(backup)
+        known[path] = backup
+        adopted.append((backup, entry['parent']))
+    db.session.flush()
+
+    # ربط النسخ التزايدية المستوردة بالنسخة السابقة لها، حتى لا تُحذف أساساتها
+    for backup, parent in adopted:
+        parent_backup = known.get(os.path.join(BACKUPS_DIR, parent)) if parent else None
+        if parent_backup is not None:
+            backup.parent_id = parent_backup.id
+    db.session.commit()
+    return len(adopted), missing
+
+
+def prune_report_files(policy, now=None):
+    """حذف ملفات التقارير المصدرة الأقدم من reports_keep_days ثم الأقدم حتى حد الحجم
+
+    الملفات نسخ محفوظة فقط: التحميل يعيد إنشاء التقرير من الفواتير. يعيد (عدد الملفات، البايتات).
+    """
+    if not os.path.exists(REPORTS_DIR):
+        return 0, 0
+
+    files = []
+    for filename in os.listdir(REPORTS_DIR):
+        path = os.path.join(REPORTS_DIR, filename)
+        if os.path.isfile(path):
+            files.append((path, os.stat(path)))
+    files.sort(key=lambda item: item[1].st_mtime)
+
+    cutoff = (now or time.time()) - policy['reports_keep_days'] * 86400
+    max_size = policy['reports_max_size_mb'] * 1024 * 1024
+    total = sum(status.st_size for _, status in files)
+    removed = []
+    freed = 0
+    for path, status in files:
+        expired = policy['reports_keep_days'] and status.st_mtime < cutoff
+        if not expired and not (max_size and total > max_size):
+            break
+        os.remove(path)
+        removed.append(path)
+        total -= status.st_size
+        freed += status.st_size
+
+    if removed:
+        TaxReport.query.filter(TaxReport.file_path.in_(removed)).update(
+            {'file_path': None}, synchronize_session=False
+        )
+        db.session.commit()
+    return len(removed), freed
+
+
+def apply_retention(progress=None):
+    """تطبيق سياسة الاحتفاظ بعد كل نسخة: مطابقة السجل، حذف النسخ الزائدة، ثم التقارير
+
+    النسخ المحذوفة تبقى في السجل بحالة pruned. يعيد ملخص ما حُذف.
+    """
+    if progress is not None:
+        progress.set_phase('تطبيق سياسة الاحتفاظ', cancellable=False)
+
+    sync_backup_catalog()
+    policy = get_retention_policy()
+    backups = BackupLog.query.filter_by(status='success').all()
+    keep = select_backups_to_keep(backups, policy)
+
+    # الأحدث أولاً: النسخ التزايدية قبل أساساتها، فلا تبقى سلسلة بلا أساس إذا توقف الحذف
+    pruned = sorted((backup for backup in backups if backup.id not in keep),
+                    key=lambda backup: backup.created_at, reverse=True)
+    freed = 0
+    repository_changed = False
+    for backup in pruned:
+        remove_backup_files(backup.file_path)
+        backup.status = 'pruned'
+        db.session.commit()
+        freed += backup.file_size or 0
+        repository_changed = repository_changed or backup.file_path.endswith(MANIFEST_SUFFIX)
+
+    if repository_changed:
+        removed, chunks_freed = BackupRepository(os.path.join(BACKUPS_DIR, 'repository')).collect_garbage()
+        print(f'مستودع النسخ: حُذفت {removed} قطعة ({chunks_freed} بايت)')
+
+    reports_removed, reports_freed = prune_report_files(policy)
+    return {
+        'pruned': len(pruned),
+        'freed': freed,
+        'reports_removed': reports_removed,
+        'reports_freed': reports_freed
+    }
+
+
+def catalog_size():
+    """الحجم الإجمالي للنسخ الموجودة حسب السجل (بدون المرور على الملفات)"""
+    return db.session.query(db.func.coalesce(db.func.sum(BackupLog.file_size), 0)).filter(
+        BackupLog.status == 'success'
+    ).scalar()
+
+
+def restore_candidates(limit=RESTORE_PICKER_LIMIT):
+    """النسخ المتاحة للاستعادة من السجل، الأحدث أولاً (النسخ غير المضغوطة مجلدات لا تُستعاد من هنا)"""
+    return BackupLog.query.filter(
+        BackupLog.status == 'success',
+        or_(*[BackupLog.file_path.like(f'%{suffix}') for suffix in BACKUP_FILE_SUFFIXES])
+    ).order_by(BackupLog.created_at.desc()).limit(limit).all()
@@ -0,0 +1,38 @@
+import hashlib
+from sqlalchemy import func
+from models import db, Product
+
+# آخر نسخة محملة من كتالوج المنتجات النشطة في هذه العملية
+_catalog = {'version': None, 'products': [], 'choices': []}
+
+# ترتيب الحقول في كل منتج داخل الكتالوج المضغوط
+CATALOG_FIELDS = ['id', 'name', 'price', 'tax_type', 'tax_rate']
+
+
+def catalog_version():
+    """إصدار الكتالوج من استعلام تجميعي صغير (يتغير مع أي إضافة أو تعديل أو حذف)"""
+    count, last_update, max_id = db.session.query(
+        func.count(Product.id), func.max(Product.updated_at), func.max(Product.id)
+    ).one()
+    signature = f'{count}:{last_update}:{max_id}'
+    return hashlib.sha1(signature.encode()).hexdigest()[:16]
+
+
+def get_catalog():
+    """كتالوج المنتجات النشطة، يُعاد بناؤه فقط عند تغير الإصدار"""
+    global _catalog
+
+    version = catalog_version()
+    if _catalog['version'] == version:
+        return _catalog
+
+    products = Product.query.filter_by(is_active=True).order_by(Product.name).all()
+    _catalog = {
+        'version': version,
+        'products': [
+            [p.id, p.name, float(p.price), p.tax_type.value, float(p.tax_rate)]
+            for p in products
+        ],
+        'choices': [(p.id, f"{p.name} - {p.price} جنيه") for p in products]
+    }
+    return _catalog
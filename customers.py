@@ -0,0 +1,117 @@
+from datetime import datetime
+from sqlalchemy import insert, or_
+from sqlalchemy.dialects import postgresql, sqlite
+from models import db, Customer
+from search import normalize_arabic
+
+# عدد اقتراحات الإكمال التلقائي
+AUTOCOMPLETE_LIMIT = 10
+
+
+def customer_key(name, tax_id=None):
+    """مفتاح إزالة التكرار: الرقم الضريبي إن وُجد وإلا الاسم بعد التطبيع"""
+    tax_id = (tax_id or '').strip()
+    if tax_id:
+        return ('tax_id', tax_id)
+    return ('name', normalize_arabic(name))
+
+
+def find_customers(keys):
+    """معرفات العملاء الموجودين لمفاتيح customer_key باستعلامين مفهرسين"""
+    tax_ids = [value for kind, value in keys if kind == 'tax_id']
+    names = [value for kind, value in keys if kind == 'name']
+
+    found = {}
+    for start in range(0, len(tax_ids), 500):
+        rows = db.session.query(Customer.id, Customer.tax_id).filter(
+            Customer.tax_id.in_(tax_ids[start:start + 500])
+        )
+        for row in rows:
+            found[('tax_id', row.tax_id)] = row.id
+    for start in range(0, len(names), 500):
+        rows = db.session.query(Customer.id, Customer.normalized_name).filter(
+            Customer.normalized_name.in_(names[start:start + 500]),
+            Customer.tax_id.is_(None)
+        )
+        for row in rows:
+            found[('name', row.normalized_name)] = row.id
+    return found
+
+
+def insert_ignoring_existing():
+    """أمر إدراج عملاء يتجاهل من أنشأه عامل آخر بنفس المفتاح في نفس اللحظة"""
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        return sqlite.insert(Customer).on_conflict_do_nothing()
+    if dialect == 'postgresql':
+        return postgresql.insert(Customer).on_conflict_do_nothing()
+    return insert(Customer)
+
+
+def resolve_customers(entries):
+    """ربط مجموعة (اسم، رقم ضريبي، عنوان) بعملاء موجودين أو جدد
+
+    البحث عن الموجودين باستعلامين مفهرسين (الرقم الضريبي والاسم المطبّع)،
+    وإدراج الجدد دفعة واحدة، وتحديث عنوان الموجودين إذا أُرسل عنوان.
+    المفتاح فريد في القاعدة، فالعملاء الذين أنشأهم طلب متزامن يُقرؤون بعد الإدراج.
+    تعيد قاموساً من customer_key إلى معرف العميل.
+    """
+    pending = {}
+    for name, tax_id, address in entries:
+        key = customer_key(name, tax_id)
+        if key[1] and key not in pending:
+            pending[key] = {
+                'name': name.strip(),
+                'normalized_name': normalize_arabic(name),
+                'tax_id': (tax_id or '').strip() or None,
+                'address': address or None
+            }
+
+    if not pending:
+        return {}
+
+    resolved = find_customers(pending)
+
+    address_updates = [
+        {'id': resolved[key], 'address': pending[key]['address']}
+        for key in pending if key in resolved and pending[key]['address']
+    ]
+    if address_updates:
+        db.session.bulk_update_mappings(Customer, address_updates)
+
+    missing = [key for key in pending if key not in resolved]
+    if missing:
+        now = datetime.utcnow()
+        db.session.execute(
+            insert_ignoring_existing(),
+            [dict(pending[key], created_at=now, updated_at=now) for key in missing]
+        )
+        resolved.update(find_customers(missing))
+
+    return resolved
+
+
+def get_or_create_customer(name, tax_id=None, address=None):
+    """العميل المطابق للاسم أو الرقم الضريبي (يُنشأ إذا لم يوجد)"""
+    key = customer_key(name, tax_id)
+    customer_id = resolve_customers([(name, tax_id, address)]).get(key)
+    if customer_id is None:
+        return None
+    return db.session.get(Customer, customer_id)
+
+
+def autocomplete_customers(term, limit=AUTOCOMPLETE_LIMIT):
+    """اقتراح العملاء الذين يبدأ اسمهم أو رقمهم الضريبي بالنص المدخل
+
+    البحث بمدى (>= البادئة و < البادئة + أعلى محرف) حتى يستخدم فهرس B-tree
+    في SQLite و PostgreSQL على حد سواء، بخلاف LIKE '%...%'.
+    """
+    prefix = normalize_arabic(term)
+    raw_prefix = (term or '').strip()
+    if not prefix:
+        return []
+
+    return Customer.query.filter(or_(
+        (Customer.normalized_name >= prefix) & (Customer.normalized_name < prefix + '\uffff'),
+        (Customer.tax_id >= raw_prefix) & (Customer.tax_id < raw_prefix + '\uffff')
+    )).order_by(Customer.normalized_name).limit(limit).all()
@@ -0,0 +1,81 @@
+import hashlib
+import json
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from models import db, Invoice, Product
+from pagination import cached_summary
+from live_events import broadcaster
+
+# مدة صلاحية إحصائيات لوحة التحكم في ذاكرة العملية (بالثواني)
+DASHBOARD_TTL = 15
+
+# عدد أيام الرسم البياني
+CHART_DAYS = 7
+
+
+def empty_totals():
+    return {'invoices_count': 0, 'total_amount': 0.0, 'vat_amount': 0.0, 'withholding_amount': 0.0}
+
+
+def compute_dashboard_stats(today=None):
+    """إحصائيات اليوم والشهر الحالي وآخر 7 أيام من استعلام مجمّع واحد حسب التاريخ"""
+    today = today or datetime.now().date()
+    month_start = today.replace(day=1)
+    chart_start = today - timedelta(days=CHART_DAYS - 1)
+
+    rows = db.session.query(
+        Invoice.invoice_date,
+        func.count(Invoice.id).label('invoices_count'),
+        func.coalesce(func.sum(Invoice.total_amount), 0).label('total_amount'),
+        func.coalesce(func.sum(Invoice.vat_amount), 0).label('vat_amount'),
+        func.coalesce(func.sum(Invoice.withholding_amount), 0).label('withholding_amount')
+    ).filter(
+        Invoice.invoice_date >= min(month_start, chart_start),
+        Invoice.invoice_date <= today,
+        Invoice.is_cancelled == False
+    ).group_by(Invoice.invoice_date).all()
+
+    by_date = {}
+    month = empty_totals()
+    for row in rows:
+        day = {
+            'invoices_count': row.invoices_count,
+            'total_amount': float(row.total_amount),
+            'vat_amount': float(row.vat_amount),
+            'withholding_amount': float(row.withholding_amount)
+        }
+        by_date[row.invoice_date] = day
+        if row.invoice_date >= month_start:
+            for key in month:
+                month[key] += day[key]
+
+    daily = []
+    for offset in range(CHART_DAYS - 1, -1, -1):
+        date = today - timedelta(days=offset)
+        day = by_date.get(date, empty_totals())
+        daily.append(dict(day, date=date.isoformat()))
+
+    return {
+        'today': by_date.get(today, empty_totals()),
+        'month': month,
+        'daily': daily,
+        'products_count': Product.query.count(),
+        'generated_at': datetime.utcnow().isoformat()
+    }
+
+
+def get_dashboard_stats():
+    """الإحصائيات مع ETag، مخزنة مؤقتاً لمدة قصيرة حتى لا يكلف الاستطلاع المتكرر شيئاً"""
+    today = datetime.now().date()
+
+    def build():
+        # معرف آخر حدث قبل الاستعلام: يبدأ بث الفروق من عنده فلا يفوت المتصفح تغييراً
+        event_id = broadcaster.current_event_id()
+        stats = compute_dashboard_stats(today)
+        stats['event_id'] = event_id
+        # generated_at و event_id لا يدخلان في ETag حتى لا يتغير إلا بتغير الأرقام
+        content = {key: value for key, value in stats.items() if key not in ('generated_at', 'event_id')}
+        etag = hashlib.sha1(json.dumps(content, sort_keys=True).encode()).hexdigest()[:16]
+        return stats, etag
+
+    return cached_summary(('dashboard', today), build, ttl=DASHBOARD_TTL)
@@ -1,7 +1,8 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, TextAreaField, DecimalField, SelectField, IntegerField, DateField, BooleanField, PasswordField, SubmitField, FieldList, FormField
+from wtforms import Form, StringField, TextAreaField, DecimalField, SelectField, IntegerField, DateField, BooleanField, PasswordField, SubmitField, FieldList, FormField
 from wtforms.validators import DataRequired, Email, Length, NumberRange, Optional, ValidationError
 from models import User, Product, TaxType, UserRole
+from catalog import get_catalog
 from datetime import datetime
 
 class LoginForm(FlaskForm):
@@ -65,8 +66,30 @@ class InvoiceItemForm(FlaskForm):
     
     def __init__(self, *args, **kwargs):
         super(InvoiceItemForm, self).__init__(*args, **kwargs)
-        self.product_id.choices = [(p.id, f"{p.name} - {p.price} جنيه") 
-                                  for p in Product.query.filter_by(is_active=True).all()]
+        # الخيارات من كتالوج المنتجات المخزن، ولا تُبنى من قاعدة البيانات إلا عند تغيره
+        self.product_id.choices = get_catalog()['choices']
+
+class InvoiceItemLineForm(Form):
+    """سطر واحد في محرر الأسطر المتعددة (بدون CSRF لأنه جزء من نموذج أكبر)"""
+    product_id = SelectField('المنتج', coerce=int, validators=[DataRequired()])
+    quantity = DecimalField('الكمية', validators=[DataRequired(), NumberRange(min=0.001)], places=3)
+    unit_price = DecimalField('سعر الوحدة', validators=[Optional(), NumberRange(min=0)], places=2)
+    discount_percentage = DecimalField('نسبة الخصم (%)', validators=[Optional(), NumberRange(min=0, max=100)], places=2, default=0)
+
+class InvoiceItemsBatchForm(FlaskForm):
+    """نموذج إضافة عدة منتجات للفاتورة دفعة واحدة"""
+    items = FieldList(FormField(InvoiceItemLineForm), min_entries=1, max_entries=500)
+    replace_existing = BooleanField('استبدال المنتجات الحالية بالكامل', default=False)
+    submit = SubmitField('حفظ المنتجات')
+    
+    def __init__(self, products=None, *args, **kwargs):
+        super(InvoiceItemsBatchForm, self).__init__(*args, **kwargs)
+        # قائمة المنتجات تُحمَّل مرة واحدة وتُشارك بين جميع الأسطر
+        if products is None:
+            products = Product.query.filter_by(is_active=True).all()
+        choices = [(p.id, f"{p.name} - {p.price} جنيه") for p in products]
+        for entry in self.items:
+            entry.product_id.choices = choices
 
 class InvoiceForm(FlaskForm):
     customer_name = StringField('اسم العميل', validators=[DataRequired(), Length(max=200)])
@@ -114,6 +137,8 @@ class SearchForm(FlaskForm):
 class BackupForm(FlaskForm):
     backup_type = SelectField('نوع النسخة الاحتياطية', choices=[
         ('full', 'نسخة كاملة'),
+        ('incremental', 'نسخة تزايدية (التغييرات منذ آخر نسخة)'),
+        ('repository', 'نسخة كاملة في المستودع (بدون تكرار)'),
         ('data_only', 'البيانات فقط'),
         ('structure_only', 'الهيكل فقط')
     ], default='full')
@@ -159,6 +184,7 @@ class SettingsForm(FlaskForm):
     # إعدادات الفواتير
     invoice_prefix = StringField('بادئة رقم الفاتورة', validators=[Optional(), Length(max=10)], default='INV')
     invoice_start_number = IntegerField('رقم البداية للفواتير', validators=[DataRequired(), NumberRange(min=1)], default=1)
+    invoices_locked_until = DateField('إقفال الفواتير حتى تاريخ', validators=[Optional()])
     
     submit = SubmitField('حفظ الإعدادات')
 
@@ -0,0 +1,843 @@
+from collections import defaultdict
+from datetime import datetime
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import json
+import os
+import threading
+import time
+import uuid
+from sqlalchemy import insert, update, select, func, case
+from sqlalchemy.exc import IntegrityError
+from models import db, Invoice, InvoiceItem, Product, TaxType, SystemSettings, Counter
+from search import invoice_search_text
+from customers import customer_key, resolve_customers
+from migrations import seed_invoice_counter
+from live_events import queue_event, invoice_contribution, contribution_deltas
+from scheduler import register_job, daily_at
+
+# الحد الأقصى لعدد الفواتير في دفعة واحدة
+MAX_BULK_INVOICES = 10000
+
+TWO_PLACES = Decimal('0.01')
+
+# أكبر القيم التي تسعها أعمدة Numeric: الكمية (10,3) والسعر (10,2) والمبالغ (12,2)
+MAX_QUANTITY = Decimal(10) ** 7
+MAX_UNIT_PRICE = Decimal(10) ** 8
+MAX_AMOUNT = Decimal(10) ** 10
+
+
+class InvoiceValidationError(ValueError):
+    """خطأ في بيانات الفاتورة المرسلة"""
+
+
+def to_decimal(value, field_name):
+    """تحويل قيمة إلى Decimal مع رسالة خطأ واضحة"""
+    if value is None or value == '':
+        raise InvoiceValidationError(f'الحقل {field_name} مطلوب.')
+    try:
+        result = Decimal(str(value))
+    except (InvalidOperation, ValueError):
+        raise InvoiceValidationError(f'قيمة غير صالحة للحقل {field_name}.')
+    if not result.is_finite():
+        raise InvoiceValidationError(f'قيمة غير صالحة للحقل {field_name}.')
+    return result
+
+
+def optional_text(invoice_data, field_name):
+    """قراءة حقل نصي اختياري، مع رفض القيم غير النصية"""
+    value = invoice_data.get(field_name)
+    if value is None:
+        return None
+    if not isinstance(value, str):
+        raise InvoiceValidationError(f'الحقل {field_name} يجب أن يكون نصاً.')
+    return value.strip() or None
+
+
+def parse_date(value, field_name, required=False):
+    """تحويل نص التاريخ (YYYY-MM-DD) إلى تاريخ"""
+    if not value:
+        if required:
+            raise InvoiceValidationError(f'الحقل {field_name} مطلوب.')
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        raise InvoiceValidationError(f'تنسيق التاريخ غير صالح للحقل {field_name}.')
+
+
+def load_products_map(product_ids):
+    """تحميل المنتجات المطلوبة في استعلام واحد"""
+    if not product_ids:
+        return {}
+    products = Product.query.filter(Product.id.in_(product_ids)).all()
+    return {product.id: product for product in products}
+
+
+def collect_product_ids(items_data):
+    """استخراج معرفات المنتجات من بيانات الأسطر المرسلة"""
+    product_ids = set()
+    for item_data in items_data or []:
+        try:
+            product_ids.add(int(item_data.get('product_id')))
+        except (AttributeError, TypeError, ValueError):
+            pass
+    return product_ids
+
+
+def calculate_line_amounts(quantity, unit_price, discount_percentage, tax_rate):
+    """حساب إجمالي السطر بعد الخصم وضريبته
+
+    يُقرَّب كل سطر إلى قرشين حتى يكون مجموع الفروق (deltas) مساوياً تماماً
+    لإعادة الحساب الكاملة.
+    """
+    base_amount = quantity * unit_price
+    line_total = base_amount - base_amount * (Decimal(discount_percentage or 0) / 100)
+    line_tax = line_total * (tax_rate / 100)
+    return (line_total.quantize(TWO_PLACES, rounding=ROUND_HALF_UP),
+            line_tax.quantize(TWO_PLACES, rounding=ROUND_HALF_UP))
+
+
+def stored_item_line(item, products_map):
+    """حساب مبالغ سطر محفوظ في قاعدة البيانات (من اللقطة المخزنة إن وجدت)"""
+    if item.line_total is not None:
+        return {'line_total': item.line_total, 'line_tax': item.line_tax, 'tax_type': item.tax_type}
+
+    product = products_map[item.product_id]
+    line_total, line_tax = calculate_line_amounts(
+        item.quantity, item.unit_price, item.discount_percentage, product.tax_rate
+    )
+    return {'line_total': line_total, 'line_tax': line_tax, 'tax_type': product.tax_type}
+
+
+def allocate_invoice_numbers(count):
+    """حجز كتلة متتالية من أرقام الفواتير
+
+    الحجز تحديث ذري واحد لصف العداد، يبقى مقفلاً حتى commit المستدعي: الطلبات
+    المتزامنة تنتظر ولا تحصل على أرقام متداخلة، والتراجع يعيد الأرقام المحجوزة.
+    """
+    invoice_prefix = SystemSettings.get_setting('invoice_prefix', 'INV')
+    start_number = int(SystemSettings.get_setting('invoice_start_number', '1'))
+    counters = Counter.__table__
+    last_number = db.session.execute(
+        update(counters)
+        .where(counters.c.name == 'invoice_number')
+        .values(value=func.coalesce(counters.c.value, start_number - 1) + count)
+        .returning(counters.c.value)
+    ).scalar()
+    if last_number is None:
+        # قاعدة لم تمر بالترقية بعد
+        db.session.rollback()
+        seed_invoice_counter()
+        return allocate_invoice_numbers(count)
+    next_number = last_number - count + 1
+    return [f"{invoice_prefix}-{number:06d}" for number in range(next_number, next_number + count)]
+
+
+def validate_item_payload(item_data, products_map):
+    """التحقق من سطر فاتورة وحساب مبالغه"""
+    if not isinstance(item_data, dict):
+        raise InvoiceValidationError('بيانات السطر يجب أن تكون كائن JSON.')
+    try:
+        product_id = int(item_data.get('product_id'))
+    except (TypeError, ValueError):
+        raise InvoiceValidationError('معرف المنتج غير صالح.')
+
+    product = products_map.get(product_id)
+    if not product or not product.is_active:
+        raise InvoiceValidationError(f'المنتج {product_id} غير موجود أو غير نشط.')
+
+    quantity = to_decimal(item_data.get('quantity'), 'quantity')
+    if quantity <= 0:
+        raise InvoiceValidationError('الكمية يجب أن تكون أكبر من صفر.')
+    if quantity >= MAX_QUANTITY:
+        raise InvoiceValidationError('الكمية أكبر من الحد المسموح.')
+
+    unit_price = item_data.get('unit_price')
+    unit_price = product.price if unit_price in (None, '') else to_decimal(unit_price, 'unit_price')
+    if unit_price < 0:
+        raise InvoiceValidationError('سعر الوحدة لا يمكن أن يكون سالباً.')
+    if unit_price >= MAX_UNIT_PRICE:
+        raise InvoiceValidationError('سعر الوحدة أكبر من الحد المسموح.')
+
+    discount_percentage = item_data.get('discount_percentage') or 0
+    discount_percentage = to_decimal(discount_percentage, 'discount_percentage')
+    if discount_percentage < 0 or discount_percentage > 100:
+        raise InvoiceValidationError('نسبة الخصم يجب أن تكون بين 0 و 100.')
+
+    line_total, line_tax = calculate_line_amounts(quantity, unit_price, discount_percentage, product.tax_rate)
+    if abs(line_total) + abs(line_tax) >= MAX_AMOUNT:
+        raise InvoiceValidationError('إجمالي السطر أكبر من الحد المسموح.')
+
+    return {
+        'product_id': product_id,
+        'quantity': quantity,
+        'unit_price': unit_price,
+        'discount_percentage': discount_percentage,
+        'line_total': line_total,
+        'line_tax': line_tax,
+        'tax_type': product.tax_type,
+        'tax_rate': product.tax_rate
+    }
+
+
+def validate_invoice_payload(invoice_data, products_map):
+    """التحقق من فاتورة كاملة وحساب إجمالياتها في الذاكرة"""
+    if not isinstance(invoice_data, dict):
+        raise InvoiceValidationError('بيانات الفاتورة يجب أن تكون كائن JSON.')
+
+    customer_name = optional_text(invoice_data, 'customer_name')
+    if not customer_name:
+        raise InvoiceValidationError('اسم العميل مطلوب.')
+    if len(customer_name) > 200:
+        raise InvoiceValidationError('اسم العميل أطول من 200 حرف.')
+
+    customer_tax_id = optional_text(invoice_data, 'customer_tax_id')
+    if customer_tax_id and len(customer_tax_id) > 50:
+        raise InvoiceValidationError('الرقم الضريبي للعميل أطول من 50 حرف.')
+
+    items_data = invoice_data.get('items') or []
+    if not isinstance(items_data, list) or not items_data:
+        raise InvoiceValidationError('الفاتورة يجب أن تحتوي على منتج واحد على الأقل.')
+
+    items = []
+    for line_number, item_data in enumerate(items_data, 1):
+        try:
+            items.append(validate_item_payload(item_data, products_map))
+        except InvoiceValidationError as e:
+            raise InvoiceValidationError(f'السطر {line_number}: {e}')
+
+    invoice = {
+        'customer_name': customer_name,
+        'customer_tax_id': customer_tax_id,
+        'customer_address': optional_text(invoice_data, 'customer_address'),
+        'invoice_date': parse_date(invoice_data.get('invoice_date'), 'invoice_date') or datetime.utcnow().date(),
+        'due_date': parse_date(invoice_data.get('due_date'), 'due_date'),
+        'notes': optional_text(invoice_data, 'notes')
+    }
+    totals = summarize_lines(items)
+    if any(abs(value) >= MAX_AMOUNT for value in totals.values()):
+        raise InvoiceValidationError('إجمالي الفاتورة أكبر من الحد المسموح.')
+    invoice.update(totals)
+
+    return invoice, items
+
+
+def summarize_lines(lines):
+    """تجميع إجماليات الفاتورة من أسطر محسوبة مسبقاً"""
+    subtotal = sum((line['line_total'] for line in lines), Decimal('0'))
+    vat_amount = sum((line['line_tax'] for line in lines if line['tax_type'] == TaxType.VAT), Decimal('0'))
+    withholding_amount = sum((line['line_tax'] for line in lines if line['tax_type'] == TaxType.WITHHOLDING), Decimal('0'))
+
+    vat_base = sum((line['line_total'] for line in lines if line['tax_type'] == TaxType.VAT), Decimal('0'))
+    withholding_base = sum((line['line_total'] for line in lines if line['tax_type'] == TaxType.WITHHOLDING), Decimal('0'))
+
+    totals = {
+        'subtotal': subtotal.quantize(TWO_PLACES, rounding=ROUND_HALF_UP),
+        'vat_amount': vat_amount.quantize(TWO_PLACES, rounding=ROUND_HALF_UP),
+        'withholding_amount': withholding_amount.quantize(TWO_PLACES, rounding=ROUND_HALF_UP),
+        'vat_base': vat_base.quantize(TWO_PLACES, rounding=ROUND_HALF_UP),
+        'withholding_base': withholding_base.quantize(TWO_PLACES, rounding=ROUND_HALF_UP)
+    }
+    totals['total_amount'] = totals['subtotal'] + totals['vat_amount'] + totals['withholding_amount']
+    return totals
+
+
+def totals_delta(added_lines=(), removed_lines=()):
+    """حساب الفرق الموقَّع في إجماليات الفاتورة من الأسطر المضافة والمحذوفة"""
+    delta = {field: Decimal('0') for field in
+             ('subtotal', 'vat_amount', 'withholding_amount', 'vat_base', 'withholding_base')}
+    for sign, lines in ((1, added_lines), (-1, removed_lines)):
+        for line in lines:
+            delta['subtotal'] += sign * line['line_total']
+            if line['tax_type'] == TaxType.VAT:
+                delta['vat_amount'] += sign * line['line_tax']
+                delta['vat_base'] += sign * line['line_total']
+            elif line['tax_type'] == TaxType.WITHHOLDING:
+                delta['withholding_amount'] += sign * line['line_tax']
+                delta['withholding_base'] += sign * line['line_total']
+    delta['total_amount'] = delta['subtotal'] + delta['vat_amount'] + delta['withholding_amount']
+    return delta
+
+
+def apply_totals_delta(invoice_id, delta):
+    """تطبيق الفرق على إجماليات الفاتورة بتحديث ذري واحد
+
+    UPDATE invoices SET subtotal = subtotal + :d ... فلا حاجة لقراءة أسطر
+    الفاتورة، وتبقى التحديثات المتزامنة على نفس الفاتورة صحيحة.
+    """
+    if not any(delta.values()):
+        # لا فرق في الإجماليات، لكن أسطر الفاتورة تغيرت: تحديث updated_at وحده
+        # حتى تلتقط النسخة التزايدية الفاتورة وأسطرها
+        db.session.execute(
+            update(Invoice)
+            .where(Invoice.id == invoice_id)
+            .values(updated_at=datetime.utcnow())
+            .execution_options(synchronize_session=False)
+        )
+        return
+    invoice = db.session.execute(
+        update(Invoice)
+        .where(Invoice.id == invoice_id)
+        .values(
+            subtotal=Invoice.subtotal + delta['subtotal'],
+            vat_amount=Invoice.vat_amount + delta['vat_amount'],
+            withholding_amount=Invoice.withholding_amount + delta['withholding_amount'],
+            total_amount=Invoice.total_amount + delta['total_amount'],
+            vat_base=Invoice.vat_base + delta['vat_base'],
+            withholding_base=Invoice.withholding_base + delta['withholding_base'],
+            updated_at=datetime.utcnow()
+        )
+        .returning(Invoice.invoice_date, Invoice.is_cancelled)
+        .execution_options(synchronize_session=False)
+    ).one_or_none()
+
+    # التحديث المباشر لا يمر بأحداث ORM، لذلك يُسجَّل حدث الفرق هنا
+    if invoice is not None:
+        deltas = contribution_deltas(added=[invoice_contribution(
+            invoice.invoice_date, invoice.is_cancelled, delta, count=0
+        )])
+        queue_event(db.session, 'totals_changed', {'invoice_id': invoice_id, 'deltas': deltas})
+
+
+def item_row(invoice_id, line):
+    """تحويل سطر محسوب إلى صف جاهز للإدراج في جدول invoice_items"""
+    return {
+        'invoice_id': invoice_id,
+        'product_id': line['product_id'],
+        'quantity': line['quantity'],
+        'unit_price': line['unit_price'],
+        'discount_percentage': line['discount_percentage'],
+        'tax_type': line['tax_type'],
+        'tax_rate': line['tax_rate'],
+        'line_total': line['line_total'],
+        'line_tax': line['line_tax']
+    }
+
+
+def bulk_create_invoices(invoices_data, user_id):
+    """إنشاء مجموعة فواتير مع منتجاتها في معاملة واحدة
+
+    يعيد قائمة بالفواتير المنشأة وقائمة بالأخطاء لكل فاتورة مرفوضة.
+    """
+    if not isinstance(invoices_data, list):
+        raise InvoiceValidationError('الحقل invoices يجب أن يكون قائمة.')
+    if len(invoices_data) > MAX_BULK_INVOICES:
+        raise InvoiceValidationError(f'الحد الأقصى للدفعة الواحدة {MAX_BULK_INVOICES} فاتورة.')
+
+    # جمع معرفات المنتجات وتحميلها مرة واحدة
+    product_ids = set()
+    for invoice_data in invoices_data:
+        if isinstance(invoice_data, dict) and isinstance(invoice_data.get('items'), list):
+            product_ids |= collect_product_ids(invoice_data['items'])
+    products_map = load_products_map(product_ids)
+
+    # التحقق من جميع الفواتير في تمريرة واحدة
+    valid = []
+    errors = []
+    for index, invoice_data in enumerate(invoices_data):
+        try:
+            valid.append((index,) + validate_invoice_payload(invoice_data, products_map))
+        except InvoiceValidationError as e:
+            errors.append({'index': index, 'error': str(e)})
+
+    if not valid:
+        return [], errors
+
+    now = datetime.utcnow()
+    invoice_numbers = allocate_invoice_numbers(len(valid))
+
+    # ربط الفواتير بالعملاء (الموجودين أو الجدد) في استعلامات مجمّعة
+    customer_ids = resolve_customers([
+        (invoice['customer_name'], invoice['customer_tax_id'], invoice['customer_address'])
+        for index, invoice, items in valid
+    ])
+
+    invoice_rows = []
+    for (index, invoice, items), invoice_number in zip(valid, invoice_numbers):
+        invoice.update({
+            'customer_id': customer_ids.get(customer_key(invoice['customer_name'], invoice['customer_tax_id'])),
+            'invoice_number': invoice_number,
+            'is_cancelled': False,
+            'created_by': user_id,
+            'created_at': now,
+            'updated_at': now
+        })
+        # الإدراج المجمّع لا يمر بأحداث ORM، لذلك يُحسب نص البحث هنا
+        invoice['search_text'] = invoice_search_text(invoice)
+        invoice_rows.append(invoice)
+
+    try:
+        # إدراج الفواتير دفعة واحدة مع استرجاع المعرفات بنفس ترتيب الإدخال
+        invoice_ids = db.session.scalars(
+            insert(Invoice).returning(Invoice.id, sort_by_parameter_order=True),
+            invoice_rows
+        ).all()
+
+        item_rows = [
+            item_row(invoice_id, line)
+            for (index, invoice, items), invoice_id in zip(valid, invoice_ids)
+            for line in items
+        ]
+        db.session.bulk_insert_mappings(InvoiceItem, item_rows)
+
+        # حدث واحد للدفعة كلها بفروق مجمّعة حسب تاريخ الفاتورة
+        deltas = contribution_deltas(added=[
+            invoice_contribution(invoice['invoice_date'], False, invoice) for index, invoice, items in valid
+        ])
+        queue_event(db.session, 'invoice_created', {'count': len(valid), 'deltas': deltas})
+        db.session.commit()
+    except IntegrityError as e:
+        # رقم فاتورة مكرر أو قيد آخر: لا يُحفظ شيء من الدفعة، ويُبلَّغ كل عنصر بالخطأ
+        db.session.rollback()
+        print(f'تعارض أثناء حفظ دفعة الفواتير: {str(e.orig)}')
+        errors.extend(
+            {'index': index, 'error': 'تعارض مع بيانات محفوظة (رقم فاتورة مكرر)، لم تُحفظ الدفعة. أعد المحاولة.'}
+            for index, invoice, items in valid
+        )
+        errors.sort(key=lambda error: error['index'])
+        return [], errors
+    except Exception:
+        db.session.rollback()
+        raise
+
+    created = [
+        {'index': index, 'id': invoice_id, 'invoice_number': invoice['invoice_number']}
+        for (index, invoice, items), invoice_id in zip(valid, invoice_ids)
+    ]
+    return created, errors
+
+
+def save_invoice_items(invoice, items_data, replace=False):
+    """حفظ مجموعة من أسطر الفاتورة في معاملة واحدة
+
+    في وضع الاستبدال تُحذف الأسطر الحالية وتُدرج الأسطر الجديدة وتُحسب
+    الإجماليات منها مباشرة. في وضع التعديل يُحدَّث السطر الذي يحمل id، ويُحذف
+    إذا كان delete صحيحاً، ويُضاف السطر الذي لا يحمل id، ثم يُطبَّق فرق واحد على
+    إجماليات الفاتورة دون قراءة باقي أسطرها.
+    يعيد قائمة بأخطاء الأسطر؛ ولا يُحفظ أي شيء عند وجود خطأ.
+    """
+    if not isinstance(items_data, list):
+        raise InvoiceValidationError('الحقل items يجب أن يكون قائمة.')
+
+    # تحميل الأسطر المشار إليها فقط
+    referenced_ids = set()
+    if not replace:
+        for item_data in items_data:
+            if isinstance(item_data, dict) and item_data.get('id') not in (None, ''):
+                try:
+                    referenced_ids.add(int(item_data['id']))
+                except (TypeError, ValueError):
+                    pass
+    existing = {}
+    if referenced_ids:
+        existing = {
+            item.id: item
+            for item in InvoiceItem.query.filter(
+                InvoiceItem.invoice_id == invoice.id,
+                InvoiceItem.id.in_(referenced_ids)
+            ).all()
+        }
+
+    product_ids = collect_product_ids(items_data)
+    product_ids |= {item.product_id for item in existing.values() if item.line_total is None}
+    products_map = load_products_map(product_ids)
+
+    errors = []
+    new_lines = []
+    updates = {}
+    deletes = set()
+    seen_ids = set()
+    for line_number, item_data in enumerate(items_data, 1):
+        try:
+            item_id = item_data.get('id') if isinstance(item_data, dict) and not replace else None
+            if item_id in (None, ''):
+                new_lines.append(validate_item_payload(item_data, products_map))
+                continue
+
+            try:
+                item_id = int(item_id)
+            except (TypeError, ValueError):
+                raise InvoiceValidationError('معرف السطر غير صالح.')
+            if item_id not in existing:
+                raise InvoiceValidationError('السطر غير موجود في هذه الفاتورة.')
+            if item_id in seen_ids:
+                raise InvoiceValidationError('السطر مكرر في الطلب.')
+            seen_ids.add(item_id)
+
+            if item_data.get('delete'):
+                deletes.add(item_id)
+            else:
+                updates[item_id] = validate_item_payload(item_data, products_map)
+        except InvoiceValidationError as e:
+            errors.append({'line': line_number, 'error': str(e)})
+
+    if errors:
+        return errors
+
+    try:
+        if replace:
+            InvoiceItem.query.filter_by(invoice_id=invoice.id).delete(synchronize_session=False)
+        elif deletes:
+            InvoiceItem.query.filter(InvoiceItem.id.in_(deletes)).delete(synchronize_session=False)
+
+        # الأسطر القديمة التي ستُستبدل أو تُحذف تُطرح من الإجماليات
+        removed_lines = [stored_item_line(existing[item_id], products_map)
+                         for item_id in list(deletes) + list(updates)]
+
+        for item_id, line in updates.items():
+            for field, value in item_row(invoice.id, line).items():
+                setattr(existing[item_id], field, value)
+
+        if new_lines:
+            db.session.bulk_insert_mappings(InvoiceItem, [item_row(invoice.id, line) for line in new_lines])
+
+        if replace:
+            for field, value in summarize_lines(new_lines).items():
+                setattr(invoice, field, value)
+            invoice.updated_at = datetime.utcnow()
+        else:
+            apply_totals_delta(invoice.id, totals_delta(new_lines + list(updates.values()), removed_lines))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return []
+
+
+def add_item_to_invoice(invoice, item_data):
+    """إضافة سطر واحد للفاتورة مع تحديث إجمالياتها بفرق ثابت التكلفة"""
+    products_map = load_products_map(collect_product_ids([item_data]))
+    line = validate_item_payload(item_data, products_map)
+
+    item = InvoiceItem(**item_row(invoice.id, line))
+    db.session.add(item)
+    apply_totals_delta(invoice.id, totals_delta(added_lines=[line]))
+    db.session.commit()
+    return item
+
+
+def remove_item_from_invoice(item):
+    """حذف سطر من الفاتورة مع طرح مبالغه من إجمالياتها"""
+    products_map = {} if item.line_total is not None else {item.product_id: item.product}
+    line = stored_item_line(item, products_map)
+    invoice_id = item.invoice_id
+
+    db.session.delete(item)
+    apply_totals_delta(invoice_id, totals_delta(removed_lines=[line]))
+    db.session.commit()
+
+
+def verify_invoice_totals(fix_since=None, chunk_size=500):
+    """التحقق الدوري من تطابق إجماليات الفواتير المخزنة مع أسطرها
+
+    الفواتير الملغاة والمقفلة (حتى invoices_locked_until) لا تُفحص: أرقامها نهائية
+    وقد تكون أُقرت ضريبياً. الفاتورة المنحرفة تُصحح فقط إذا عُدلت بعد fix_since
+    (الانحراف من تعديل حديث)، وغيرها يُبلَّغ عنه دون تعديل.
+    يعيد (معرفات المصححة، معرفات المنحرفة غير المصححة).
+    """
+    fixed = []
+    drifted = []
+    last_id = 0
+    locked_until = get_locked_until()
+
+    while True:
+        query = Invoice.query.filter(Invoice.id > last_id, Invoice.is_cancelled == False)
+        if locked_until:
+            query = query.filter(Invoice.invoice_date > locked_until)
+        invoices = query.order_by(Invoice.id).limit(chunk_size).all()
+        if not invoices:
+            break
+        last_id = invoices[-1].id
+
+        items = InvoiceItem.query.filter(InvoiceItem.invoice_id.in_([inv.id for inv in invoices])).all()
+        products_map = load_products_map({item.product_id for item in items if item.line_total is None})
+
+        lines_by_invoice = defaultdict(list)
+        for item in items:
+            lines_by_invoice[item.invoice_id].append(stored_item_line(item, products_map))
+
+        for invoice in invoices:
+            expected = summarize_lines(lines_by_invoice[invoice.id])
+            stored = {field: Decimal(getattr(invoice, field) or 0).quantize(TWO_PLACES) for field in expected}
+            if stored == expected:
+                continue
+            if fix_since is not None and invoice.updated_at and invoice.updated_at >= fix_since:
+                fixed.append(invoice.id)
+                for field, value in expected.items():
+                    setattr(invoice, field, value)
+            else:
+                drifted.append(invoice.id)
+
+        db.session.commit()
+
+    return fixed, drifted
+
+
+def verify_invoice_totals_job(app):
+    """مهمة مجدولة للتحقق من انحراف إجماليات الفواتير
+
+    تصحح فقط الفواتير المعدلة منذ آخر تحقق ناجح، وتحفظ تقريراً بالباقي
+    (invoice_totals_report) يظهر في صفحة الإعدادات. أول تشغيل لا يصحح شيئاً.
+    """
+    started_at = datetime.utcnow()
+    last_verified = SystemSettings.get_setting('invoice_totals_verified_at')
+    fix_since = datetime.fromisoformat(last_verified) if last_verified else None
+
+    fixed, drifted = verify_invoice_totals(fix_since=fix_since)
+    if fixed:
+        print(f'تم تصحيح إجماليات {len(fixed)} فاتورة معدلة منذ آخر تحقق: {fixed[:20]}')
+    if drifted:
+        print(f'إجماليات {len(drifted)} فاتورة لا تطابق أسطرها ولم تُعدل: {drifted[:20]}')
+
+    SystemSettings.set_setting('invoice_totals_report', json.dumps({
+        'checked_at': started_at.isoformat(),
+        'fixed_count': len(fixed),
+        'drifted_count': len(drifted),
+        'drifted_ids': drifted[:50]
+    }))
+    SystemSettings.set_setting('invoice_totals_verified_at', started_at.isoformat())
+
+
+def schedule_totals_verification(app):
+    """جدولة التحقق اليومي من إجماليات الفواتير"""
+    register_job('invoice_totals', verify_invoice_totals_job, lambda: daily_at(3))
+
+
+def summarize_invoice_list(*criteria):
+    """عدد الفواتير وإجماليات غير الملغاة منها باستعلام تجميعي واحد بنفس شروط القائمة"""
+    active = Invoice.is_cancelled == False
+    row = db.session.query(
+        func.count(Invoice.id).label('count'),
+        func.coalesce(func.sum(case((active, Invoice.total_amount), else_=0)), 0).label('total_amount'),
+        func.coalesce(func.sum(case((active, Invoice.vat_amount), else_=0)), 0).label('vat_amount'),
+        func.coalesce(func.sum(case((active, Invoice.withholding_amount), else_=0)), 0).label('withholding_amount')
+    ).filter(*criteria).one()
+    return row._asdict()
+
+
+# مهام إعادة حساب الضرائب بعد تعديل منتج (داخل العملية الحالية)
+RERATE_CHUNK_SIZE = 500
+
+# حالة مهام إعادة الحساب في ملفات JSON ليقرأها أي عامل (worker)
+RERATE_JOBS_DIR = os.path.join('instance', 'rerate_jobs')
+
+# المهمة الجارية التي لم تُحدَّث حالتها خلال هذه المدة توقف عاملها (بالثواني)
+RERATE_STALE_SECONDS = 600
+
+# عدد ملفات المهام المنتهية التي تُحفظ
+RERATE_FINISHED_KEPT = 20
+
+
+def get_locked_until():
+    """تاريخ إقفال الفواتير (الفواتير حتى هذا التاريخ نهائية)"""
+    value = SystemSettings.get_setting('invoices_locked_until')
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+
+def find_open_invoice_lines(product_id):
+    """أسطر المنتج في الفواتير غير الملغاة وغير المقفلة (عبر فهرس product_id)
+
+    تعيد أزواج (invoice_id, item_id) مرتبة حسب الفاتورة.
+    """
+    query = db.session.query(InvoiceItem.invoice_id, InvoiceItem.id).join(
+        Invoice, Invoice.id == InvoiceItem.invoice_id
+    ).filter(
+        InvoiceItem.product_id == product_id,
+        Invoice.is_cancelled == False
+    )
+    locked_until = get_locked_until()
+    if locked_until:
+        query = query.filter(Invoice.invoice_date > locked_until)
+    return sorted(query.all())
+
+
+def recalculate_invoices_totals(invoice_ids):
+    """إعادة حساب إجماليات مجموعة فواتير من أسطرها بتحديثات SQL مجمّعة"""
+    invoices = Invoice.__table__
+    items = InvoiceItem.__table__
+
+    def items_sum(column, *criteria):
+        return select(func.coalesce(func.sum(column), 0)).where(
+            items.c.invoice_id == invoices.c.id, *criteria
+        ).scalar_subquery()
+
+    in_chunk = invoices.c.id.in_(invoice_ids)
+    db.session.execute(
+        invoices.update().where(in_chunk).values(
+            subtotal=items_sum(items.c.line_total),
+            vat_amount=items_sum(items.c.line_tax, items.c.tax_type == TaxType.VAT),
+            withholding_amount=items_sum(items.c.line_tax, items.c.tax_type == TaxType.WITHHOLDING),
+            vat_base=items_sum(items.c.line_total, items.c.tax_type == TaxType.VAT),
+            withholding_base=items_sum(items.c.line_total, items.c.tax_type == TaxType.WITHHOLDING),
+            updated_at=datetime.utcnow()
+        )
+    )
+    # total_amount في تحديث مستقل لأن SET يقرأ القيم القديمة في نفس الجملة
+    db.session.execute(
+        invoices.update().where(in_chunk).values(
+            total_amount=invoices.c.subtotal + invoices.c.vat_amount + invoices.c.withholding_amount
+        )
+    )
+
+
+def rerate_product_invoices(product_id, old_price=None, chunk_size=RERATE_CHUNK_SIZE, progress=None):
+    """تحديث لقطة ضريبة المنتج وأسعاره في الفواتير المفتوحة وإعادة حساب إجمالياتها
+
+    الأسطر التي سعرها يساوي السعر القديم للمنتج تأخذ السعر الجديد، أما الأسعار
+    المعدلة يدوياً فتبقى كما هي. كل دفعة تُحفظ في معاملة قصيرة مستقلة.
+    """
+    product = db.session.get(Product, product_id)
+    if product is None:
+        return 0
+
+    items = InvoiceItem.__table__
+    lines_by_invoice = defaultdict(list)
+    for invoice_id, item_id in find_open_invoice_lines(product_id):
+        lines_by_invoice[invoice_id].append(item_id)
+    invoice_ids = list(lines_by_invoice)
+    if progress:
+        progress(0, len(invoice_ids))
+
+    reprice = old_price is not None and Decimal(old_price) != Decimal(product.price)
+
+    for start in range(0, len(invoice_ids), chunk_size):
+        chunk = invoice_ids[start:start + chunk_size]
+        # التحديث بالمفتاح الأساسي للأسطر بدلاً من إعادة مسح فهرس المنتج لكل دفعة
+        item_ids = [item_id for invoice_id in chunk for item_id in lines_by_invoice[invoice_id]]
+        product_lines = items.c.id.in_(item_ids)
+
+        if reprice:
+            db.session.execute(
+                items.update()
+                .where(product_lines, items.c.unit_price == old_price)
+                .values(
+                    unit_price=product.price,
+                    line_total=func.round(
+                        items.c.quantity * product.price
+                        * (100 - func.coalesce(items.c.discount_percentage, 0)) / 100, 2
+                    )
+                )
+            )
+
+        db.session.execute(
+            items.update()
+            .where(product_lines)
+            .values(
+                tax_type=product.tax_type,
+                tax_rate=product.tax_rate,
+                line_tax=func.round(items.c.line_total * product.tax_rate / 100, 2)
+            )
+        )
+        recalculate_invoices_totals(chunk)
+        # فروق إعادة التسعير لا تُحسب هنا، فيعيد المتصفح تحميل الإحصائيات
+        queue_event(db.session, 'stats_reset', {})
+        db.session.commit()
+
+        if progress:
+            progress(min(start + chunk_size, len(invoice_ids)), len(invoice_ids))
+
+    return len(invoice_ids)
+
+
+def rerate_job_path(job_id):
+    return os.path.join(RERATE_JOBS_DIR, f'{job_id}.json')
+
+
+def write_rerate_job(job):
+    os.makedirs(RERATE_JOBS_DIR, exist_ok=True)
+    path = rerate_job_path(job['id'])
+    temp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(job, f, ensure_ascii=False)
+    os.replace(temp_path, path)
+
+
+def read_rerate_job(job_id):
+    """حالة مهمة إعادة الحساب من ملفها، أو None
+
+    المهمة الجارية التي توقف تحديث ملفها (إعادة تشغيل الخادم مثلاً) تُسجل كمنقطعة.
+    """
+    if not job_id.isalnum():
+        return None
+    path = rerate_job_path(job_id)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            job = json.load(f)
+        modified = os.path.getmtime(path)
+    except (OSError, ValueError):
+        return None
+    if job['status'] in ('pending', 'running') and time.time() - modified > RERATE_STALE_SECONDS:
+        job.update({'status': 'failed', 'error': 'انقطعت العملية قبل اكتمالها', 'finished_at': datetime.utcnow().isoformat()})
+        write_rerate_job(job)
+    return job
+
+
+def prune_rerate_jobs(keep=RERATE_FINISHED_KEPT):
+    """حذف ملفات المهام المنتهية الأقدم مع الإبقاء على آخر keep منها"""
+    if not os.path.exists(RERATE_JOBS_DIR):
+        return
+    job_ids = [
+        filename[:-len('.json')]
+        for filename in os.listdir(RERATE_JOBS_DIR) if filename.endswith('.json')
+    ]
+    finished = []
+    for job_id in job_ids:
+        job = read_rerate_job(job_id)
+        if job and job['status'] not in ('pending', 'running'):
+            finished.append((job['finished_at'] or '', job_id))
+    finished.sort(reverse=True)
+    for _, job_id in finished[keep:]:
+        try:
+            os.remove(rerate_job_path(job_id))
+        except FileNotFoundError:
+            pass
+
+
+def run_product_rerating(app, job, old_price=None):
+    """تنفيذ مهمة إعادة الحساب في الخلفية مع تحديث حالة التقدم"""
+    def progress(processed, total):
+        job['processed'] = processed
+        job['total'] = total
+        write_rerate_job(job)
+
+    with app.app_context():
+        job['status'] = 'running'
+        write_rerate_job(job)
+        try:
+            rerate_product_invoices(job['product_id'], old_price=old_price, progress=progress)
+            job['status'] = 'completed'
+        except Exception as e:
+            db.session.rollback()
+            job['status'] = 'failed'
+            job['error'] = str(e)
+            print(f'خطأ في إعادة حساب ضرائب فواتير المنتج {job["product_id"]}: {str(e)}')
+        finally:
+            job['finished_at'] = datetime.utcnow().isoformat()
+            write_rerate_job(job)
+            db.session.remove()
+            prune_rerate_jobs()
+
+
+def start_product_rerating(app, product_id, old_price=None):
+    """بدء مهمة خلفية لإعادة حساب الفواتير المفتوحة بعد تعديل المنتج"""
+    job = {
+        'id': uuid.uuid4().hex,
+        'product_id': product_id,
+        'status': 'pending',
+        'processed': 0,
+        'total': 0,
+        'error': None,
+        'started_at': datetime.utcnow().isoformat(),
+        'finished_at': None
+    }
+    write_rerate_job(job)
+
+    thread = threading.Thread(target=run_product_rerating, args=(app, job, old_price), daemon=True)
+    thread.start()
+    return job
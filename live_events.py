@@ -0,0 +1,330 @@
+import json
+import threading
+from collections import deque, defaultdict
+from datetime import datetime
+from sqlalchemy import event, inspect, insert, update, func
+from sqlalchemy.orm import Session
+from models import db, Invoice, Counter, LiveEvent
+from pagination import invalidate_summaries
+
+# ثوانٍ بين رسائل النبض للحفاظ على الاتصال مفتوحاً عبر البروكسيات
+HEARTBEAT_INTERVAL = 15
+
+# ثوانٍ بين استطلاعين لجدول الأحداث في كل عامل
+POLL_INTERVAL = 1
+
+# عدد الأحداث المحفوظة في الذاكرة لإعادة إرسالها عند إعادة الاتصال
+EVENT_BUFFER_SIZE = 500
+
+# عدد الأحداث المحفوظة في القاعدة؛ الأقدم منها يُحذف كل PRUNE_EVERY حدثاً
+EVENTS_KEPT = 5000
+PRUNE_EVERY = 1000
+
+# الحد الأقصى للاتصالات المفتوحة في العملية الواحدة
+MAX_CONNECTIONS = 100
+
+# حقول الإجماليات التي تُرسل فروقها للمتصفح
+TOTAL_FIELDS = ('total_amount', 'vat_amount', 'withholding_amount')
+
+
+class TooManyConnections(Exception):
+    """تم بلوغ الحد الأقصى لاتصالات البث"""
+
+
+def write_events(connection, events):
+    """حفظ أحداث (النوع، البيانات) في جدول live_events بمعرفات متسلسلة
+
+    المعرفات تُحجز بتحديث صف عداد live_events، فيبقى الصف مقفلاً حتى نهاية
+    المعاملة: تُحفظ الأحداث بترتيب معرفاتها ولا يتخطى الاستطلاع حدثاً لم
+    تكتمل معاملته بعد، والمعاملة الملغاة تُرجع المعرفات فلا تظهر فجوات.
+    """
+    counters = Counter.__table__
+    events_table = LiveEvent.__table__
+    last_id = connection.execute(
+        update(counters)
+        .where(counters.c.name == 'live_events')
+        .values(value=func.coalesce(counters.c.value, 0) + len(events))
+        .returning(counters.c.value)
+    ).scalar()
+    if last_id is None:
+        # قبل تهيئة العداد (seed_live_event_counter)
+        last_id = (connection.execute(func.max(events_table.c.id).select()).scalar() or 0) + len(events)
+        connection.execute(insert(counters).values(name='live_events', value=last_id))
+
+    first_id = last_id - len(events) + 1
+    now = datetime.utcnow()
+    connection.execute(insert(events_table), [
+        {'id': first_id + offset, 'event_type': event_type,
+         'data': json.dumps(data, ensure_ascii=False), 'created_at': now}
+        for offset, (event_type, data) in enumerate(events)
+    ])
+
+    if last_id // PRUNE_EVERY != (first_id - 1) // PRUNE_EVERY:
+        connection.execute(events_table.delete().where(events_table.c.id <= last_id - EVENTS_KEPT))
+    return last_id
+
+
+class EventBroadcaster:
+    """موزع أحداث يغذي اتصالات SSE المفتوحة في العملية من جدول live_events
+
+    الأحداث تُحفظ في القاعدة مع المعاملة التي أنتجتها، وخيط في كل عامل يستطلع
+    الجدول وينقل الجديد إلى ذاكرة دائرية، فيصل كل حدث إلى كل العمال. معرف الحدث
+    هو معرفه في الجدول، مشترك بين العمال فيصلح Last-Event-ID على أي منها.
+    """
+
+    def __init__(self, buffer_size=EVENT_BUFFER_SIZE, max_connections=MAX_CONNECTIONS,
+                 poll_interval=POLL_INTERVAL):
+        self.events = deque(maxlen=buffer_size)
+        self.sequence = None  # آخر معرف مقروء، None قبل أول استطلاع
+        self.anchor = None  # created_at لآخر حدث مقروء، لاكتشاف استبدال الجدول (الاستعادة)
+        self.epoch = 0  # يزيد عند استبدال الجدول فتعيد الاتصالات تحميل الإحصائيات
+        self.connections = 0
+        self.max_connections = max_connections
+        self.poll_interval = poll_interval
+        self.condition = threading.Condition()
+        self.poll_requested = threading.Event()
+        self.started = False
+
+    def start(self, app):
+        """بدء خيط الاستطلاع مرة واحدة في كل عملية"""
+        with self.condition:
+            if self.started:
+                return
+            self.started = True
+
+        def loop():
+            while True:
+                try:
+                    with app.app_context():
+                        self.poll()
+                except Exception as e:
+                    print(f'خطأ في استطلاع أحداث البث: {str(e)}')
+                self.poll_requested.wait(self.poll_interval)
+                self.poll_requested.clear()
+
+        threading.Thread(target=loop, name='live-events', daemon=True).start()
+
+    def request_poll(self):
+        """استطلاع فوري (بعد commit في هذا العامل) بدلاً من انتظار الموعد التالي"""
+        self.poll_requested.set()
+
+    def poll(self):
+        """نقل الأحداث الجديدة من الجدول إلى الذاكرة وإيقاظ الاتصالات"""
+        if self.sequence:
+            anchor = db.session.query(LiveEvent.created_at).filter(LiveEvent.id == self.sequence).scalar()
+            if anchor != self.anchor:
+                # الجدول استُبدل (استعادة نسخة) أو حُذف آخر حدث مقروء
+                latest = db.session.query(LiveEvent.id, LiveEvent.created_at).order_by(LiveEvent.id.desc()).first()
+                with self.condition:
+                    self.events.clear()
+                    self.sequence, self.anchor = latest if latest else (0, None)
+                    self.epoch += 1
+                    self.condition.notify_all()
+                invalidate_summaries('dashboard')
+                invalidate_summaries('invoices_list')
+                return
+
+        if self.sequence is None:
+            latest = db.session.query(LiveEvent.id, LiveEvent.created_at).order_by(LiveEvent.id.desc()).first()
+            with self.condition:
+                self.sequence, self.anchor = latest if latest else (0, None)
+                self.condition.notify_all()
+            return
+
+        rows = db.session.query(
+            LiveEvent.id, LiveEvent.event_type, LiveEvent.data, LiveEvent.created_at
+        ).filter(LiveEvent.id > self.sequence).order_by(LiveEvent.id.desc()).limit(self.events.maxlen).all()
+        if not rows:
+            return
+        rows.reverse()
+
+        with self.condition:
+            self.events.extend((row.id, row.event_type, row.data) for row in rows)
+            self.sequence, self.anchor = rows[-1].id, rows[-1].created_at
+            self.condition.notify_all()
+        # تغييرات من عمال آخرين: الإجماليات المخزنة في هذا العامل لم تعد صحيحة
+        invalidate_summaries('dashboard')
+        invalidate_summaries('invoices_list')
+
+    def publish(self, event_type, data):
+        """نشر حدث خارج جلسة ORM (بعد الاستعادة مثلاً) في معاملة مستقلة"""
+        with db.engine.begin() as conn:
+            write_events(conn, [(event_type, data)])
+        self.request_poll()
+
+    def current_event_id(self):
+        """معرف آخر حدث محفوظ، يُرسل مع الصفحة ليبدأ المتصفح البث من عنده"""
+        return str(db.session.query(func.max(LiveEvent.id)).scalar() or 0)
+
+    def parse_event_id(self, last_event_id):
+        try:
+            return int(last_event_id)
+        except (TypeError, ValueError):
+            return None
+
+    def format_event(self, sequence, event_type, data):
+        return f'id: {sequence}\nevent: {event_type}\ndata: {data}\n\n'
+
+    def acquire(self):
+        with self.condition:
+            if self.connections >= self.max_connections:
+                raise TooManyConnections()
+            self.connections += 1
+
+    def release(self):
+        with self.condition:
+            self.connections -= 1
+
+    def stream(self, last_event_id=None, heartbeat=HEARTBEAT_INTERVAL):
+        """مولد رسائل SSE لاتصال واحد
+
+        يُستدعى acquire قبله، و release عند إغلاق الرد (call_on_close) لأن
+        المولد قد يُغلق قبل أن يبدأ فلا يصل إلى finally.
+        """
+        yield 'retry: 5000\n\n'
+
+        position = self.parse_event_id(last_event_id)
+        with self.condition:
+            # معرف أحدث مما قرأه هذا العامل (صفحة من عامل آخر): انتظار استطلاع قبل الحكم بفوات أحداث
+            if self.sequence is None or (position is not None and position > self.sequence):
+                self.request_poll()
+                self.condition.wait_for(
+                    lambda: self.sequence is not None and (position is None or position <= self.sequence),
+                    timeout=self.poll_interval * 3
+                )
+            epoch = self.epoch
+            sequence = self.sequence or 0
+            oldest = self.events[0][0] if self.events else sequence + 1
+            # فاتت المتصفح أحداث لم تعد محفوظة (أو استُبدلت القاعدة): يعيد تحميل الإحصائيات كاملة
+            missed = bool(last_event_id) and (
+                position is None or position < oldest - 1 or position > sequence
+            )
+            if missed or position is None:
+                position = sequence
+
+        if missed:
+            yield self.format_event(position, 'stats_reset', '{}')
+
+        while True:
+            with self.condition:
+                pending = [item for item in self.events if item[0] > position]
+                if not pending and self.epoch == epoch:
+                    self.condition.wait(timeout=heartbeat)
+                    pending = [item for item in self.events if item[0] > position]
+                if self.epoch != epoch or (pending and pending[0][0] > position + 1):
+                    # استُبدل الجدول أو تجاوزت الأحداث الجديدة سعة الذاكرة
+                    epoch = self.epoch
+                    position = self.sequence
+                    pending = [(position, 'stats_reset', '{}')]
+
+            if not pending:
+                yield ': heartbeat\n\n'
+                continue
+
+            for sequence, event_type, data in pending:
+                position = sequence
+                yield self.format_event(sequence, event_type, data)
+
+
+broadcaster = EventBroadcaster()
+
+
+def queue_event(session, event_type, data):
+    """إضافة حدث يُحفظ مع commit الجلسة (في نفس المعاملة)"""
+    session.info.setdefault('live_events', []).append((event_type, data))
+
+
+def invoice_contribution(invoice_date, is_cancelled, totals, count=1):
+    """مساهمة فاتورة في عدادات لوحة التحكم (لا شيء للفواتير الملغاة)"""
+    if is_cancelled or invoice_date is None:
+        return None
+    return invoice_date, dict({'invoices_count': count}, **{field: float(totals[field] or 0) for field in TOTAL_FIELDS})
+
+
+def contribution_deltas(added=(), removed=()):
+    """فروق العدادات مجمّعة حسب التاريخ من المساهمات المضافة والمطروحة"""
+    deltas = defaultdict(lambda: dict.fromkeys(('invoices_count',) + TOTAL_FIELDS, 0))
+    for sign, contributions in ((1, added), (-1, removed)):
+        for contribution in contributions:
+            if contribution:
+                date, values = contribution
+                for key, value in values.items():
+                    deltas[date][key] += sign * value
+
+    return [
+        dict(values, date=date.isoformat())
+        for date, values in deltas.items()
+        if any(abs(value) > 0.000001 for value in values.values())
+    ]
+
+
+def previous_value(state, name):
+    history = state.attrs[name].history
+    if history.deleted:
+        return history.deleted[0]
+    if history.unchanged:
+        return history.unchanged[0]
+    return getattr(state.obj(), name)
+
+
+@event.listens_for(Session, 'after_flush')
+def collect_invoice_events(session, flush_context):
+    """تحويل تغييرات الفواتير عبر ORM إلى أحداث فروق"""
+    for invoice in session.new:
+        if isinstance(invoice, Invoice):
+            new = invoice_contribution(invoice.invoice_date, invoice.is_cancelled,
+                                       {field: getattr(invoice, field) for field in TOTAL_FIELDS})
+            deltas = contribution_deltas(added=[new])
+            queue_event(session, 'invoice_created', {'invoice_id': invoice.id, 'deltas': deltas})
+
+    for invoice in session.dirty:
+        if not isinstance(invoice, Invoice) or not session.is_modified(invoice):
+            continue
+        state = inspect(invoice)
+        old = invoice_contribution(
+            previous_value(state, 'invoice_date'), previous_value(state, 'is_cancelled'),
+            {field: previous_value(state, field) for field in TOTAL_FIELDS}
+        )
+        new = invoice_contribution(invoice.invoice_date, invoice.is_cancelled,
+                                   {field: getattr(invoice, field) for field in TOTAL_FIELDS})
+        deltas = contribution_deltas(added=[new], removed=[old])
+        if deltas:
+            event_type = 'invoice_cancelled' if invoice.is_cancelled and old else 'totals_changed'
+            queue_event(session, event_type, {'invoice_id': invoice.id, 'deltas': deltas})
+
+    for invoice in session.deleted:
+        if isinstance(invoice, Invoice):
+            state = inspect(invoice)
+            old = invoice_contribution(
+                previous_value(state, 'invoice_date'), previous_value(state, 'is_cancelled'),
+                {field: previous_value(state, field) for field in TOTAL_FIELDS}
+            )
+            queue_event(session, 'totals_changed', {'invoice_id': invoice.id, 'deltas': contribution_deltas(removed=[old])})
+
+
+@event.listens_for(Session, 'before_commit')
+def save_queued_events(session):
+    """حفظ الأحداث في نفس معاملة التغيير، فلا يُنشر تغيير لم يُحفظ ولا يضيع تغيير محفوظ"""
+    # الأحداث الناتجة عن تغييرات ORM المعلقة تُجمع عند flush
+    session.flush()
+    events = session.info.pop('live_events', [])
+    if events:
+        write_events(session.connection(), events)
+        session.info['live_events_saved'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def publish_queued_events(session):
+    if not session.info.pop('live_events_saved', False):
+        return
+
+    # الإجماليات المخزنة في هذا العامل لم تعد صحيحة؛ العمال الآخرون يحذفونها عند الاستطلاع
+    invalidate_summaries('dashboard')
+    invalidate_summaries('invoices_list')
+    broadcaster.request_poll()
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_queued_events(session):
+    session.info.pop('live_events', None)
+    session.info.pop('live_events_saved', None)
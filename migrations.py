@@ -0,0 +1,299 @@
+from sqlalchemy import inspect, text, func, and_, or_, select, insert
+from sqlalchemy.exc import IntegrityError
+import uuid
+from models import db, Product, Invoice, InvoiceItem, TaxType, Customer, User, Counter, LiveEvent
+from search import backfill_search_text, setup_search_index
+from customers import customer_key, resolve_customers
+
+
+def upgrade_schema():
+    """إضافة الأعمدة والفهارس الجديدة إلى الجداول الموجودة مسبقاً
+
+    db.create_all() ينشئ الجداول الجديدة فقط ولا يعدل الجداول القائمة، لذلك
+    تُضاف هنا الأعمدة الناقصة (كأعمدة تقبل NULL ثم تُعبَّأ بمهام التعبئة).
+    """
+    # الجداول الناقصة (مثلاً بعد استعادة قاعدة من نسخة أقدم)
+    db.create_all()
+    inspector = inspect(db.engine)
+    existing_tables = set(inspector.get_table_names())
+    preparer = db.engine.dialect.identifier_preparer
+
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+
+            existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                ddl = f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {preparer.format_column(column)} {column_type}'
+                if column.server_default is not None:
+                    ddl += f' DEFAULT {column.server_default.arg}'
+                conn.execute(text(ddl))
+
+        # الفهارس الفريدة للعملاء تتطلب دمج المكررين من قبل إضافتها
+        if 'customers' in existing_tables:
+            merge_duplicate_customers(conn)
+            conn.execute(text('DROP INDEX IF EXISTS ix_customers_tax_id'))
+
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+
+def merge_duplicate_customers(conn):
+    """دمج العملاء المكررين بنفس المفتاح (الرقم الضريبي، أو الاسم المطبّع بدونه) في أقدمهم
+
+    الفواتير التي كانت تعرض عنوان العميل المكرر تأخذه كلقطة قبل نقلها.
+    """
+    customers = Customer.__table__
+    invoices = Invoice.__table__
+
+    def duplicate_groups(key_column, *criteria):
+        return conn.execute(
+            select(key_column, func.min(customers.c.id))
+            .where(key_column.isnot(None), *criteria)
+            .group_by(key_column).having(func.count() > 1)
+        ).all()
+
+    groups = [
+        (customers.c.tax_id == tax_id, keeper_id)
+        for tax_id, keeper_id in duplicate_groups(customers.c.tax_id)
+    ] + [
+        (and_(customers.c.normalized_name == name, customers.c.tax_id.is_(None)), keeper_id)
+        for name, keeper_id in duplicate_groups(customers.c.normalized_name, customers.c.tax_id.is_(None))
+    ]
+
+    for same_key, keeper_id in groups:
+        duplicates = conn.execute(
+            select(customers.c.id, customers.c.address).where(same_key, customers.c.id != keeper_id)
+            .order_by(customers.c.id)
+        ).all()
+        duplicate_ids = [row.id for row in duplicates]
+
+        conn.execute(
+            invoices.update()
+            .where(invoices.c.customer_id.in_(duplicate_ids), invoices.c.customer_address.is_(None))
+            .values(customer_address=select(customers.c.address).where(
+                customers.c.id == invoices.c.customer_id
+            ).scalar_subquery())
+        )
+        address = next((row.address for row in duplicates if row.address), None)
+        if address:
+            conn.execute(
+                customers.update()
+                .where(customers.c.id == keeper_id, customers.c.address.is_(None))
+                .values(address=address)
+            )
+        conn.execute(invoices.update().where(invoices.c.customer_id.in_(duplicate_ids)).values(customer_id=keeper_id))
+        conn.execute(customers.delete().where(customers.c.id.in_(duplicate_ids)))
+
+
+def product_value(product_column):
+    """استعلام فرعي يقرأ قيمة من منتج السطر الحالي"""
+    products = Product.__table__
+    items = InvoiceItem.__table__
+    return select(product_column).where(products.c.id == items.c.product_id).scalar_subquery()
+
+
+def backfill_invoice_item_snapshots(chunk_size=5000):
+    """تعبئة لقطة الضريبة (النوع، المعدل، إجمالي السطر، ضريبته) للأسطر القديمة
+
+    التعبئة تتم بتحديثات SQL على دفعات حسب المعرف حتى لا تُقفل الجدول طويلاً.
+    """
+    items = InvoiceItem.__table__
+    products = Product.__table__
+
+    pending = db.session.execute(
+        select(items.c.id).where(items.c.line_tax.is_(None)).limit(1)
+    ).first()
+    if not pending:
+        return 0
+
+    max_id = db.session.query(func.max(InvoiceItem.id)).scalar() or 0
+    updated = 0
+
+    for start in range(0, max_id, chunk_size):
+        in_chunk = and_(items.c.id > start, items.c.id <= start + chunk_size)
+
+        result = db.session.execute(
+            items.update()
+            .where(in_chunk, items.c.line_total.is_(None))
+            .values(
+                tax_type=product_value(products.c.tax_type),
+                tax_rate=product_value(products.c.tax_rate),
+                line_total=func.round(
+                    items.c.quantity * items.c.unit_price
+                    * (100 - func.coalesce(items.c.discount_percentage, 0)) / 100, 2
+                )
+            )
+        )
+        updated += result.rowcount
+
+        db.session.execute(
+            items.update()
+            .where(in_chunk, items.c.line_tax.is_(None))
+            .values(line_tax=func.round(items.c.line_total * items.c.tax_rate / 100, 2))
+        )
+        db.session.commit()
+
+    return updated
+
+
+def backfill_invoice_tax_bases(chunk_size=5000):
+    """تعبئة الأوعية الضريبية (vat_base, withholding_base) للفواتير القديمة
+
+    تُعالج فقط الفواتير التي عليها ضريبة ووعاؤها صفر، فتكون المهمة آمنة
+    للتشغيل المتكرر عند كل بدء للتطبيق.
+    """
+    invoices = Invoice.__table__
+    items = InvoiceItem.__table__
+
+    needs_backfill = or_(
+        and_(invoices.c.vat_amount != 0, invoices.c.vat_base == 0),
+        and_(invoices.c.withholding_amount != 0, invoices.c.withholding_base == 0)
+    )
+    pending = db.session.execute(select(invoices.c.id).where(needs_backfill).limit(1)).first()
+    if not pending:
+        return 0
+
+    def base_for(tax_type):
+        return select(func.coalesce(func.sum(items.c.line_total), 0)).where(
+            items.c.invoice_id == invoices.c.id,
+            items.c.tax_type == tax_type
+        ).scalar_subquery()
+
+    max_id = db.session.query(func.max(Invoice.id)).scalar() or 0
+    updated = 0
+
+    for start in range(0, max_id, chunk_size):
+        result = db.session.execute(
+            invoices.update()
+            .where(invoices.c.id > start, invoices.c.id <= start + chunk_size, needs_backfill)
+            .values(vat_base=base_for(TaxType.VAT), withholding_base=base_for(TaxType.WITHHOLDING))
+        )
+        updated += result.rowcount
+        db.session.commit()
+
+    return updated
+
+
+def backfill_customers(chunk_size=2000):
+    """ربط الفواتير القديمة بجدول العملاء مع دمج الأسماء المكررة
+
+    الأسماء توحَّد بالتطبيع (أو بالرقم الضريبي إن وُجد). أول عنوان يصبح العنوان
+    الافتراضي للعميل، ويبقى عنوان كل فاتورة فيها كلقطة.
+    """
+    last_id = 0
+    linked = 0
+
+    while True:
+        rows = db.session.query(
+            Invoice.id, Invoice.customer_name, Invoice.customer_tax_id, Invoice.customer_address
+        ).filter(
+            Invoice.id > last_id, Invoice.customer_id.is_(None)
+        ).order_by(Invoice.id).limit(chunk_size).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        # العناوين تُعالج أدناه حتى لا يستبدل عنوان فاتورة قديمة عنوان العميل
+        customer_ids = resolve_customers([
+            (row.customer_name, row.customer_tax_id, None) for row in rows
+        ])
+        addresses = dict(db.session.query(Customer.id, Customer.address).filter(
+            Customer.id.in_(set(customer_ids.values()))
+        ).all())
+
+        invoice_updates = []
+        customer_updates = {}
+        for row in rows:
+            customer_id = customer_ids.get(customer_key(row.customer_name, row.customer_tax_id))
+            if customer_id is None:
+                continue
+
+            address = row.customer_address
+            if address and not addresses.get(customer_id):
+                addresses[customer_id] = address
+                customer_updates[customer_id] = address
+
+            invoice_updates.append({'id': row.id, 'customer_id': customer_id})
+
+        db.session.bulk_update_mappings(Customer, [
+            {'id': customer_id, 'address': address} for customer_id, address in customer_updates.items()
+        ])
+        db.session.bulk_update_mappings(Invoice, invoice_updates)
+        db.session.commit()
+        linked += len(invoice_updates)
+
+    return linked
+
+
+def backfill_security_stamps():
+    """ختم أمان للمستخدمين القدامى (الجلسات السابقة تتطلب تسجيل الدخول مرة واحدة)"""
+    users = User.__table__
+    user_ids = db.session.scalars(select(users.c.id).where(users.c.security_stamp.is_(None))).all()
+    for user_id in user_ids:
+        db.session.execute(
+            users.update().where(users.c.id == user_id).values(security_stamp=uuid.uuid4().hex)
+        )
+    db.session.commit()
+
+
+def seed_counter(name, last_id):
+    """إنشاء صف العداد إن لم يوجد ورفع قيمته إلى last_id على الأقل
+
+    لا يقل العداد عن أكبر معرف مستخدم، فلا تتكرر القيم بعد استعادة بيانات أحدث منه.
+    """
+    counters = Counter.__table__
+    if db.session.get(Counter, name) is None:
+        try:
+            db.session.execute(insert(counters).values(name=name, value=last_id))
+            db.session.commit()
+        except IntegrityError:
+            # عامل آخر أنشأه في نفس اللحظة
+            db.session.rollback()
+    if last_id:
+        db.session.execute(
+            counters.update()
+            .where(counters.c.name == name, or_(counters.c.value.is_(None), counters.c.value < last_id))
+            .values(value=last_id)
+        )
+        db.session.commit()
+
+
+def seed_invoice_counter():
+    """عداد أرقام الفواتير من أكبر معرف فاتورة (الترقيم القديم كان معرف الفاتورة)"""
+    seed_counter('invoice_number', db.session.query(func.max(Invoice.id)).scalar())
+
+
+def seed_live_event_counter():
+    """عداد معرفات أحداث البث المباشر من أكبر معرف محفوظ"""
+    seed_counter('live_events', db.session.query(func.max(LiveEvent.id)).scalar())
+
+
+def enable_sqlite_wal():
+    """وضع WAL لقاعدة SQLite (يُحفظ في الملف): القراءة والنسخ الاحتياطي لا يمنعان الكتابة"""
+    if db.engine.dialect.name != 'sqlite':
+        return
+    with db.engine.connect() as conn:
+        conn.exec_driver_sql('PRAGMA journal_mode=WAL')
+
+
+def upgrade_database():
+    """تحديث هيكل قاعدة البيانات وتعبئة البيانات المشتقة"""
+    enable_sqlite_wal()
+    upgrade_schema()
+    backfill_invoice_item_snapshots()
+    backfill_invoice_tax_bases()
+    backfill_search_text()
+    backfill_customers()
+    backfill_security_stamps()
+    seed_invoice_counter()
+    seed_live_event_counter()
+    setup_search_index()
@@ -1,7 +1,9 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from datetime import datetime
-from werkzeug.security import generate_password_hash, check_password_hash
+import uuid
+from sqlalchemy import event, inspect
+from passwords import hash_password, verify_password
 from enum import Enum
 
 db = SQLAlchemy()
@@ -15,6 +17,29 @@ class TaxType(Enum):
     VAT = "vat"  # ضريبة القيمة المضافة 14%
     WITHHOLDING = "withholding"  # ضريبة الخصم والإضافة 5%
 
+# صلاحيات كل دور كمجموعات ثابتة تُبنى مرة واحدة عند تحميل الوحدة
+ROLE_PERMISSIONS = {
+    UserRole.ADMIN: frozenset([
+        'create_invoice', 'edit_invoice', 'delete_invoice', 'view_invoice',
+        'create_product', 'edit_product', 'delete_product', 'view_product',
+        'create_user', 'edit_user', 'delete_user', 'view_user',
+        'view_reports', 'export_reports', 'backup_system', 'restore_system',
+        'manage_settings'
+    ]),
+    UserRole.ACCOUNTANT: frozenset([
+        'create_invoice', 'edit_invoice', 'view_invoice',
+        'create_product', 'edit_product', 'view_product',
+        'view_reports', 'export_reports'
+    ]),
+    UserRole.USER: frozenset([
+        'create_invoice', 'view_invoice',
+        'view_product'
+    ])
+}
+
+# الحقول التي يؤدي تغييرها إلى تجديد ختم الأمان
+SECURITY_STAMP_FIELDS = ('role', 'password_hash', 'is_active')
+
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
     
@@ -26,41 +51,45 @@ class User(UserMixin, db.Model):
     is_active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     last_login = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    security_stamp = db.Column(db.String(32), default=lambda: uuid.uuid4().hex)
     
     # العلاقات
     invoices = db.relationship('Invoice', foreign_keys='Invoice.created_by', backref='created_by_user', lazy=True)
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        valid, upgraded_hash = verify_password(password, self.password_hash)
+        if upgraded_hash:
+            # ترقية التجزئة للخوارزمية أو التكلفة الحالية (تُحفظ مع commit المستدعي)
+            # دون تجديد ختم الأمان لأن كلمة المرور نفسها لم تتغير
+            self.password_hash = upgraded_hash
+            self.upgraded_password_hash = upgraded_hash
+        return valid
     
     def has_permission(self, action):
         """فحص الصلاحيات"""
-        permissions = {
-            UserRole.ADMIN: [
-                'create_invoice', 'edit_invoice', 'delete_invoice', 'view_invoice',
-                'create_product', 'edit_product', 'delete_product', 'view_product',
-                'create_user', 'edit_user', 'delete_user', 'view_user',
-                'view_reports', 'export_reports', 'backup_system', 'restore_system',
-                'manage_settings'
-            ],
-            UserRole.ACCOUNTANT: [
-                'create_invoice', 'edit_invoice', 'view_invoice',
-                'create_product', 'edit_product', 'view_product',
-                'view_reports', 'export_reports'
-            ],
-            UserRole.USER: [
-                'create_invoice', 'view_invoice',
-                'view_product'
-            ]
-        }
-        return action in permissions.get(self.role, [])
+        return action in ROLE_PERMISSIONS.get(self.role, ())
+    
+    def get_id(self):
+        """معرف الجلسة: المعرف مع ختم الأمان، فتبطل الجلسات القديمة عند تغيير الدور أو كلمة المرور أو التفعيل"""
+        return f'{self.id}:{self.security_stamp}'
     
     def __repr__(self):
         return f'<User {self.username}>'
 
+@event.listens_for(User, 'before_update')
+def bump_security_stamp(mapper, connection, target):
+    """تجديد ختم الأمان عند تغيير الدور أو كلمة المرور أو حالة التفعيل"""
+    state = inspect(target)
+    changed = [field for field in SECURITY_STAMP_FIELDS if state.attrs[field].history.has_changes()]
+    if changed == ['password_hash'] and getattr(target, 'upgraded_password_hash', None) == target.password_hash:
+        return
+    if changed:
+        target.security_stamp = uuid.uuid4().hex
+
 class Product(db.Model):
     __tablename__ = 'products'
     
@@ -71,6 +100,7 @@ class Product(db.Model):
     tax_type = db.Column(db.Enum(TaxType), nullable=False)
     tax_rate = db.Column(db.Numeric(5, 2), nullable=False)  # معدل الضريبة
     is_active = db.Column(db.Boolean, default=True)
+    search_text = db.Column(db.Text)  # الاسم بعد التطبيع للبحث (انظر search.py)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
@@ -88,15 +118,42 @@ class Product(db.Model):
     def __repr__(self):
         return f'<Product {self.name}>'
 
+class Customer(db.Model):
+    __tablename__ = 'customers'
+    __table_args__ = (
+        # مفتاح إزالة التكرار فريد: الرقم الضريبي، أو الاسم المطبّع للعملاء بدون رقم ضريبي
+        db.Index('uq_customers_tax_id', 'tax_id', unique=True),
+        db.Index('uq_customers_normalized_name', 'normalized_name', unique=True,
+                 sqlite_where=db.text('tax_id IS NULL'), postgresql_where=db.text('tax_id IS NULL')),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)
+    normalized_name = db.Column(db.String(200), nullable=False, index=True)  # الاسم بعد التطبيع للبحث وإزالة التكرار
+    tax_id = db.Column(db.String(50))
+    address = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    # العلاقات
+    invoices = db.relationship('Invoice', backref='customer', lazy=True)
+    
+    def __repr__(self):
+        return f'<Customer {self.name}>'
+
 class Invoice(db.Model):
     __tablename__ = 'invoices'
+    __table_args__ = (
+        db.Index('ix_invoices_created_at_id', 'created_at', 'id'),  # ترقيم قائمة الفواتير بالمؤشرات
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     invoice_number = db.Column(db.String(50), unique=True, nullable=False)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customers.id'), index=True)
     customer_name = db.Column(db.String(200), nullable=False)
     customer_tax_id = db.Column(db.String(50))
-    customer_address = db.Column(db.Text)
-    invoice_date = db.Column(db.Date, nullable=False, default=datetime.utcnow().date())
+    customer_address = db.Column(db.Text)  # لقطة عنوان العميل وقت الفاتورة؛ العنوان الافتراضي في بيانات العميل
+    invoice_date = db.Column(db.Date, nullable=False, default=datetime.utcnow().date(), index=True)
     due_date = db.Column(db.Date)
     
     # المبالغ
@@ -104,9 +161,12 @@ class Invoice(db.Model):
     vat_amount = db.Column(db.Numeric(12, 2), nullable=False, default=0)  # ضريبة القيمة المضافة
     withholding_amount = db.Column(db.Numeric(12, 2), nullable=False, default=0)  # ضريبة الخصم والإضافة
     total_amount = db.Column(db.Numeric(12, 2), nullable=False, default=0)  # المبلغ الإجمالي
+    vat_base = db.Column(db.Numeric(12, 2), nullable=False, default=0, server_default='0')  # المبلغ الخاضع لضريبة القيمة المضافة
+    withholding_base = db.Column(db.Numeric(12, 2), nullable=False, default=0, server_default='0')  # المبلغ الخاضع لضريبة الخصم والإضافة
     
     # معلومات إضافية
     notes = db.Column(db.Text)
+    search_text = db.Column(db.Text)  # الرقم واسم العميل والرقم الضريبي بعد التطبيع (انظر search.py)
     is_cancelled = db.Column(db.Boolean, default=False)
     cancelled_at = db.Column(db.DateTime)
     cancelled_by = db.Column(db.Integer, db.ForeignKey('users.id'))
@@ -122,18 +182,28 @@ class Invoice(db.Model):
         self.subtotal = 0
         self.vat_amount = 0
         self.withholding_amount = 0
+        self.vat_base = 0
+        self.withholding_base = 0
         
         for item in self.items:
-            item_total = item.quantity * item.unit_price
-            self.subtotal += item_total
+            line_total = item.get_line_total()
+            self.subtotal += line_total
             
-            if item.product.tax_type == TaxType.VAT:
-                self.vat_amount += item.product.get_tax_amount(item_total)
-            elif item.product.tax_type == TaxType.WITHHOLDING:
-                self.withholding_amount += item.product.get_tax_amount(item_total)
+            if item.get_tax_type() == TaxType.VAT:
+                self.vat_amount += item.get_tax_amount()
+                self.vat_base += line_total
+            elif item.get_tax_type() == TaxType.WITHHOLDING:
+                self.withholding_amount += item.get_tax_amount()
+                self.withholding_base += line_total
         
         self.total_amount = self.subtotal + self.vat_amount + self.withholding_amount
     
+    def get_customer_address(self):
+        """عنوان العميل المحفوظ في الفاتورة، أو العنوان الافتراضي للعميل إن لم يُحفظ"""
+        if self.customer_address:
+            return self.customer_address
+        return self.customer.address if self.customer else None
+    
     def cancel_invoice(self, user_id):
         """إلغاء الفاتورة"""
         self.is_cancelled = True
@@ -147,23 +217,41 @@ class InvoiceItem(db.Model):
     __tablename__ = 'invoice_items'
     
     id = db.Column(db.Integer, primary_key=True)
-    invoice_id = db.Column(db.Integer, db.ForeignKey('invoices.id'), nullable=False)
-    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
+    invoice_id = db.Column(db.Integer, db.ForeignKey('invoices.id'), nullable=False, index=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False, index=True)
     quantity = db.Column(db.Numeric(10, 3), nullable=False)
     unit_price = db.Column(db.Numeric(10, 2), nullable=False)
     discount_percentage = db.Column(db.Numeric(5, 2), default=0)
     
+    # لقطة من بيانات الضريبة وقت كتابة السطر (لا تتأثر بتعديل المنتج لاحقاً)
+    tax_type = db.Column(db.Enum(TaxType), index=True)
+    tax_rate = db.Column(db.Numeric(5, 2))
+    line_total = db.Column(db.Numeric(12, 2))  # بعد الخصم
+    line_tax = db.Column(db.Numeric(12, 2))
+    
     def get_line_total(self):
         """حساب إجمالي السطر"""
+        if self.line_total is not None:
+            return self.line_total
         base_amount = self.quantity * self.unit_price
         discount_amount = base_amount * (self.discount_percentage / 100)
         return base_amount - discount_amount
     
     def get_tax_amount(self):
         """حساب ضريبة السطر"""
+        if self.line_tax is not None:
+            return self.line_tax
         line_total = self.get_line_total()
         return self.product.get_tax_amount(line_total)
     
+    def get_tax_type(self):
+        """نوع ضريبة السطر كما كان وقت كتابته"""
+        return self.tax_type or self.product.tax_type
+    
+    def get_tax_rate(self):
+        """معدل ضريبة السطر كما كان وقت كتابته"""
+        return self.tax_rate if self.tax_rate is not None else self.product.tax_rate
+    
     def __repr__(self):
         return f'<InvoiceItem {self.product.name} x {self.quantity}>'
 
@@ -228,10 +316,99 @@ class BackupLog(db.Model):
     backup_type = db.Column(db.String(50), nullable=False)  # manual, automatic
     file_path = db.Column(db.String(500), nullable=False)
     file_size = db.Column(db.BigInteger)
-    status = db.Column(db.String(20), nullable=False)  # success, failed
+    status = db.Column(db.String(20), nullable=False)  # success, failed, cancelled
     error_message = db.Column(db.Text)
     created_by = db.Column(db.Integer, db.ForeignKey('users.id'))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    # سلسلة النسخ التزايدية: النسخة الأساسية (full أو data_only) تبدأ سلسلة جديدة،
+    # وكل نسخة تزايدية تشير إلى النسخة السابقة لها في نفس السلسلة
+    backup_kind = db.Column(db.String(20))  # full, data_only, structure_only, incremental
+    chain_id = db.Column(db.String(32), index=True)
+    parent_id = db.Column(db.Integer, db.ForeignKey('backup_logs.id'))
+    snapshot_at = db.Column(db.DateTime)  # وقت بدء قراءة البيانات (UTC)
+    
+    duration = db.Column(db.Float)  # مدة النسخ بالثواني
+    throughput = db.Column(db.Float)  # متوسط البيانات المقروءة بالبايت في الثانية
+    
+    parent = db.relationship('BackupLog', remote_side=[id])
+    
     def __repr__(self):
         return f'<BackupLog {self.backup_type} {self.status}>'
+
+class Counter(db.Model):
+    """عداد متسلسل يُحجز منه بتحديث ذري واحد (أرقام الفواتير، معرفات أحداث البث)"""
+    __tablename__ = 'counters'
+
+    name = db.Column(db.String(50), primary_key=True)
+    value = db.Column(db.BigInteger)  # آخر قيمة محجوزة، NULL قبل أول حجز
+
+    def __repr__(self):
+        return f'<Counter {self.name} {self.value}>'
+
+class LiveEvent(db.Model):
+    """حدث بث مباشر محفوظ مع المعاملة التي أنتجته؛ موزع الأحداث في كل عامل يقرؤه بالاستطلاع"""
+    __tablename__ = 'live_events'
+
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)  # يُحجز من عداد live_events
+    event_type = db.Column(db.String(50), nullable=False)
+    data = db.Column(db.Text, nullable=False)  # JSON
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<LiveEvent {self.id} {self.event_type}>'
+
+class SchedulerLease(db.Model):
+    """قيادة المجدول: العامل صاحب الإيجار الساري هو الوحيد الذي يشغل المهام المجدولة"""
+    __tablename__ = 'scheduler_leases'
+
+    name = db.Column(db.String(50), primary_key=True)
+    owner = db.Column(db.String(100))
+    expires_at = db.Column(db.DateTime)  # UTC
+
+    def __repr__(self):
+        return f'<SchedulerLease {self.name} {self.owner}>'
+
+class ScheduledJob(db.Model):
+    """حالة مهمة مجدولة: آخر تشغيل وموعد التشغيل التالي (بتوقيت UTC)"""
+    __tablename__ = 'scheduled_jobs'
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), unique=True, nullable=False)
+    schedule = db.Column(db.String(50))  # وصف الجدولة الحالية، تغيره يعيد حساب الموعد التالي
+    next_run_at = db.Column(db.DateTime)
+    last_run_at = db.Column(db.DateTime)
+    last_finished_at = db.Column(db.DateTime)
+    last_status = db.Column(db.String(20))  # running, success, failed, retry
+    last_error = db.Column(db.Text)
+    # يزيد مع كل حجز للتشغيل؛ الحجز يشترط القيمة المقروءة فلا يُحجز الموعد الواحد مرتين
+    runs = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<ScheduledJob {self.name} {self.next_run_at}>'
+
+class DeletedRecord(db.Model):
+    """سجل الصفوف المحذوفة، تنقله النسخ التزايدية لتُحذف عند الاستعادة"""
+    __tablename__ = 'deleted_records'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(50), nullable=False)
+    record_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<DeletedRecord {self.table_name} {self.record_id}>'
+
+# أسطر الفواتير لا يُسجَّل حذفها لأنها تُنسخ وتُستعاد كاملة مع فاتورتها عند أي تغيير فيها
+@event.listens_for(User, 'after_delete')
+@event.listens_for(Customer, 'after_delete')
+@event.listens_for(Product, 'after_delete')
+@event.listens_for(Invoice, 'after_delete')
+@event.listens_for(TaxReport, 'after_delete')
+def record_deletion(mapper, connection, target):
+    """تسجيل الصف المحذوف في نفس معاملة الحذف"""
+    connection.execute(DeletedRecord.__table__.insert().values(
+        table_name=mapper.local_table.name,
+        record_id=target.id,
+        deleted_at=datetime.utcnow()
+    ))
@@ -0,0 +1,96 @@
+import base64
+import json
+import time
+from datetime import datetime
+from sqlalchemy import tuple_
+
+# مدة صلاحية الإجماليات المخزنة مؤقتاً لكل مجموعة فلاتر (بالثواني)
+SUMMARY_CACHE_TTL = 30
+
+_summary_cache = {}
+
+
+def encode_cursor(created_at, record_id):
+    """مؤشر صفحة غير شفاف من (created_at, id)"""
+    payload = json.dumps([created_at.isoformat() if created_at else None, record_id])
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """فك المؤشر، ويعيد None إذا كان تالفاً"""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        created_at, record_id = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        return datetime.fromisoformat(created_at), int(record_id)
+    except (ValueError, TypeError):
+        return None
+
+
+class KeysetPage:
+    """صفحة نتائج بترقيم المؤشرات على (created_at, id) تنازلياً"""
+
+    def __init__(self, items, has_next, has_prev):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+
+    @property
+    def next_cursor(self):
+        if not self.has_next or not self.items:
+            return None
+        last = self.items[-1]
+        return encode_cursor(last.created_at, last.id)
+
+    @property
+    def prev_cursor(self):
+        if not self.has_prev or not self.items:
+            return None
+        first = self.items[0]
+        return encode_cursor(first.created_at, first.id)
+
+
+def keyset_paginate(query, model, per_page=20, after=None, before=None):
+    """ترقيم بدون OFFSET: الصفحات العميقة بنفس سرعة الصفحة الأولى
+
+    after: مؤشر آخر سجل في الصفحة السابقة (الانتقال للأقدم).
+    before: مؤشر أول سجل في الصفحة الحالية (الرجوع للأحدث).
+    """
+    key = tuple_(model.created_at, model.id)
+    after = decode_cursor(after)
+    before = decode_cursor(before) if not after else None
+
+    if before:
+        rows = query.filter(key > tuple_(*before)).order_by(
+            model.created_at.asc(), model.id.asc()
+        ).limit(per_page + 1).all()
+        has_prev = len(rows) > per_page
+        items = list(reversed(rows[:per_page]))
+        return KeysetPage(items, has_next=True, has_prev=has_prev)
+
+    if after:
+        query = query.filter(key < tuple_(*after))
+    rows = query.order_by(model.created_at.desc(), model.id.desc()).limit(per_page + 1).all()
+    return KeysetPage(rows[:per_page], has_next=len(rows) > per_page, has_prev=after is not None)
+
+
+def cached_summary(cache_key, compute, ttl=SUMMARY_CACHE_TTL):
+    """تخزين مؤقت قصير لنتيجة استعلام تجميعي حسب مفتاح الفلاتر"""
+    now = time.monotonic()
+    cached = _summary_cache.get(cache_key)
+    if cached and now - cached[0] < ttl:
+        return cached[1]
+
+    value = compute()
+    if len(_summary_cache) > 1000:
+        _summary_cache.clear()
+    _summary_cache[cache_key] = (now, value)
+    return value
+
+
+def invalidate_summaries(namespace):
+    """حذف كل الإجماليات المخزنة تحت نفس بادئة المفتاح (مثل 'dashboard')"""
+    for cache_key in list(_summary_cache):
+        if cache_key[0] == namespace:
+            _summary_cache.pop(cache_key, None)
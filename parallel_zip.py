@@ -0,0 +1,362 @@
+import bz2
+import hashlib
+import lzma
+import os
+import struct
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+# حجم الكتلة التي تُضغط مستقلة في خيط منفصل
+BLOCK_SIZE = 1024 * 1024
+
+# آخر 32KB من الكتلة السابقة قاموس للكتلة التالية (نافذة deflate)، فلا تخسر
+# الكتل المستقلة إلا القليل من نسبة الضغط
+DEFLATE_WINDOW = 32 * 1024
+
+# خوارزميات الضغط: رقم الطريقة في صيغة ZIP، أقل إصدار لفك الضغط، المستوى الافتراضي
+METHODS = {
+    'stored': (0, 20, 0),
+    'deflate': (8, 20, 6),
+    'bz2': (12, 46, 9),
+    'lzma': (14, 63, 6),
+}
+
+# المستويات المتاحة لكل خوارزمية
+LEVELS = {
+    'stored': range(0, 1),
+    'deflate': range(1, 10),
+    'bz2': range(1, 10),
+    'lzma': range(0, 10),
+}
+
+ZIP64_LIMIT = (1 << 31) - 1
+ZIP_MAX = 0xFFFFFFFF
+UTF8_FLAG = 0x800
+LZMA_EOS_FLAG = 0x02
+
+# كتلة deflate نهائية فارغة تُغلق التدفق بعد الكتل المتصلة بـ Z_SYNC_FLUSH
+DEFLATE_END = b'\x03\x00'
+
+
+def deflate_block(block, dictionary, level):
+    """ضغط كتلة واحدة deflate خام تنتهي على حد بايت (Z_SYNC_FLUSH)
+
+    الكتل المضغوطة بهذه الطريقة تُلصق ببعضها فتكون تدفق deflate واحداً صحيحاً
+    (نفس أسلوب pigz)، وzlib يحرر GIL أثناء الضغط فتعمل الكتل على أنوية مختلفة.
+    """
+    if dictionary:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9, zlib.Z_DEFAULT_STRATEGY, dictionary)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, 9)
+    return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+def lzma_compressor(level):
+    """ضاغط LZMA مع ترويسة الخصائص بالصيغة التي يتوقعها ZIP (الطريقة 14)"""
+    filters = {'id': lzma.FILTER_LZMA1, 'preset': level}
+    properties = lzma._encode_filter_properties(filters)
+    compressor = lzma.LZMACompressor(lzma.FORMAT_RAW, filters=[filters])
+    return compressor, struct.pack('<BBH', 9, 4, len(properties)) + properties
+
+
+def dos_date_time(timestamp):
+    moment = datetime.fromtimestamp(timestamp)
+    if moment.year < 1980:
+        moment = datetime(1980, 1, 1)
+    return (
+        (moment.year - 1980) << 9 | moment.month << 5 | moment.day,
+        moment.hour << 11 | moment.minute << 5 | moment.second // 2
+    )
+
+
+class MemberWriter:
+    """عضو يُكتب تدريجياً في الأرشيف (مثل ZipFile.open بوضع 'w')"""
+
+    def __init__(self, archive, arcname):
+        self.archive = archive
+        self.arcname = arcname
+        self.buffer = bytearray()
+        self.blocks = deque()
+        self.member = archive.start_member(arcname, size_hint=None, mtime=time.time(), mode=0o600)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.archive.block_size:
+            block = bytes(self.buffer[:self.archive.block_size])
+            del self.buffer[:self.archive.block_size]
+            self.member.add_block(block)
+        return len(data)
+
+    def close(self):
+        if self.buffer:
+            self.member.add_block(bytes(self.buffer))
+            self.buffer.clear()
+        self.member.finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+class Member:
+    """ضغط عضو واحد وكتابته: الترويسة أولاً ثم البيانات ثم تصحيح الأحجام في الترويسة"""
+
+    def __init__(self, archive, arcname, size_hint, mtime, mode):
+        self.archive = archive
+        self.arcname = arcname
+        self.name_bytes = arcname.encode('utf-8')
+        self.flags = UTF8_FLAG if not arcname.isascii() else 0
+        self.method_id, self.version, _ = METHODS[archive.method]
+        if archive.method == 'lzma':
+            self.flags |= LZMA_EOS_FLAG
+        # الحجم غير المعروف مسبقاً (تدفق) يُكتب بترويسة ZIP64 احتياطاً
+        self.zip64 = size_hint is None or size_hint > ZIP64_LIMIT
+        if self.zip64:
+            self.version = max(self.version, 45)
+        self.date, self.time = dos_date_time(mtime)
+        self.external_attr = (mode & 0xFFFF) << 16
+        self.crc = 0
+        self.size = 0
+        self.compressed_size = 0
+        self.sha256 = hashlib.sha256()
+        self.pending = deque()
+        self.previous_tail = b''
+
+        self.offset = archive.file.tell()
+        self.write_local_header()
+        if archive.method == 'bz2':
+            self.compressor = bz2.BZ2Compressor(archive.level)
+        elif archive.method == 'lzma':
+            self.compressor, header = lzma_compressor(archive.level)
+            self.write_data(header)
+        else:
+            self.compressor = None
+
+    def local_header(self):
+        if self.zip64:
+            extra = struct.pack('<HHQQ', 0x0001, 16, self.size, self.compressed_size)
+            sizes = (ZIP_MAX, ZIP_MAX)
+        else:
+            extra = b''
+            sizes = (self.compressed_size, self.size)
+        return struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, self.version, self.flags, self.method_id,
+            self.time, self.date, self.crc, sizes[0], sizes[1], len(self.name_bytes), len(extra)
+        ) + self.name_bytes + extra
+
+    def write_local_header(self):
+        self.archive.file.write(self.local_header())
+
+    def write_data(self, data):
+        if data:
+            self.archive.file.write(data)
+            self.compressed_size += len(data)
+
+    def add_block(self, block):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.sha256.update(block)
+        if self.archive.progress:
+            self.archive.progress(len(block))
+
+        method = self.archive.method
+        if method == 'stored':
+            self.write_data(block)
+        elif method == 'deflate':
+            # عدد محدود من الكتل قيد الضغط حتى تبقى الذاكرة ثابتة
+            self.pending.append(self.archive.executor.submit(
+                deflate_block, block, self.previous_tail, self.archive.level
+            ))
+            self.previous_tail = block[-DEFLATE_WINDOW:]
+            while len(self.pending) > self.archive.workers * 2:
+                self.write_data(self.pending.popleft().result())
+        else:
+            # bz2 و lzma لا تُقسم إلى تدفقات مستقلة داخل عضو ZIP واحد، فيعمل
+            # الضاغط في خيط مستقل بالترتيب بينما يقرأ الخيط الحالي الكتلة التالية
+            self.pending.append(self.archive.ordered_executor.submit(self.compressor.compress, block))
+            while len(self.pending) > 2:
+                self.write_data(self.pending.popleft().result())
+
+    def finish(self):
+        while self.pending:
+            self.write_data(self.pending.popleft().result())
+        if self.archive.method == 'deflate':
+            self.write_data(DEFLATE_END)
+        elif self.compressor is not None:
+            self.write_data(self.compressor.flush())
+
+        if not self.zip64 and (self.size > ZIP64_LIMIT or self.compressed_size > ZIP64_LIMIT):
+            raise ValueError(f'حجم العضو {self.arcname} يتجاوز حد ZIP بدون ZIP64')
+
+        end = self.archive.file.tell()
+        self.archive.file.seek(self.offset)
+        self.write_local_header()
+        self.archive.file.seek(end)
+        self.archive.add_central_entry(self)
+        return self.sha256.hexdigest()
+
+    def central_header(self):
+        extra_values = []
+        size, compressed_size, offset = self.size, self.compressed_size, self.offset
+        if size > ZIP_MAX - 1 or compressed_size > ZIP_MAX - 1 or self.zip64:
+            extra_values += [size, compressed_size]
+            size = compressed_size = ZIP_MAX
+        if offset > ZIP_MAX - 1:
+            extra_values.append(offset)
+            offset = ZIP_MAX
+        extra = b''
+        if extra_values:
+            extra = struct.pack(f'<HH{len(extra_values)}Q', 0x0001, 8 * len(extra_values), *extra_values)
+        return struct.pack(
+            '<IHHHHHHIIIHHHHHII', 0x02014b50, 3 << 8 | self.version, self.version, self.flags,
+            self.method_id, self.time, self.date, self.crc, compressed_size, size,
+            len(self.name_bytes), len(extra), 0, 0, 0, self.external_attr, offset
+        ) + self.name_bytes + extra
+
+
+class ParallelZipWriter:
+    """كتابة أرشيف ZIP قياسي مع ضغط الكتل على عدة أنوية
+
+    deflate: كل عضو يُقسم إلى كتل تُضغط متوازية ثم تُلصق بالترتيب في تدفق
+    واحد، فيقرأ الأرشيف أي برنامج ZIP. bz2 و lzma: ضاغط واحد لكل عضو يعمل
+    بالتوازي مع القراءة وحساب البصمات.
+    الواجهة قريبة من zipfile.ZipFile: write و writestr و open(name, 'w').
+    progress(عدد البايتات) تُستدعى بعد قراءة كل كتلة من البيانات غير المضغوطة.
+    """
+
+    def __init__(self, path, method='deflate', level=None, workers=None, block_size=BLOCK_SIZE, progress=None):
+        if method not in METHODS:
+            raise ValueError(f'خوارزمية ضغط غير مدعومة: {method}')
+        self.method = method
+        self.level = METHODS[method][2] if level in (None, '') else int(level)
+        if self.level not in LEVELS[method]:
+            raise ValueError(f'مستوى ضغط غير صالح لـ {method}: {self.level}')
+        self.workers = max(1, int(workers or os.cpu_count() or 1))
+        self.block_size = block_size
+        self.progress = progress
+        self.file = open(path, 'wb')
+        self.entries = []
+        self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix='zip-compress')
+        self.ordered_executor = ThreadPoolExecutor(1, thread_name_prefix='zip-compress-ordered')
+
+    def start_member(self, arcname, size_hint, mtime, mode):
+        return Member(self, arcname, size_hint, mtime, mode)
+
+    def add_central_entry(self, member):
+        self.entries.append(member.central_header())
+
+    def write(self, file_path, arcname):
+        """إضافة ملف من القرص، ويعيد بصمته SHA-256"""
+        status = os.stat(file_path)
+        member = self.start_member(arcname, status.st_size, status.st_mtime, status.st_mode)
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(self.block_size), b''):
+                member.add_block(block)
+        return member.finish()
+
+    def writestr(self, arcname, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        member = self.start_member(arcname, len(data), time.time(), 0o600)
+        for start in range(0, len(data), self.block_size):
+            member.add_block(data[start:start + self.block_size])
+        return member.finish()
+
+    def open(self, arcname, mode='w'):
+        if mode != 'w':
+            raise ValueError('ParallelZipWriter يدعم الكتابة فقط')
+        return MemberWriter(self, arcname)
+
+    def close(self):
+        if self.file is None:
+            return
+        try:
+            self.write_central_directory()
+        finally:
+            self.executor.shutdown()
+            self.ordered_executor.shutdown()
+            self.file.close()
+            self.file = None
+
+    def write_central_directory(self):
+        start = self.file.tell()
+        for entry in self.entries:
+            self.file.write(entry)
+        size = self.file.tell() - start
+        count = len(self.entries)
+
+        if count > 0xFFFF or start > ZIP_MAX - 1 or size > ZIP_MAX - 1:
+            zip64_end = self.file.tell()
+            self.file.write(struct.pack(
+                '<IQHHIIQQQQ', 0x06064b50, 44, 45, 45, 0, 0, count, count, size, start
+            ))
+            self.file.write(struct.pack('<IIQI', 0x07064b50, 0, zip64_end, 1))
+            count, size, start = min(count, 0xFFFF), min(size, ZIP_MAX), min(start, ZIP_MAX)
+        self.file.write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, count, count, size, start, 0))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.executor.shutdown(cancel_futures=True)
+            self.ordered_executor.shutdown(cancel_futures=True)
+            self.file.close()
+            self.file = None
+
+
+def benchmark_compression(sample, methods=None, levels=None, workers=None):
+    """قياس كل خوارزمية ومستوى على عينة من البيانات
+
+    يعيد النتائج (الزمن، الحجم، النسبة، السرعة) والإعداد الموصى به: الأسرع بين
+    الإعدادات التي لا يزيد حجمها عن الأصغر بأكثر من 10%.
+    """
+    import tempfile
+
+    methods = methods or ['deflate', 'bz2', 'lzma']
+    results = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'benchmark.zip')
+        for method in methods:
+            for level in (levels or {'deflate': [1, 6, 9], 'bz2': [1, 9], 'lzma': [0, 6]}[method]):
+                started = time.perf_counter()
+                with ParallelZipWriter(path, method, level, workers) as archive:
+                    archive.writestr('sample', sample)
+                elapsed = time.perf_counter() - started
+                size = os.path.getsize(path)
+                results.append({
+                    'method': method,
+                    'level': level,
+                    'seconds': round(elapsed, 3),
+                    'size': size,
+                    'ratio': round(size / len(sample), 4) if sample else 0,
+                    'mb_per_second': round(len(sample) / 1024 / 1024 / elapsed, 1) if elapsed else None
+                })
+
+    smallest = min(result['size'] for result in results)
+    candidates = [result for result in results if result['size'] <= smallest * 1.1]
+    recommended = min(candidates, key=lambda result: result['seconds'])
+    return {'results': results, 'recommended': {'method': recommended['method'], 'level': recommended['level']}}
+
+
+if __name__ == '__main__':
+    # مثال: python parallel_zip.py instance/app.db 32
+    import sys
+
+    sample_path = sys.argv[1]
+    sample_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    with open(sample_path, 'rb') as f:
+        sample_data = f.read(sample_mb * 1024 * 1024)
+    report = benchmark_compression(sample_data)
+    for row in report['results']:
+        print(f"{row['method']:>8} -{row['level']}: {row['seconds']:>7} s  "
+              f"{row['mb_per_second']:>7} MB/s  ratio {row['ratio']}")
+    print(f"recommended: {report['recommended']['method']} -{report['recommended']['level']}")
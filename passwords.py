@@ -0,0 +1,279 @@
+import base64
+import hashlib
+import os
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+
+try:
+    import bcrypt
+    BCRYPT_AVAILABLE = True
+except ImportError:
+    BCRYPT_AVAILABLE = False
+
+
+class PasswordHashingBusy(Exception):
+    """طابور التجزئة ممتلئ ولم يبدأ الطلب خلال المهلة المحددة"""
+
+
+class PBKDF2Hasher:
+    """PBKDF2-SHA256 بصيغة Werkzeug: pbkdf2:sha256:<iterations>$salt$hash"""
+
+    algorithm = 'pbkdf2'
+
+    def __init__(self, iterations=600000):
+        self.iterations = int(iterations)
+
+    def identifies(self, encoded):
+        return encoded.startswith('pbkdf2:')
+
+    def encode(self, password):
+        return generate_password_hash(password, method=f'pbkdf2:sha256:{self.iterations}')
+
+    def verify(self, password, encoded):
+        return check_password_hash(encoded, password)
+
+    def needs_rehash(self, encoded):
+        method = encoded.split('$', 1)[0].split(':')
+        return method[1:] != ['sha256', str(self.iterations)]
+
+
+class ScryptHasher:
+    """scrypt بصيغة Werkzeug: scrypt:<n>:<r>:<p>$salt$hash"""
+
+    algorithm = 'scrypt'
+
+    def __init__(self, n=2 ** 15, r=8, p=1):
+        self.n, self.r, self.p = int(n), int(r), int(p)
+
+    def identifies(self, encoded):
+        return encoded.startswith('scrypt:')
+
+    def encode(self, password):
+        return generate_password_hash(password, method=f'scrypt:{self.n}:{self.r}:{self.p}')
+
+    def verify(self, password, encoded):
+        return check_password_hash(encoded, password)
+
+    def needs_rehash(self, encoded):
+        return encoded.split('$', 1)[0] != f'scrypt:{self.n}:{self.r}:{self.p}'
+
+
+class BcryptHasher:
+    """bcrypt على SHA-256 لكلمة المرور (bcrypt يقبل 72 بايت فقط): bcrypt-sha256$<hash>"""
+
+    algorithm = 'bcrypt'
+    prefix = 'bcrypt-sha256$'
+
+    def __init__(self, rounds=12):
+        if not BCRYPT_AVAILABLE:
+            raise RuntimeError('مكتبة bcrypt غير مثبتة.')
+        self.rounds = int(rounds)
+
+    def identifies(self, encoded):
+        return encoded.startswith(self.prefix)
+
+    def prehash(self, password):
+        return base64.b64encode(hashlib.sha256(password.encode('utf-8')).digest())
+
+    def encode(self, password):
+        hashed = bcrypt.hashpw(self.prehash(password), bcrypt.gensalt(self.rounds))
+        return self.prefix + hashed.decode('ascii')
+
+    def verify(self, password, encoded):
+        try:
+            return bcrypt.checkpw(self.prehash(password), encoded[len(self.prefix):].encode('ascii'))
+        except ValueError:
+            return False
+
+    def needs_rehash(self, encoded):
+        # $2b$<rounds>$...
+        return encoded[len(self.prefix):].split('$')[2] != f'{self.rounds:02d}'
+
+
+# سجل خوارزميات التجزئة: الاسم (قيمة PASSWORD_HASHER) ودالة تبنيها من الإعدادات
+HASHERS = {
+    'pbkdf2': lambda settings: PBKDF2Hasher(settings['PASSWORD_PBKDF2_ITERATIONS']),
+    'scrypt': lambda settings: ScryptHasher(settings['PASSWORD_SCRYPT_N']),
+    'bcrypt': lambda settings: BcryptHasher(settings['PASSWORD_BCRYPT_ROUNDS']),
+}
+
+
+def register_hasher(name, factory):
+    """إضافة خوارزمية تجزئة جديدة للسجل (تُستخدم بعد configure_password_hashing)"""
+    HASHERS[name] = factory
+
+
+# الإعدادات الافتراضية، تُستبدل بـ configure_password_hashing من إعدادات التطبيق
+DEFAULT_SETTINGS = {
+    'PASSWORD_HASHER': 'bcrypt' if BCRYPT_AVAILABLE else 'pbkdf2',
+    'PASSWORD_PBKDF2_ITERATIONS': 600000,
+    'PASSWORD_BCRYPT_ROUNDS': 12,
+    'PASSWORD_SCRYPT_N': 2 ** 15,
+    # عدد عمليات التجزئة المتزامنة في العملية الواحدة (الباقي ينتظر دوره)
+    'PASSWORD_HASH_WORKERS': max(1, (os.cpu_count() or 2) // 2),
+    # أقصى انتظار لبدء التجزئة قبل رفض تسجيل الدخول بدلاً من تعطيل الخادم (بالثواني)
+    'PASSWORD_HASH_QUEUE_TIMEOUT': 10,
+}
+
+_state = {'hasher': None, 'verifiers': [], 'executor': None, 'timeout': None}
+_state_lock = threading.Lock()
+
+
+def build_hashers(settings):
+    """الخوارزمية الحالية للتجزئة، وكل الخوارزميات المتاحة للتحقق من التجزئات القديمة"""
+    hashers = {}
+    for name, factory in HASHERS.items():
+        try:
+            hashers[name] = factory(settings)
+        except RuntimeError:
+            # مكتبة اختيارية غير مثبتة
+            continue
+
+    name = settings['PASSWORD_HASHER']
+    if name not in hashers:
+        raise ValueError(f'خوارزمية تجزئة غير معروفة أو غير متاحة: {name}')
+    return hashers[name], list(hashers.values())
+
+
+def configure_password_hashing(config=None):
+    """تطبيق إعدادات التجزئة من إعدادات التطبيق (مع القيم الافتراضية للناقص منها)"""
+    settings = dict(DEFAULT_SETTINGS)
+    for key in DEFAULT_SETTINGS:
+        if config and config.get(key) not in (None, ''):
+            settings[key] = config[key]
+
+    hasher, verifiers = build_hashers(settings)
+    with _state_lock:
+        if _state['executor'] is not None:
+            _state['executor'].shutdown(wait=False)
+        _state.update(
+            hasher=hasher,
+            verifiers=verifiers,
+            executor=ThreadPoolExecutor(
+                max_workers=int(settings['PASSWORD_HASH_WORKERS']), thread_name_prefix='password-hash'
+            ),
+            timeout=float(settings['PASSWORD_HASH_QUEUE_TIMEOUT'])
+        )
+
+
+def get_state():
+    if _state['hasher'] is None:
+        configure_password_hashing()
+    return _state
+
+
+def run_in_pool(function, *args):
+    """تنفيذ عملية تجزئة في مجمع الخيوط المحدود
+
+    المكتبات الثلاث تحرر GIL أثناء الحساب، فيبقى عدد الأنوية المشغولة بالتجزئة
+    محدوداً بحجم المجمع مهما زاد عدد طلبات الدخول المتزامنة.
+    """
+    state = get_state()
+    started = threading.Event()
+
+    def task():
+        started.set()
+        return function(*args)
+
+    future = state['executor'].submit(task)
+    if not started.wait(state['timeout']) and future.cancel():
+        raise PasswordHashingBusy()
+    return future.result()
+
+
+def identify_hasher(encoded):
+    for hasher in get_state()['verifiers']:
+        if hasher.identifies(encoded or ''):
+            return hasher
+    return None
+
+
+def hash_password(password):
+    """تجزئة كلمة المرور بالخوارزمية والتكلفة الحالية"""
+    return run_in_pool(get_state()['hasher'].encode, password)
+
+
+def verify_password(password, encoded):
+    """التحقق من كلمة المرور، ويعيد (صحيحة، تجزئة جديدة أو None)
+
+    إذا كانت التجزئة المخزنة بخوارزمية أو تكلفة مختلفة عن الحالية تُعاد تجزئة
+    جديدة ليحفظها المستدعي، فتترقى التجزئات تدريجياً مع تسجيلات الدخول.
+    """
+    hasher = identify_hasher(encoded)
+    if hasher is None or not password:
+        return False, None
+
+    def verify_and_upgrade():
+        if not hasher.verify(password, encoded):
+            return False, None
+        current = get_state()['hasher']
+        if hasher is not current or current.needs_rehash(encoded):
+            return True, current.encode(password)
+        return True, None
+
+    return run_in_pool(verify_and_upgrade)
+
+
+def benchmark_logins(concurrency=10, logins=100, password='benchmark-password'):
+    """قياس زمن تسجيل الدخول (التحقق من كلمة المرور) تحت دخول متزامن
+
+    يعيد عدد الطلبات ونسبة المرفوض لانشغال الطابور وزمن p50 و p99 بالملي ثانية
+    والإنتاجية (عمليات دخول في الثانية).
+    """
+    encoded = hash_password(password)
+    latencies = []
+    rejected = 0
+    lock = threading.Lock()
+    remaining = iter(range(logins))
+
+    def client():
+        nonlocal rejected
+        while True:
+            with lock:
+                if next(remaining, None) is None:
+                    return
+            start = time.perf_counter()
+            try:
+                verify_password(password, encoded)
+            except PasswordHashingBusy:
+                with lock:
+                    rejected += 1
+                continue
+            with lock:
+                latencies.append((time.perf_counter() - start) * 1000)
+
+    started = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    percentiles = statistics.quantiles(latencies, n=100, method='inclusive') if len(latencies) > 1 else latencies * 99
+    return {
+        'hasher': get_state()['hasher'].algorithm,
+        'concurrency': concurrency,
+        'logins': logins,
+        'rejected': rejected,
+        'p50_ms': round(percentiles[49], 1) if latencies else None,
+        'p99_ms': round(percentiles[98], 1) if latencies else None,
+        'throughput': round(len(latencies) / elapsed, 1) if elapsed else None,
+    }
+
+
+if __name__ == '__main__':
+    # مثال: PASSWORD_HASHER=bcrypt PASSWORD_BCRYPT_ROUNDS=11 python passwords.py 20 200
+    import sys
+
+    configure_password_hashing(os.environ)
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    logins = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    result = benchmark_logins(concurrency, logins)
+    print(f"{result['hasher']}: {result['logins']} logins @ {result['concurrency']} concurrent -> "
+          f"p50 {result['p50_ms']} ms, p99 {result['p99_ms']} ms, "
+          f"{result['throughput']} logins/s, rejected {result['rejected']}")
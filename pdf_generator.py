@@ -149,10 +149,22 @@ class ArabicPDFGenerator:
         table_data = [
             [self.process_arabic_text("البيان"), self.process_arabic_text("المبلغ (جنيه)")],
             [self.process_arabic_text("إجمالي المبيعات"), f"{total_sales:,.2f}"],
-            [self.process_arabic_text("المبيعات الخاضعة لضريبة ق.م.م (14%)"), f"{vat_sales:,.2f}"],
+            [self.process_arabic_text("المبيعات الخاضعة لضريبة ق.م.م"), f"{vat_sales:,.2f}"],
             [self.process_arabic_text("ضريبة القيمة المضافة"), f"{vat_amount:,.2f}"],
-            [self.process_arabic_text("المبيعات الخاضعة لضريبة خ.إ (5%)"), f"{withholding_sales:,.2f}"],
+            [self.process_arabic_text("المبيعات الخاضعة لضريبة خ.إ"), f"{withholding_sales:,.2f}"],
             [self.process_arabic_text("ضريبة الخصم والإضافة"), f"{withholding_amount:,.2f}"],
+        ]
+        
+        # صف لكل (نوع ضريبة، معدل) بدلاً من افتراض 14% و 5%
+        type_labels = {'vat': 'ق.م.م', 'withholding': 'خ.إ'}
+        for rollup in data.get('rate_rollups', []):
+            label = f"{type_labels.get(rollup['tax_type'], '')} {rollup['tax_rate']:g}%"
+            table_data.append([
+                self.process_arabic_text(f"المبيعات الخاضعة {label} / الضريبة"),
+                f"{self.safe_float(rollup['taxable_sales']):,.2f} / {self.safe_float(rollup['tax_amount']):,.2f}"
+            ])
+        
+        table_data += [
             [self.process_arabic_text("إجمالي الضرائب"), f"{total_taxes:,.2f}"],
             [self.process_arabic_text("الإجمالي النهائي"), f"{final_total:,.2f}"],
         ]
@@ -313,7 +325,8 @@ class ArabicPDFGenerator:
             'withholding_sales': withholding_sales,
             'withholding_amount': withholding_amount,
             'total_taxes': vat_amount + withholding_amount,
-            'final_total': total_sales + vat_amount + withholding_amount
+            'final_total': total_sales + vat_amount + withholding_amount,
+            'rate_rollups': data.get('rate_rollups', [])
         }
         
         summary_table = self.create_summary_table(summary_data)
@@ -388,7 +401,7 @@ class ArabicPDFGenerator:
             ]
             
             for invoice in data['invoices']:
-                vat_base = self.safe_float(invoice.vat_amount) / 0.14 if invoice.vat_amount else 0
+                vat_base = self.safe_float(invoice.vat_base)
                 table_data.append([
                     invoice.invoice_number,
                     invoice.invoice_date.strftime('%Y/%m/%d'),
@@ -455,7 +468,7 @@ class ArabicPDFGenerator:
             ]
             
             for invoice in data['invoices']:
-                withholding_base = self.safe_float(invoice.withholding_amount) / 0.05 if invoice.withholding_amount else 0
+                withholding_base = self.safe_float(invoice.withholding_base)
                 table_data.append([
                     invoice.invoice_number,
                     invoice.invoice_date.strftime('%Y/%m/%d'),
@@ -520,6 +533,7 @@ class ArabicPDFGenerator:
             'vat_amount': self.safe_float(data.get('total_vat', 0)),
             'withholding_sales': self.safe_float(data.get('withholding_taxable_sales', 0)),
             'withholding_amount': self.safe_float(data.get('total_withholding', 0)),
+            'rate_rollups': data.get('rate_rollups', []),
         }
         summary_data['total_taxes'] = summary_data['vat_amount'] + summary_data['withholding_amount']
         summary_data['final_total'] = summary_data['total_sales'] + summary_data['total_taxes']
@@ -2,7 +2,7 @@ from datetime import datetime, timedelta
 from decimal import Decimal
 from flask import Blueprint, render_template, request, flash, redirect, url_for, send_file
 from flask_login import login_required
-from sqlalchemy import func
+from sqlalchemy import func, case
 import io
 import os
 from io import BytesIO
@@ -28,7 +28,7 @@ try:
 except ImportError:
     OPENPYXL_AVAILABLE = False
 
-from models import db, Invoice, InvoiceItem, Product, TaxReport, TaxType, SystemSettings
+from models import db, Invoice, InvoiceItem, Product, Customer, TaxReport, TaxType, SystemSettings
 from forms import ReportForm
 from auth import permission_required
 
@@ -102,24 +102,25 @@ def reports_dashboard():
     monthly_vat = sum(invoice.vat_amount for invoice in monthly_invoices)
     monthly_withholding = sum(invoice.withholding_amount for invoice in monthly_invoices)
     
-    # أفضل المنتجات مبيعاً
+    # أفضل المنتجات مبيعاً (تجميع على أسطر الفواتير فقط ثم جلب الأسماء)
     top_products_query = db.session.query(
-        Product.name,
+        InvoiceItem.product_id,
         func.sum(InvoiceItem.quantity).label('total_quantity'),
-        func.sum(InvoiceItem.quantity * InvoiceItem.unit_price).label('total_revenue')
-    ).join(InvoiceItem).join(Invoice).filter(
+        func.sum(InvoiceItem.line_total).label('total_revenue')
+    ).join(Invoice).filter(
         Invoice.is_cancelled == False
-    ).group_by(Product.id).order_by(
-        func.sum(InvoiceItem.quantity * InvoiceItem.unit_price).desc()
+    ).group_by(InvoiceItem.product_id).order_by(
+        func.sum(InvoiceItem.line_total).desc()
     ).limit(5).all()
     
+    product_names = get_product_names([row.product_id for row in top_products_query])
     top_products = [
         {
-            'name': product[0],
-            'quantity': product[1],
-            'revenue': product[2]
+            'name': product_names.get(row.product_id, ''),
+            'quantity': row.total_quantity,
+            'revenue': row.total_revenue
         }
-        for product in top_products_query
+        for row in top_products_query
     ]
     
     # إحصائيات السنة الحالية
@@ -362,15 +363,13 @@ def vat_report():
     ).order_by(Invoice.invoice_date.desc()).all()
     
     # حساب الإجماليات - المبلغ الخاضع للضريبة فقط
-    total_taxable_sales = 0
-    total_vat_amount = 0
+    totals = get_invoice_totals(Invoice.vat_amount > 0, Invoice.is_cancelled == False)
+    total_taxable_sales = float(totals['vat_base'])
+    total_vat_amount = float(totals['vat_amount'])
     
-    for invoice in invoices:
-        if invoice.vat_amount > 0:
-            # حساب المبلغ الخاضع لضريبة القيمة المضافة
-            vat_base = float(invoice.vat_amount / Decimal('0.14'))
-            total_taxable_sales += vat_base
-            total_vat_amount += float(invoice.vat_amount)
+    # التفصيل حسب معدل الضريبة
+    rate_rollups = get_tax_rate_rollups(InvoiceItem.tax_type == TaxType.VAT, Invoice.is_cancelled == False)
+    invoice_rates = get_invoice_tax_rates([invoice.id for invoice in invoices], TaxType.VAT)
     
     # الحصول على بيانات الشركة من الإعدادات
     company_name = SystemSettings.get_setting('company_name', 'اسم الشركة')
@@ -388,7 +387,8 @@ def vat_report():
                 'company_address': company_address,
                 'invoices': invoices,
                 'total_taxable_sales': total_taxable_sales,
-                'total_vat_amount': total_vat_amount
+                'total_vat_amount': total_vat_amount,
+                'rate_rollups': rate_rollups
             }
             
             # إنشاء PDF
@@ -413,6 +413,8 @@ def vat_report():
                          invoices=invoices,
                          total_taxable_sales=total_taxable_sales,
                          total_vat_amount=total_vat_amount,
+                         rate_rollups=rate_rollups,
+                         invoice_rates=invoice_rates,
                          period_text='جميع الفترات',
                          current_date=datetime.utcnow(),
                          company_name=company_name,
@@ -431,15 +433,13 @@ def withholding_report():
     ).order_by(Invoice.invoice_date.desc()).all()
     
     # حساب الإجماليات - المبلغ الخاضع للضريبة فقط
-    total_taxable_sales = 0
-    total_withholding_amount = 0
+    totals = get_invoice_totals(Invoice.withholding_amount > 0, Invoice.is_cancelled == False)
+    total_taxable_sales = float(totals['withholding_base'])
+    total_withholding_amount = float(totals['withholding_amount'])
     
-    for invoice in invoices:
-        if invoice.withholding_amount > 0:
-            # حساب المبلغ الخاضع لضريبة الخصم والإضافة
-            withholding_base = float(invoice.withholding_amount / Decimal('0.05'))
-            total_taxable_sales += withholding_base
-            total_withholding_amount += float(invoice.withholding_amount)
+    # التفصيل حسب معدل الضريبة
+    rate_rollups = get_tax_rate_rollups(InvoiceItem.tax_type == TaxType.WITHHOLDING, Invoice.is_cancelled == False)
+    invoice_rates = get_invoice_tax_rates([invoice.id for invoice in invoices], TaxType.WITHHOLDING)
     
     # الحصول على بيانات الشركة من الإعدادات
     company_name = SystemSettings.get_setting('company_name', 'اسم الشركة')
@@ -457,7 +457,8 @@ def withholding_report():
                 'company_address': company_address,
                 'invoices': invoices,
                 'total_taxable_sales': total_taxable_sales,
-                'total_withholding_amount': total_withholding_amount
+                'total_withholding_amount': total_withholding_amount,
+                'rate_rollups': rate_rollups
             }
             
             # إنشاء PDF
@@ -482,6 +483,8 @@ def withholding_report():
                          invoices=invoices,
                          total_taxable_sales=total_taxable_sales,
                          total_withholding_amount=total_withholding_amount,
+                         rate_rollups=rate_rollups,
+                         invoice_rates=invoice_rates,
                          period_text='جميع الفترات',
                          current_date=datetime.utcnow(),
                          company_name=company_name,
@@ -565,31 +568,23 @@ def comprehensive_report():
         Invoice.is_cancelled == False
     ).order_by(Invoice.invoice_date.desc()).all()
     
-    # حساب الإجماليات
-    total_invoices = len(invoices)
-    total_sales = sum(invoice.subtotal for invoice in invoices)
-    total_vat = sum(invoice.vat_amount for invoice in invoices)
-    total_withholding = sum(invoice.withholding_amount for invoice in invoices)
+    # حساب الإجماليات والإحصائيات التفصيلية باستعلام تجميعي واحد
+    totals = get_invoice_totals(Invoice.is_cancelled == False)
+    total_invoices = totals['invoices_count']
+    total_sales = totals['subtotal']
+    total_vat = totals['vat_amount']
+    total_withholding = totals['withholding_amount']
     total_taxes = total_vat + total_withholding
     
-    # إحصائيات تفصيلية
-    vat_invoices = [inv for inv in invoices if inv.vat_amount > 0]
-    withholding_invoices = [inv for inv in invoices if inv.withholding_amount > 0]
+    vat_invoices_count = totals['vat_invoices_count']
+    withholding_invoices_count = totals['withholding_invoices_count']
     
-    vat_invoices_count = len(vat_invoices)
-    withholding_invoices_count = len(withholding_invoices)
+    # المبيعات الخاضعة للضريبة من الأوعية المخزنة في الفواتير
+    vat_taxable_sales = float(totals['vat_base'])
+    withholding_taxable_sales = float(totals['withholding_base'])
     
-    # حساب المبيعات الخاضعة للضريبة بشكل صحيح
-    vat_taxable_sales = 0
-    withholding_taxable_sales = 0
-    
-    for inv in vat_invoices:
-        if inv.vat_amount > 0:
-            vat_taxable_sales += float(inv.vat_amount / Decimal('0.14'))
-    
-    for inv in withholding_invoices:
-        if inv.withholding_amount > 0:
-            withholding_taxable_sales += float(inv.withholding_amount / Decimal('0.05'))
+    # التفصيل حسب (نوع الضريبة، المعدل)
+    rate_rollups = get_tax_rate_rollups(Invoice.is_cancelled == False)
     
     # الحصول على بيانات الشركة من الإعدادات
     company_name = SystemSettings.get_setting('company_name', 'اسم الشركة')
@@ -614,7 +609,8 @@ def comprehensive_report():
                 'vat_invoices_count': vat_invoices_count,
                 'withholding_invoices_count': withholding_invoices_count,
                 'vat_taxable_sales': vat_taxable_sales,
-                'withholding_taxable_sales': withholding_taxable_sales
+                'withholding_taxable_sales': withholding_taxable_sales,
+                'rate_rollups': rate_rollups
             }
             
             # إنشاء PDF
@@ -646,6 +642,7 @@ def comprehensive_report():
                          withholding_invoices_count=withholding_invoices_count,
                          vat_taxable_sales=vat_taxable_sales,
                          withholding_taxable_sales=withholding_taxable_sales,
+                         rate_rollups=rate_rollups,
                          period_text='جميع الفترات',
                          current_date=datetime.utcnow(),
                          company_name=company_name,
@@ -657,78 +654,45 @@ def comprehensive_report():
 @permission_required('view_reports')
 def tax_declaration():
     """إنشاء إقرار ضريبي"""
-    # الحصول على جميع الفواتير النشطة
-    invoices = Invoice.query.filter_by(is_cancelled=False).all()
-    
-    # حساب الإجماليات للإقرار بشكل محاسبي صحيح
-    total_sales = sum(inv.subtotal for inv in invoices)  # إجمالي المبيعات
-    
-    # حساب المبيعات الخاضعة لضريبة القيمة المضافة فقط
-    # (المبيعات التي عليها ضريبة 14% مقسومة على 1.14 للحصول على القيمة قبل الضريبة)
-    total_vat_sales = 0
-    total_vat_amount = 0
-    
-    # حساب المبيعات الخاضعة لضريبة الخصم والإضافة فقط  
-    # (المبيعات التي عليها ضريبة 5% مقسومة على 1.05 للحصول على القيمة قبل الضريبة)
-    total_withholding_sales = 0
-    total_withholding_amount = 0
-    
-    for invoice in invoices:
-        if invoice.vat_amount > 0:
-            # حساب المبيعات الخاضعة لضريبة القيمة المضافة
-            vat_base = invoice.vat_amount / Decimal('0.14')  # القيمة قبل الضريبة
-            total_vat_sales += float(vat_base)
-            total_vat_amount += float(invoice.vat_amount)
-            
-        if invoice.withholding_amount > 0:
-            # حساب المبيعات الخاضعة لضريبة الخصم والإضافة
-            withholding_base = invoice.withholding_amount / Decimal('0.05')  # القيمة قبل الضريبة
-            total_withholding_sales += float(withholding_base)
-            total_withholding_amount += float(invoice.withholding_amount)
-    
-    # إحصائيات شهرية للسنة الحالية
+    # حساب الإجماليات للإقرار من الأوعية الضريبية المخزنة في الفواتير
+    totals = get_invoice_totals(Invoice.is_cancelled == False)
+    total_sales = totals['subtotal']  # إجمالي المبيعات
+    total_vat_sales = float(totals['vat_base'])
+    total_vat_amount = float(totals['vat_amount'])
+    total_withholding_sales = float(totals['withholding_base'])
+    total_withholding_amount = float(totals['withholding_amount'])
+    
+    # التفصيل حسب (نوع الضريبة، المعدل)
+    rate_rollups = get_tax_rate_rollups(Invoice.is_cancelled == False)
+    
+    # إحصائيات شهرية للسنة الحالية باستعلام مجمّع واحد
     current_year = datetime.utcnow().year
-    monthly_data = []
+    month_column = db.extract('month', Invoice.invoice_date)
+    monthly_rows = db.session.query(
+        month_column.label('month'),
+        func.coalesce(func.sum(Invoice.subtotal), 0).label('subtotal'),
+        func.coalesce(func.sum(Invoice.vat_base), 0).label('vat_base'),
+        func.coalesce(func.sum(Invoice.vat_amount), 0).label('vat_amount'),
+        func.coalesce(func.sum(Invoice.withholding_base), 0).label('withholding_base'),
+        func.coalesce(func.sum(Invoice.withholding_amount), 0).label('withholding_amount')
+    ).filter(
+        Invoice.invoice_date >= datetime(current_year, 1, 1).date(),
+        Invoice.invoice_date <= datetime(current_year, 12, 31).date(),
+        Invoice.is_cancelled == False
+    ).group_by(month_column).all()
+    monthly_rows = {int(row.month): row for row in monthly_rows}
     
+    monthly_data = []
     for month in range(1, 13):
-        month_start = datetime(current_year, month, 1)
-        if month == 12:
-            month_end = datetime(current_year + 1, 1, 1) - timedelta(days=1)
-        else:
-            month_end = datetime(current_year, month + 1, 1) - timedelta(days=1)
-        
-        month_invoices = Invoice.query.filter(
-            Invoice.invoice_date >= month_start,
-            Invoice.invoice_date <= month_end,
-            Invoice.is_cancelled == False
-        ).all()
-        
-        # حساب المبيعات الشهرية بشكل محاسبي صحيح
-        month_total_sales = sum(inv.subtotal for inv in month_invoices)
-        
-        # حساب المبيعات الخاضعة للضرائب لكل شهر
-        month_vat_sales = 0
-        month_vat_amount = 0
-        month_withholding_sales = 0
-        month_withholding_amount = 0
-        
-        for invoice in month_invoices:
-            if invoice.vat_amount > 0:
-                month_vat_sales += float(invoice.vat_amount / Decimal('0.14'))  # القيمة قبل الضريبة
-                month_vat_amount += float(invoice.vat_amount)
-                
-            if invoice.withholding_amount > 0:
-                month_withholding_sales += float(invoice.withholding_amount / Decimal('0.05'))  # القيمة قبل الضريبة
-                month_withholding_amount += float(invoice.withholding_amount)
-        
+        row = monthly_rows.get(month)
         monthly_data.append({
             'month': month,
-            'month_name': month_start.strftime('%B'),
-            'total_sales': month_total_sales,
-            'vat_sales': month_vat_sales,
-            'vat_amount': month_vat_amount,
-            'withholding_sales': month_withholding_sales,
-            'withholding_amount': month_withholding_amount
+            'month_name': datetime(current_year, month, 1).strftime('%B'),
+            'total_sales': row.subtotal if row else 0,
+            'vat_sales': float(row.vat_base) if row else 0,
+            'vat_amount': float(row.vat_amount) if row else 0,
+            'withholding_sales': float(row.withholding_base) if row else 0,
+            'withholding_amount': float(row.withholding_amount) if row else 0
         })
     
     # الحصول على بيانات الشركة من الإعدادات
@@ -751,6 +715,7 @@ def tax_declaration():
                 'total_withholding_sales': total_withholding_sales,
                 'total_withholding_amount': total_withholding_amount,
                 'monthly_data': monthly_data,
+                'rate_rollups': rate_rollups,
                 'current_year': current_year
             }
             
@@ -777,6 +742,7 @@ def tax_declaration():
                          total_withholding_sales=total_withholding_sales,
                          total_withholding_amount=total_withholding_amount,
                          monthly_data=monthly_data,
+                         rate_rollups=rate_rollups,
                          current_year=current_year,
                          current_date=datetime.utcnow(),
                          company_name=company_name,
@@ -813,20 +779,29 @@ def monthly_summary():
     total_withholding = sum(inv.withholding_amount for inv in monthly_invoices)
     total_revenue = sum(inv.total_amount for inv in monthly_invoices)
     
-    # أفضل العملاء
-    customer_stats = {}
-    for invoice in monthly_invoices:
-        if invoice.customer_name not in customer_stats:
-            customer_stats[invoice.customer_name] = {
-                'invoices_count': 0,
-                'total_amount': 0
-            }
-        customer_stats[invoice.customer_name]['invoices_count'] += 1
-        customer_stats[invoice.customer_name]['total_amount'] += invoice.total_amount
-    
-    top_customers = sorted(customer_stats.items(), 
-                          key=lambda x: x[1]['total_amount'], 
-                          reverse=True)[:10]
+    # أفضل العملاء (تجميع على فهرس customer_id)
+    total_column = func.sum(Invoice.total_amount)
+    customer_rows = db.session.query(
+        Invoice.customer_id,
+        func.count(Invoice.id).label('invoices_count'),
+        total_column.label('total_amount')
+    ).filter(
+        Invoice.invoice_date >= month_start,
+        Invoice.invoice_date <= month_end,
+        Invoice.is_cancelled == False,
+        Invoice.customer_id.isnot(None)
+    ).group_by(Invoice.customer_id).order_by(total_column.desc()).limit(10).all()
+    
+    customer_names = dict(db.session.query(Customer.id, Customer.name).filter(
+        Customer.id.in_([row.customer_id for row in customer_rows])
+    ).all())
+    top_customers = [
+        (customer_names.get(row.customer_id, ''), {
+            'invoices_count': row.invoices_count,
+            'total_amount': row.total_amount
+        })
+        for row in customer_rows
+    ]
     
     return render_template('reports/monthly_summary.html',
                          month=month,
@@ -982,6 +957,67 @@ def chart_data():
     
     return jsonify([])
 
+def get_invoice_totals(*criteria):
+    """إجماليات الفواتير وأوعيتها الضريبية باستعلام تجميعي واحد"""
+    row = db.session.query(
+        func.count(Invoice.id).label('invoices_count'),
+        func.coalesce(func.sum(Invoice.subtotal), 0).label('subtotal'),
+        func.coalesce(func.sum(Invoice.vat_amount), 0).label('vat_amount'),
+        func.coalesce(func.sum(Invoice.withholding_amount), 0).label('withholding_amount'),
+        func.coalesce(func.sum(Invoice.total_amount), 0).label('total_amount'),
+        func.coalesce(func.sum(Invoice.vat_base), 0).label('vat_base'),
+        func.coalesce(func.sum(Invoice.withholding_base), 0).label('withholding_base'),
+        func.count(case((Invoice.vat_amount > 0, 1))).label('vat_invoices_count'),
+        func.count(case((Invoice.withholding_amount > 0, 1))).label('withholding_invoices_count')
+    ).filter(*criteria).one()
+    return row._asdict()
+
+def get_tax_rate_rollups(*criteria):
+    """تجميع الأوعية والضرائب حسب (نوع الضريبة، المعدل) باستعلام مجمّع واحد
+
+    يُقرأ النوع والمعدل من لقطة أسطر الفواتير، فأي معدل يُحدد للمنتج يظهر
+    في صف مستقل بدلاً من افتراض 14% و 5% فقط.
+    """
+    rows = db.session.query(
+        InvoiceItem.tax_type,
+        InvoiceItem.tax_rate,
+        func.count(func.distinct(InvoiceItem.invoice_id)).label('invoices_count'),
+        func.coalesce(func.sum(InvoiceItem.line_total), 0).label('taxable_sales'),
+        func.coalesce(func.sum(InvoiceItem.line_tax), 0).label('tax_amount')
+    ).join(Invoice, Invoice.id == InvoiceItem.invoice_id).filter(
+        *criteria
+    ).group_by(InvoiceItem.tax_type, InvoiceItem.tax_rate).order_by(
+        InvoiceItem.tax_type, InvoiceItem.tax_rate
+    ).all()
+    
+    return [{
+        'tax_type': row.tax_type.value if row.tax_type else None,
+        'tax_rate': float(row.tax_rate or 0),
+        'invoices_count': row.invoices_count,
+        'taxable_sales': float(row.taxable_sales),
+        'tax_amount': float(row.tax_amount)
+    } for row in rows]
+
+def get_invoice_tax_rates(invoice_ids, tax_type, chunk_size=500):
+    """معدلات الضريبة المستخدمة في كل فاتورة لنوع ضريبة معين"""
+    rates = {}
+    for start in range(0, len(invoice_ids), chunk_size):
+        rows = db.session.query(
+            InvoiceItem.invoice_id, InvoiceItem.tax_rate
+        ).filter(
+            InvoiceItem.invoice_id.in_(invoice_ids[start:start + chunk_size]),
+            InvoiceItem.tax_type == tax_type
+        ).distinct().order_by(InvoiceItem.invoice_id, InvoiceItem.tax_rate).all()
+        
+        for row in rows:
+            rates.setdefault(row.invoice_id, []).append(float(row.tax_rate or 0))
+    return rates
+
+@reports_bp.app_template_filter('tax_rate')
+def format_tax_rate(rate):
+    """عرض معدل الضريبة بدون أصفار زائدة (14% أو 12.5%)"""
+    return f"{float(rate or 0):g}%"
+
 def calculate_report_totals(invoices):
     """حساب إجماليات التقرير"""
     total_sales = sum(inv.subtotal for inv in invoices)
@@ -990,22 +1026,7 @@ def calculate_report_totals(invoices):
     total_amount = sum(inv.total_amount for inv in invoices)
     
     # تفاصيل المنتجات
-    product_details = {}
-    for invoice in invoices:
-        for item in invoice.items:
-            product_name = item.product.name
-            if product_name not in product_details:
-                product_details[product_name] = {
-                    'quantity': 0,
-                    'amount': 0,
-                    'tax_type': item.product.tax_type.value,
-                    'tax_amount': 0
-                }
-            
-            line_total = item.get_line_total()
-            product_details[product_name]['quantity'] += float(item.quantity)
-            product_details[product_name]['amount'] += float(line_total)
-            product_details[product_name]['tax_amount'] += float(item.get_tax_amount())
+    product_details = get_product_details([inv.id for inv in invoices])
     
     return {
         'total_invoices': len(invoices),
@@ -1018,6 +1039,51 @@ def calculate_report_totals(invoices):
         'withholding_invoices': len([inv for inv in invoices if inv.withholding_amount > 0])
     }
 
+def get_product_names(product_ids):
+    """جلب أسماء مجموعة منتجات في استعلام واحد"""
+    if not product_ids:
+        return {}
+    rows = db.session.query(Product.id, Product.name).filter(Product.id.in_(product_ids)).all()
+    return {row.id: row.name for row in rows}
+
+def get_product_details(invoice_ids, chunk_size=500):
+    """تجميع مبيعات وضرائب كل منتج من لقطات أسطر الفواتير
+
+    التجميع يتم بـ SUM على جدول invoice_items وحده (بدون ربط بجدول المنتجات)،
+    على دفعات من معرفات الفواتير. كل صف لمنتج ونوع ضريبة من لقطة السطر، فلا تُدمج
+    منتجات بنفس الاسم ولا أسطر منتج تغير نوع ضريبته. تعيد قائمة مرتبة بالاسم.
+    """
+    totals = {}
+    for start in range(0, len(invoice_ids), chunk_size):
+        rows = db.session.query(
+            InvoiceItem.product_id,
+            InvoiceItem.tax_type,
+            func.sum(InvoiceItem.quantity).label('quantity'),
+            func.sum(InvoiceItem.line_total).label('amount'),
+            func.sum(InvoiceItem.line_tax).label('tax_amount')
+        ).filter(
+            InvoiceItem.invoice_id.in_(invoice_ids[start:start + chunk_size])
+        ).group_by(InvoiceItem.product_id, InvoiceItem.tax_type).all()
+        
+        for row in rows:
+            tax_type = row.tax_type.value if row.tax_type else None
+            details = totals.setdefault((row.product_id, tax_type), {
+                'product_id': row.product_id,
+                'tax_type': tax_type,
+                'quantity': 0,
+                'amount': 0,
+                'tax_amount': 0
+            })
+            details['quantity'] += float(row.quantity or 0)
+            details['amount'] += float(row.amount or 0)
+            details['tax_amount'] += float(row.tax_amount or 0)
+    
+    product_names = get_product_names(list({product_id for product_id, tax_type in totals}))
+    for details in totals.values():
+        details['product_name'] = product_names.get(details['product_id'], '')
+    
+    return sorted(totals.values(), key=lambda details: (details['product_name'], details['product_id'], details['tax_type'] or ''))
+
 def create_pdf_report(report_data):
     """إنشاء تقرير PDF"""
     if not REPORTLAB_AVAILABLE:
@@ -1153,26 +1219,29 @@ def create_excel_report(report_data):
         row += 3
         ws[f'A{row}'] = 'تفاصيل المنتجات'
         ws[f'A{row}'].font = title_font
-        ws.merge_cells(f'A{row}:D{row}')
+        ws.merge_cells(f'A{row}:E{row}')
         
         row += 1
-        headers = ['المنتج', 'الكمية', 'المبلغ', 'الضريبة']
+        headers = ['المنتج', 'الكمية', 'المبلغ', 'الضريبة', 'نوع الضريبة']
         for col, header in enumerate(headers, 1):
             cell = ws.cell(row=row, column=col, value=header)
             cell.font = header_font
         
-        for product_name, details in report_data['product_details'].items():
+        tax_type_labels = {'vat': 'ضريبة القيمة المضافة', 'withholding': 'ضريبة الخصم والإضافة'}
+        for details in report_data['product_details']:
             row += 1
-            ws[f'A{row}'] = product_name
+            ws[f'A{row}'] = details['product_name']
             ws[f'B{row}'] = details['quantity']
             ws[f'C{row}'] = details['amount']
             ws[f'D{row}'] = details['tax_amount']
+            ws[f'E{row}'] = tax_type_labels.get(details['tax_type'], '')
     
     # تنسيق الأعمدة
     ws.column_dimensions['A'].width = 30
     ws.column_dimensions['B'].width = 15
     ws.column_dimensions['C'].width = 15
     ws.column_dimensions['D'].width = 15
+    ws.column_dimensions['E'].width = 22
     
     buffer = BytesIO()
     wb.save(buffer)
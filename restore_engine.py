@@ -0,0 +1,307 @@
+import json
+from datetime import datetime, date, time
+from decimal import Decimal
+from itertools import islice
+from sqlalchemy import text, func, select, bindparam
+from sqlalchemy.dialects import sqlite, postgresql
+from models import db
+from search import drop_search_index
+
+# عدد الصفوف في كل أمر INSERT مجمّع (executemany)
+RESTORE_BATCH_SIZE = 5000
+
+
+class RestoreError(Exception):
+    """خطأ في بيانات النسخة الاحتياطية يمنع استعادتها"""
+
+
+def column_loader(column):
+    """دالة تحويل قيمة JSON إلى نوع العمود كما في الجدول (None إذا لم يلزم تحويل)"""
+    column_type = column.type
+    if isinstance(column_type, db.Enum) and column_type.enum_class is not None:
+        enum_class = column_type.enum_class
+
+        def load_enum(value):
+            # النسخ تحفظ قيمة العنصر (admin)، وقد تحفظ النسخ القديمة اسمه (ADMIN)
+            try:
+                return enum_class(value)
+            except ValueError:
+                return enum_class[value]
+        return load_enum
+    if isinstance(column_type, db.Numeric) and column_type.asdecimal:
+        return lambda value: Decimal(str(value))
+    if isinstance(column_type, db.DateTime):
+        return lambda value: datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if isinstance(column_type, db.Date):
+        return lambda value: date.fromisoformat(value[:10])
+    if isinstance(column_type, db.Time):
+        return time.fromisoformat
+    return None
+
+
+def read_ndjson(stream):
+    """قراءة صفوف ملف NDJSON مفتوح سطراً بسطر"""
+    for line in stream:
+        if line.strip():
+            yield json.loads(line)
+
+
+def supports_upsert():
+    """هل تدعم القاعدة INSERT ... ON CONFLICT (SQLite و PostgreSQL)"""
+    return db.engine.dialect.name in ('sqlite', 'postgresql')
+
+
+def insert_statement(table, skip_existing=False, upsert=False):
+    """أمر الإدراج؛ في وضع الدمج تُتجاهل الصفوف الموجودة بنفس المفتاح، وفي وضع
+    upsert تُحدَّث أعمدتها بقيم الصف الجديد"""
+    if not (skip_existing or upsert):
+        return table.insert()
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        statement = sqlite.insert(table)
+    elif dialect == 'postgresql':
+        statement = postgresql.insert(table)
+    else:
+        return table.insert()
+    if skip_existing:
+        return statement.on_conflict_do_nothing()
+    return statement.on_conflict_do_update(
+        index_elements=list(table.primary_key.columns),
+        set_={column.name: statement.excluded[column.name] for column in table.columns if not column.primary_key}
+    )
+
+
+def insert_table_rows(conn, table, rows, skip_existing=False, upsert=False, batch_size=RESTORE_BATCH_SIZE,
+                      progress=None, before_batch=None):
+    """إدراج صفوف جدول على دفعات executemany مع تحويل القيم حسب نوع كل عمود
+
+    before_batch(conn, params) تُستدعى قبل إدراج كل دفعة (مثلاً لتسجيل معرفات صفوفها).
+    """
+    loaders = {column.name: column_loader(column) for column in table.columns}
+    statement = insert_statement(table, skip_existing, upsert)
+
+    count = 0
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+
+        # أعمدة الدفعة: الموجودة في النسخة وفي الجدول الحالي معاً (الأعمدة
+        # الجديدة غير الموجودة في النسخ القديمة تأخذ قيمها الافتراضية)
+        names = [name for name in batch[0] if name in loaders]
+        converters = [(name, loaders[name]) for name in names]
+        params = []
+        for row in batch:
+            values = {}
+            for name, loader in converters:
+                value = row.get(name)
+                values[name] = loader(value) if loader is not None and value is not None else value
+            params.append(values)
+
+        try:
+            if before_batch:
+                before_batch(conn, params)
+            conn.execute(statement, params)
+        except Exception as e:
+            raise RestoreError(f'تعذر استعادة جدول {table.name} (الصفوف {count + 1}-{count + len(batch)}): {e}') from e
+        count += len(batch)
+        if progress:
+            progress(table.name, count)
+    return count
+
+
+def delete_rows(conn, column, values, batch_size=RESTORE_BATCH_SIZE, criteria=()):
+    """حذف الصفوف التي تقع قيمة العمود فيها ضمن القيم المعطاة، على دفعات
+
+    criteria: شروط إضافية على الصفوف المحذوفة.
+    """
+    values = list(values)
+    for start in range(0, len(values), batch_size):
+        conn.execute(column.table.delete().where(column.in_(values[start:start + batch_size]), *criteria))
+
+
+def unreferenced_criteria(table):
+    """شروط أن الصف لا تشير إليه صفوف أي جدول بمفتاح أجنبي"""
+    criteria = []
+    for other in db.metadata.sorted_tables:
+        for fk in other.foreign_keys:
+            if fk.column.table is table:
+                # اسم مستعار حتى لا يرتبط الاستعلام الفرعي بالجدول نفسه في الإشارة الذاتية
+                referencing = other.alias().c[fk.parent.name]
+                criteria.append(~select(referencing).where(referencing == fk.column).exists())
+    return criteria
+
+def reset_sequences(conn, tables):
+    """مزامنة تسلسلات المفاتيح في PostgreSQL مع أكبر معرف بعد الإدراج بمعرفات صريحة
+
+    SQLite لا تحتاج ذلك لأن INTEGER PRIMARY KEY يأخذ max(rowid) + 1 تلقائياً.
+    """
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for table in tables:
+        if 'id' not in table.columns:
+            continue
+        max_id = conn.execute(select(func.max(table.c.id))).scalar()
+        conn.execute(
+            text("SELECT setval(pg_get_serial_sequence(:table, 'id'), :value, :called)"),
+            {'table': table.name, 'value': max_id or 1, 'called': max_id is not None}
+        )
+
+
+def plan_replacement(restored_names):
+    """ما يلزم لحذف صفوف الجداول المستعادة دون تأجيل فحص المفاتيح الأجنبية
+
+    الجداول غير المستعادة التي تشير إليها بعمود يقبل NULL تحتفظ بصفوفها، ويُفصل
+    العمود قبل الحذف ثم يُعاد ربطه بعد الإدراج (سجلات النسخ مثلاً). أما التي تشير
+    إليها بعمود إلزامي فلا تصح صفوفها بدون الأصل، فتُحذف معها.
+    يعيد (الجداول المحذوفة بترتيب المفاتيح، قائمة (العمود، العمود المشار إليه) للفصل).
+    """
+    cleared = []
+    detached = []
+    for table in db.metadata.sorted_tables:
+        if table.name in restored_names:
+            cleared.append(table)
+            continue
+        cleared_names = {cleared_table.name for cleared_table in cleared}
+        references = [fk for fk in table.foreign_keys if fk.column.table.name in cleared_names]
+        if any(not fk.parent.nullable for fk in references):
+            cleared.append(table)
+        else:
+            detached.extend((fk.parent, fk.column) for fk in references)
+    return cleared, detached
+
+
+def detach_references(conn, detached):
+    """حفظ قيم أعمدة الإشارة ثم تفريغها؛ تعيد ما يلزم لإعادة الربط"""
+    saved = []
+    for column, referred in detached:
+        table = column.table
+        primary_key = table.primary_key.columns.values()[0]
+        rows = conn.execute(select(primary_key, column).where(column.isnot(None))).all()
+        if rows:
+            conn.execute(table.update().where(column.isnot(None)).values({column.name: None}))
+            saved.append((column, referred, rows))
+    return saved
+
+
+def reattach_references(conn, saved, batch_size=RESTORE_BATCH_SIZE):
+    """إعادة قيم أعمدة الإشارة التي ما زال صفها المشار إليه موجوداً بعد الاستعادة"""
+    for column, referred, rows in saved:
+        table = column.table
+        primary_key = table.primary_key.columns.values()[0]
+        statement = table.update().where(
+            primary_key == bindparam('row_key'),
+            select(referred).where(referred == bindparam('reference')).exists()
+        ).values({column.name: bindparam('reference')})
+        params = [{'row_key': key, 'reference': value} for key, value in rows]
+        for start in range(0, len(params), batch_size):
+            conn.execute(statement, params[start:start + batch_size])
+
+
+def restore_tables(sources, replace=True, batch_size=RESTORE_BATCH_SIZE, progress=None):
+    """استعادة مجموعة جداول في معاملة واحدة
+
+    sources: قاموس من اسم الجدول إلى صفوفه (أي iterable من القواميس، ويُفضل مولداً
+    يقرأ من الملف حتى لا تُحمَّل النسخة في الذاكرة).
+    replace: حذف الصفوف الحالية للجداول المستعادة أولاً؛ وإلا تُضاف الصفوف
+    غير الموجودة فقط (دمج).
+    الحذف بعكس ترتيب المفاتيح الأجنبية والإدراج بترتيبها، والإشارات من الجداول
+    الأخرى تُعالج بـ plan_replacement، فلا تعتمد الاستعادة على تأجيل القيود
+    (القيود في PostgreSQL غير قابلة للتأجيل). يُعاد بناء فهرس البحث مرة واحدة
+    بعد الانتهاء. يعيد عدد الصفوف لكل جدول.
+    """
+    known = {table.name: table for table in db.metadata.sorted_tables}
+    unknown = set(sources) - set(known)
+    if unknown:
+        raise RestoreError(f'جداول غير معروفة في النسخة الاحتياطية: {", ".join(sorted(unknown))}')
+
+    tables = [table for table in db.metadata.sorted_tables if table.name in sources]
+    counts = {}
+
+    db.session.remove()
+    with db.engine.begin() as conn:
+        drop_search_index(conn, {table.name for table in tables})
+
+        saved = []
+        if replace:
+            cleared, detached = plan_replacement(set(sources))
+            saved = detach_references(conn, detached)
+            for table in reversed(cleared):
+                conn.execute(table.delete())
+
+        for table in tables:
+            counts[table.name] = insert_table_rows(
+                conn, table, sources[table.name], skip_existing=not replace,
+                batch_size=batch_size, progress=progress
+            )
+
+        reattach_references(conn, saved, batch_size)
+        reset_sequences(conn, tables)
+
+    return counts
+
+
+def apply_table_changes(sources, deletions=None, child_tables=None, batch_size=RESTORE_BATCH_SIZE, progress=None):
+    """تطبيق نسخة تزايدية على القاعدة الحالية في معاملة واحدة
+
+    sources: قاموس من اسم الجدول إلى صفوفه المتغيرة بحالتها الأخيرة؛ كل صف يحدّث
+    الصف الحالي بنفس المفتاح (INSERT ... ON CONFLICT DO UPDATE) أو يُضاف، فلا يُحذف
+    صف أصل تشير إليه صفوف أخرى (القيود في PostgreSQL غير قابلة للتأجيل).
+    deletions: قاموس من اسم الجدول إلى معرفات الصفوف المحذوفة؛ تُحذف قبل الإضافة
+    (فيصح إعادة استخدام معرف أو قيمة فريدة محذوفة لصف جديد في نفس النسخة)، عدا
+    الصفوف التي ما زالت صفوف أخرى تشير إليها فتُحذف بعد تحديث تلك الصفوف.
+    child_tables: قاموس من اسم الجدول التابع إلى (عمود المفتاح الأجنبي، اسم الجدول
+    الأصل)؛ صفوف الجدول التابع في النسخة هي كل صفوف الأصول المتغيرة، فتُحذف صفوفها
+    الحالية أولاً (ومنها المحذوفة) ثم تُدرج.
+    """
+    deletions = deletions or {}
+    child_tables = child_tables or {}
+    known = {table.name: table for table in db.metadata.sorted_tables}
+    unknown = (set(sources) | set(deletions) | set(child_tables)) - set(known)
+    if unknown:
+        raise RestoreError(f'جداول غير معروفة في النسخة الاحتياطية: {", ".join(sorted(unknown))}')
+
+    tables = [table for table in db.metadata.sorted_tables if table.name in sources]
+    changed_ids = {name: set() for name in sources}
+    upsert = supports_upsert()
+    counts = {}
+
+    def record_changed(table):
+        primary_key = table.primary_key.columns.values()[0]
+
+        def before_batch(conn, params):
+            ids = [row[primary_key.name] for row in params if row.get(primary_key.name) is not None]
+            changed_ids[table.name].update(ids)
+            if not upsert:
+                # قواعد بلا ON CONFLICT: حذف النسخة الحالية من الصف ثم إدراجه
+                delete_rows(conn, primary_key, ids, batch_size)
+        return before_batch
+
+    db.session.remove()
+    with db.engine.begin() as conn:
+        for name, (column_name, parent) in child_tables.items():
+            if deletions.get(parent):
+                delete_rows(conn, known[name].c[column_name], deletions[parent], batch_size)
+        for table in reversed(db.metadata.sorted_tables):
+            if deletions.get(table.name):
+                delete_rows(conn, table.primary_key.columns.values()[0], deletions[table.name], batch_size,
+                            unreferenced_criteria(table))
+
+        for table in tables:
+            if table.name in child_tables:
+                column_name, parent = child_tables[table.name]
+                delete_rows(conn, table.c[column_name], changed_ids.get(parent, ()), batch_size)
+            counts[table.name] = insert_table_rows(
+                conn, table, sources[table.name], upsert=upsert, batch_size=batch_size, progress=progress,
+                before_batch=record_changed(table)
+            )
+
+        for table in reversed(db.metadata.sorted_tables):
+            if deletions.get(table.name):
+                removed = set(deletions[table.name]) - changed_ids.get(table.name, set())
+                delete_rows(conn, table.primary_key.columns.values()[0], removed, batch_size)
+
+        reset_sequences(conn, tables)
+
+    return counts
@@ -0,0 +1,250 @@
+import os
+import socket
+import threading
+import time
+import uuid
+from calendar import monthrange
+from datetime import datetime, timedelta, timezone
+from sqlalchemy import update, or_
+from sqlalchemy.exc import IntegrityError
+from models import db, SchedulerLease, ScheduledJob
+
+# مدة إيجار القيادة بالثواني؛ القائد يجددها في كل دورة، وإذا توقف تنتقل لعامل آخر بعد انتهائها
+LEASE_SECONDS = 90
+
+# ثوانٍ بين دورات فحص المهام المستحقة وتجديد الإيجار
+TICK_SECONDS = 30
+
+# تأجيل المهمة التي طلبت إعادة المحاولة (عملية أخرى جارية مثلاً)
+RETRY_DELAY = timedelta(minutes=10)
+
+LEADER_LEASE = 'scheduler'
+
+# معرف هذا العامل في جدول الإيجار
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+# المهام المسجلة: الاسم -> (الدالة، دالة تعيد جدولتها الحالية أو None إذا كانت معطلة)
+JOBS = {}
+
+_started = False
+_start_lock = threading.Lock()
+_running = set()
+
+
+class RetryLater(Exception):
+    """المهمة لا يمكن تشغيلها الآن، وتُعاد بعد RETRY_DELAY"""
+
+
+class Schedule:
+    """موعد متكرر بالتوقيت المحلي: يومي، أو أسبوعي في يوم محدد، أو شهري في يوم محدد"""
+
+    def __init__(self, kind, hour, minute=0, weekday=None, day=None):
+        self.kind = kind
+        self.hour = hour
+        self.minute = minute
+        self.weekday = weekday  # 0 = الاثنين
+        self.day = day
+
+    @property
+    def signature(self):
+        return f'{self.kind}:{self.weekday if self.kind == "weekly" else self.day or ""}:{self.hour:02d}:{self.minute:02d}'
+
+    def next_after(self, moment):
+        """أول موعد بعد moment (توقيت محلي بدون منطقة زمنية)"""
+        candidate = moment.replace(hour=self.hour, minute=self.minute, second=0, microsecond=0)
+        if self.kind == 'daily':
+            if candidate <= moment:
+                candidate += timedelta(days=1)
+            return candidate
+        if self.kind == 'weekly':
+            candidate += timedelta(days=(self.weekday - candidate.weekday()) % 7)
+            if candidate <= moment:
+                candidate += timedelta(days=7)
+            return candidate
+        if self.kind == 'monthly':
+            year, month = candidate.year, candidate.month
+            while True:
+                # اليوم 31 في شهر أقصر يصبح آخر يوم فيه
+                day = min(self.day, monthrange(year, month)[1])
+                candidate = candidate.replace(year=year, month=month, day=day)
+                if candidate > moment:
+                    return candidate
+                year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        raise ValueError(f'نوع جدولة غير معروف: {self.kind}')
+
+
+def daily_at(hour, minute=0):
+    return Schedule('daily', hour, minute)
+
+
+def weekly_at(weekday, hour, minute=0):
+    return Schedule('weekly', hour, minute, weekday=weekday)
+
+
+def monthly_at(day, hour, minute=0):
+    return Schedule('monthly', hour, minute, day=day)
+
+
+def local_to_utc(moment):
+    return moment.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def utc_to_local(moment):
+    return moment.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+
+
+def register_job(name, func, schedule_provider):
+    """تسجيل مهمة مجدولة
+
+    func(app) تُستدعى داخل سياق التطبيق، وschedule_provider() (داخل السياق أيضاً)
+    تعيد Schedule حسب الإعدادات الحالية أو None لتعطيل المهمة.
+    """
+    JOBS[name] = (func, schedule_provider)
+
+
+def acquire_lease(now=None):
+    """حجز إيجار القيادة أو تجديده؛ يعيد True إذا كان هذا العامل هو القائد
+
+    التحديث مشروط (المالك نفسه أو إيجار منتهٍ) فلا ينجح إلا لعامل واحد.
+    """
+    now = now or datetime.utcnow()
+    expires_at = now + timedelta(seconds=LEASE_SECONDS)
+    leases = SchedulerLease.__table__
+    result = db.session.execute(
+        update(leases)
+        .where(leases.c.name == LEADER_LEASE)
+        .where(or_(leases.c.owner == WORKER_ID, leases.c.expires_at < now, leases.c.expires_at.is_(None)))
+        .values(owner=WORKER_ID, expires_at=expires_at)
+    )
+    if result.rowcount == 0 and db.session.get(SchedulerLease, LEADER_LEASE) is None:
+        db.session.add(SchedulerLease(name=LEADER_LEASE, owner=WORKER_ID, expires_at=expires_at))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # عامل آخر أنشأ الإيجار في نفس اللحظة
+            db.session.rollback()
+            return False
+        return True
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def get_job_state(name):
+    return ScheduledJob.query.filter_by(name=name).first()
+
+
+def sync_job_schedule(name, schedule, now_local):
+    """إنشاء سجل المهمة أو تحديث موعدها التالي إذا تغيرت جدولتها
+
+    الموعد التالي المسجل في الماضي (توقف الخادم وقت التشغيل) يبقى كما هو
+    فتُشغل المهمة مرة واحدة للتعويض.
+    """
+    state = get_job_state(name)
+    signature = schedule.signature if schedule else None
+    if state is None:
+        state = ScheduledJob(name=name, runs=0)
+        db.session.add(state)
+    elif state.schedule == signature:
+        return state
+
+    state.schedule = signature
+    state.next_run_at = local_to_utc(schedule.next_after(now_local)) if schedule else None
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        state = get_job_state(name)
+    return state
+
+
+def claim_run(state, next_run_at, now):
+    """حجز تشغيل المهمة للموعد المستحق؛ ينجح لعامل واحد فقط لكل موعد"""
+    jobs = ScheduledJob.__table__
+    result = db.session.execute(
+        update(jobs)
+        .where(jobs.c.id == state.id, jobs.c.runs == state.runs)
+        .values(runs=jobs.c.runs + 1, next_run_at=next_run_at, last_run_at=now,
+                last_status='running', last_error=None)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def finish_run(name, status, error=None, retry_at=None):
+    state = get_job_state(name)
+    state.last_status = status
+    state.last_error = error
+    state.last_finished_at = datetime.utcnow()
+    if retry_at is not None:
+        state.next_run_at = retry_at
+    db.session.commit()
+
+
+def run_claimed_job(app, name, func):
+    """تشغيل مهمة محجوزة في سياق التطبيق وتسجيل نتيجتها"""
+    try:
+        with app.app_context():
+            try:
+                func(app)
+                finish_run(name, 'success')
+            except RetryLater as e:
+                db.session.rollback()
+                finish_run(name, 'retry', str(e), retry_at=datetime.utcnow() + RETRY_DELAY)
+            except Exception as e:
+                db.session.rollback()
+                print(f'خطأ في المهمة المجدولة {name}: {str(e)}')
+                finish_run(name, 'failed', str(e))
+            finally:
+                db.session.remove()
+    finally:
+        _running.discard(name)
+
+
+def run_due_jobs(app, now=None):
+    """دورة واحدة: تجديد القيادة ثم تشغيل المهام المستحقة (كل مهمة في خيط خاص)
+
+    يعيد أسماء المهام التي بدأت.
+    """
+    now = now or datetime.utcnow()
+    started = []
+    with app.app_context():
+        try:
+            if not acquire_lease(now):
+                return started
+
+            now_local = utc_to_local(now)
+            for name, (func, schedule_provider) in JOBS.items():
+                schedule = schedule_provider()
+                state = sync_job_schedule(name, schedule, now_local)
+                if schedule is None or state.next_run_at is None or state.next_run_at > now or name in _running:
+                    continue
+
+                # الموعد التالي يُحسب من الآن: المواعيد الفائتة أثناء التوقف تُشغل مرة واحدة
+                next_run_at = local_to_utc(schedule.next_after(now_local))
+                if not claim_run(state, next_run_at, now):
+                    continue
+                _running.add(name)
+                threading.Thread(target=run_claimed_job, args=(app, name, func), daemon=True).start()
+                started.append(name)
+        except Exception as e:
+            db.session.rollback()
+            print(f'خطأ في دورة المجدول: {str(e)}')
+        finally:
+            db.session.remove()
+    return started
+
+
+def start_scheduler(app):
+    """بدء خيط المجدول مرة واحدة في كل عملية؛ القيادة تحدد من يشغل المهام فعلاً"""
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+
+    def loop():
+        while True:
+            run_due_jobs(app)
+            time.sleep(TICK_SECONDS)
+
+    threading.Thread(target=loop, name='scheduler', daemon=True).start()
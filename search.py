@@ -0,0 +1,203 @@
+import re
+from sqlalchemy import event, select, text
+from sqlalchemy.exc import OperationalError
+from models import db, Invoice, Product
+
+# التشكيل والتطويل تُحذف قبل الفهرسة والبحث
+ARABIC_DIACRITICS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+
+ARABIC_LETTER_MAP = str.maketrans({
+    'أ': 'ا',
+    'إ': 'ا',
+    'آ': 'ا',
+    'ٱ': 'ا',
+    'ة': 'ه',
+    'ى': 'ي',
+})
+
+# جداول الفهرس النصي (FTS5 بمقسّم trigram في SQLite)
+SEARCH_TABLES = {
+    'invoices': 'invoices_fts',
+    'products': 'products_fts',
+}
+
+# أقل طول يستطيع مقسّم trigram البحث به؛ ما دونه يُبحث عنه بـ LIKE
+MIN_TRIGRAM_LENGTH = 3
+
+# نتيجة فحص دعم FTS5 بمقسّم trigram لكل محرك قاعدة بيانات
+_trigram_support = {}
+
+
+def normalize_arabic(value):
+    """توحيد النص العربي للبحث: حذف التشكيل وتوحيد الألف والتاء المربوطة والياء"""
+    if not value:
+        return ''
+    value = ARABIC_DIACRITICS.sub('', str(value))
+    value = value.translate(ARABIC_LETTER_MAP).lower()
+    return ' '.join(value.split())
+
+
+def invoice_search_text(invoice):
+    """نص البحث المُطبّع للفاتورة (الرقم، اسم العميل، الرقم الضريبي)"""
+    if isinstance(invoice, dict):
+        parts = (invoice.get('invoice_number'), invoice.get('customer_name'), invoice.get('customer_tax_id'))
+    else:
+        parts = (invoice.invoice_number, invoice.customer_name, invoice.customer_tax_id)
+    return normalize_arabic(' '.join(part for part in parts if part))
+
+
+def product_search_text(product):
+    """نص البحث المُطبّع للمنتج"""
+    return normalize_arabic(product.name)
+
+
+@event.listens_for(Invoice, 'before_insert')
+@event.listens_for(Invoice, 'before_update')
+def update_invoice_search_text(mapper, connection, invoice):
+    invoice.search_text = invoice_search_text(invoice)
+
+
+@event.listens_for(Product, 'before_insert')
+@event.listens_for(Product, 'before_update')
+def update_product_search_text(mapper, connection, product):
+    product.search_text = product_search_text(product)
+
+
+def is_sqlite():
+    return db.engine.dialect.name == 'sqlite'
+
+
+def fts_trigram_available():
+    """هل يدعم SQLite جداول FTS5 بمقسّم trigram (يتطلب 3.34 فأحدث مبنياً مع FTS5)
+
+    يُفحص بإنشاء جدول مؤقت مرة واحدة لكل محرك، فإن لم يتوفر يُستخدم LIKE للبحث.
+    """
+    if not is_sqlite():
+        return False
+    engine = db.engine
+    if engine not in _trigram_support:
+        with engine.connect() as conn:
+            try:
+                conn.execute(text("CREATE VIRTUAL TABLE temp.fts_probe USING fts5(value, tokenize='trigram')"))
+                conn.execute(text('DROP TABLE temp.fts_probe'))
+                _trigram_support[engine] = True
+            except OperationalError:
+                _trigram_support[engine] = False
+            conn.rollback()
+    return _trigram_support[engine]
+
+
+def setup_search_index():
+    """إنشاء فهرس البحث ومزامنته تلقائياً مع عمود search_text
+
+    في SQLite: جدول FTS5 خارجي المحتوى بمقسّم trigram مع triggers للمزامنة.
+    في PostgreSQL: فهرس GIN بـ pg_trgm على نفس العمود، فيستفيد منه LIKE مباشرة.
+    إذا لم يدعم SQLite مقسّم trigram يبقى البحث بـ LIKE على search_text.
+    """
+    if is_sqlite() and not fts_trigram_available():
+        print('تنبيه: SQLite لا يدعم FTS5 بمقسّم trigram، سيُستخدم البحث بـ LIKE')
+        with db.engine.begin() as conn:
+            # triggers من قاعدة أُنشئت بإصدار يدعمه تفشل مع كل كتابة
+            drop_search_index(conn)
+        return
+
+    with db.engine.begin() as conn:
+        if is_sqlite():
+            for table, fts_table in SEARCH_TABLES.items():
+                # الفهرس بلا triggers (من فترة عمل بدون FTS5) قديم فيُعاد بناؤه
+                synced = conn.execute(
+                    text("SELECT 1 FROM sqlite_master WHERE type = 'trigger' AND name = :name"),
+                    {'name': f'{fts_table}_ai'}
+                ).first()
+                if synced:
+                    continue
+
+                conn.execute(text(f'DROP TABLE IF EXISTS {fts_table}'))
+                conn.execute(text(
+                    f"CREATE VIRTUAL TABLE {fts_table} USING fts5("
+                    f"search_text, content='{table}', content_rowid='id', tokenize='trigram')"
+                ))
+                conn.execute(text(
+                    f"CREATE TRIGGER {fts_table}_ai AFTER INSERT ON {table} BEGIN "
+                    f"INSERT INTO {fts_table}(rowid, search_text) VALUES (new.id, new.search_text); END"
+                ))
+                conn.execute(text(
+                    f"CREATE TRIGGER {fts_table}_ad AFTER DELETE ON {table} BEGIN "
+                    f"INSERT INTO {fts_table}({fts_table}, rowid, search_text) VALUES ('delete', old.id, old.search_text); END"
+                ))
+                conn.execute(text(
+                    f"CREATE TRIGGER {fts_table}_au AFTER UPDATE OF search_text ON {table} BEGIN "
+                    f"INSERT INTO {fts_table}({fts_table}, rowid, search_text) VALUES ('delete', old.id, old.search_text); "
+                    f"INSERT INTO {fts_table}(rowid, search_text) VALUES (new.id, new.search_text); END"
+                ))
+                conn.execute(text(f"INSERT INTO {fts_table}({fts_table}) VALUES ('rebuild')"))
+
+        elif db.engine.dialect.name == 'postgresql':
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            for table in SEARCH_TABLES:
+                conn.execute(text(
+                    f"CREATE INDEX IF NOT EXISTS ix_{table}_search_trgm "
+                    f"ON {table} USING gin (search_text gin_trgm_ops)"
+                ))
+
+
+def drop_search_index(conn, tables=None):
+    """حذف جداول FTS و triggers المزامنة في SQLite قبل عمليات الكتابة المجمّعة
+
+    يُعاد إنشاؤها وبناؤها دفعة واحدة بـ setup_search_index بعد انتهاء الكتابة،
+    وهو أسرع كثيراً من تحديث الفهرس صفاً بصف عبر triggers.
+    """
+    if not is_sqlite():
+        return
+    for table, fts_table in SEARCH_TABLES.items():
+        if tables is not None and table not in tables:
+            continue
+        for suffix in ('ai', 'ad', 'au'):
+            conn.execute(text(f'DROP TRIGGER IF EXISTS {fts_table}_{suffix}'))
+        # حذف جدول FTS5 يتطلب الوحدة نفسها، فيبقى الجدول إن لم تتوفر (لا يُستخدم)
+        if fts_trigram_available():
+            conn.execute(text(f'DROP TABLE IF EXISTS {fts_table}'))
+
+
+def backfill_search_text(chunk_size=2000):
+    """تعبئة نص البحث للسجلات القديمة (التطبيع يتم في بايثون)"""
+    updated = 0
+    sources = (
+        (Invoice, invoice_search_text, (Invoice.id, Invoice.invoice_number, Invoice.customer_name, Invoice.customer_tax_id)),
+        (Product, product_search_text, (Product.id, Product.name)),
+    )
+    for model, build, columns in sources:
+        last_id = 0
+        while True:
+            records = db.session.query(*columns).filter(
+                model.id > last_id, model.search_text.is_(None)
+            ).order_by(model.id).limit(chunk_size).all()
+            if not records:
+                break
+            last_id = records[-1].id
+            db.session.bulk_update_mappings(model, [
+                {'id': record.id, 'search_text': build(record)} for record in records
+            ])
+            db.session.commit()
+            updated += len(records)
+    return updated
+
+
+def search_filter(model, term):
+    """شرط بحث مفهرس على نموذج (Invoice أو Product) أو None إذا كان النص فارغاً"""
+    term = normalize_arabic(term)
+    if not term:
+        return None
+
+    table = model.__tablename__
+    if fts_trigram_available() and len(term) >= MIN_TRIGRAM_LENGTH:
+        fts_table = SEARCH_TABLES[table]
+        phrase = '"' + term.replace('"', '""') + '"'
+        matches = select(text('rowid')).select_from(text(fts_table)).where(
+            text(f'{fts_table} MATCH :phrase').bindparams(phrase=phrase)
+        )
+        return model.id.in_(matches)
+
+    # في PostgreSQL يخدم فهرس pg_trgm هذا الشرط
+    escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return model.search_text.like(f'%{escaped}%', escape='\\')
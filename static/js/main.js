@@ -7,6 +7,9 @@ document.addEventListener('DOMContentLoaded', function() {
     // تهيئة الرسوم البيانية
     initializeCharts();
     
+    // التحديث المباشر لإحصائيات لوحة التحكم
+    initializeLiveDashboard();
+    
     // تهيئة النماذج
     initializeForms();
     
@@ -122,6 +125,23 @@ function performSearch(query, inputElement) {
     }
 }
 
+// إحصائيات لوحة التحكم: طلب واحد تتشاركه كل الرسوم البيانية
+let dashboardStatsPromise = null;
+let dailySalesChartInstance = null;
+let taxChartInstance = null;
+
+function loadDashboardStats() {
+    if (!dashboardStatsPromise) {
+        dashboardStatsPromise = fetch('/api/dashboard/stats')
+            .then(response => response.json())
+            .catch(error => {
+                dashboardStatsPromise = null;
+                throw error;
+            });
+    }
+    return dashboardStatsPromise;
+}
+
 // تهيئة الرسوم البيانية
 function initializeCharts() {
     // رسم بياني للمبيعات اليومية
@@ -145,17 +165,18 @@ function initializeCharts() {
 
 // إنشاء رسم بياني للمبيعات اليومية
 function createDailySalesChart() {
-    fetch('/api/dashboard/stats')
-        .then(response => response.json())
-        .then(data => {
+    loadDashboardStats()
+        .then(stats => {
+            const data = stats.daily;
             const ctx = document.getElementById('dailySalesChart').getContext('2d');
-            new Chart(ctx, {
+            dailySalesChartInstance = new Chart(ctx, {
                 type: 'line',
                 data: {
                     labels: data.map(item => new Date(item.date).toLocaleDateString('ar-EG')),
+                    dates: data.map(item => item.date),
                     datasets: [{
                         label: 'المبيعات اليومية',
-                        data: data.map(item => item.total_sales),
+                        data: data.map(item => item.total_amount),
                         borderColor: '#3498db',
                         backgroundColor: 'rgba(52, 152, 219, 0.1)',
                         borderWidth: 3,
@@ -193,14 +214,13 @@ function createDailySalesChart() {
 
 // إنشاء رسم بياني للضرائب
 function createTaxChart() {
-    fetch('/api/dashboard/stats')
-        .then(response => response.json())
-        .then(data => {
-            const totalVAT = data.reduce((sum, item) => sum + item.vat_amount, 0);
-            const totalWithholding = data.reduce((sum, item) => sum + item.withholding_amount, 0);
+    loadDashboardStats()
+        .then(stats => {
+            const totalVAT = stats.daily.reduce((sum, item) => sum + item.vat_amount, 0);
+            const totalWithholding = stats.daily.reduce((sum, item) => sum + item.withholding_amount, 0);
             
             const ctx = document.getElementById('taxChart').getContext('2d');
-            new Chart(ctx, {
+            taxChartInstance = new Chart(ctx, {
                 type: 'doughnut',
                 data: {
                     labels: ['ضريبة القيمة المضافة', 'ضريبة الخصم والإضافة'],
@@ -230,6 +250,117 @@ function createTaxChart() {
         .catch(error => console.error('خطأ في تحميل بيانات الضرائب:', error));
 }
 
+// التحديث المباشر للوحة التحكم: أحداث فروق من الخادم بدلاً من إعادة تحميل الإحصائيات
+function initializeLiveDashboard() {
+    const counters = document.getElementById('dashboardCounters');
+    if (!counters || !window.EventSource) {
+        return;
+    }
+    
+    let lastEventId = counters.dataset.eventId;
+    let source = null;
+    
+    function connect() {
+        const url = '/api/dashboard/events' + (lastEventId ? '?last_event_id=' + encodeURIComponent(lastEventId) : '');
+        source = new EventSource(url);
+        
+        ['invoice_created', 'invoice_cancelled', 'totals_changed'].forEach(type => {
+            source.addEventListener(type, event => {
+                lastEventId = event.lastEventId;
+                JSON.parse(event.data).deltas.forEach(applyDashboardDelta);
+            });
+        });
+        
+        source.addEventListener('stats_reset', event => {
+            lastEventId = event.lastEventId;
+            reloadDashboardStats();
+        });
+        
+        source.onerror = function() {
+            // المتصفح يعيد الاتصال تلقائياً؛ أما إذا رفض الخادم الاتصال (الحد الأقصى) فنعيد المحاولة لاحقاً
+            if (source.readyState === EventSource.CLOSED) {
+                setTimeout(connect, 30000);
+            }
+        };
+    }
+    
+    connect();
+    window.addEventListener('beforeunload', () => source && source.close());
+}
+
+function formatDashboardAmount(value) {
+    return value.toLocaleString('en-US', {minimumFractionDigits: 2, maximumFractionDigits: 2}) + ' ج.م';
+}
+
+function setDashboardCounter(id, value, formatter) {
+    const element = document.getElementById(id);
+    if (element) {
+        element.dataset.value = value;
+        element.textContent = formatter ? formatter(value) : value;
+    }
+}
+
+function addToDashboardCounter(id, delta, formatter) {
+    const element = document.getElementById(id);
+    if (element && delta) {
+        setDashboardCounter(id, parseFloat(element.dataset.value || 0) + delta, formatter);
+    }
+}
+
+// تطبيق فرق تاريخ واحد على العدادات والرسوم البيانية
+function applyDashboardDelta(delta) {
+    const today = document.getElementById('dashboardCounters').dataset.today;
+    const taxes = delta.vat_amount + delta.withholding_amount;
+    
+    if (delta.date === today) {
+        addToDashboardCounter('todayInvoicesCount', delta.invoices_count);
+        addToDashboardCounter('todayTotalAmount', delta.total_amount, formatDashboardAmount);
+    }
+    if (delta.date.slice(0, 7) === today.slice(0, 7) && delta.date <= today) {
+        addToDashboardCounter('monthTaxAmount', taxes, formatDashboardAmount);
+    }
+    
+    if (dailySalesChartInstance) {
+        const index = dailySalesChartInstance.data.dates.indexOf(delta.date);
+        if (index !== -1) {
+            dailySalesChartInstance.data.datasets[0].data[index] += delta.total_amount;
+            dailySalesChartInstance.update();
+            
+            if (taxChartInstance) {
+                const values = taxChartInstance.data.datasets[0].data;
+                values[0] += delta.vat_amount;
+                values[1] += delta.withholding_amount;
+                taxChartInstance.update();
+            }
+        }
+    }
+}
+
+// إعادة تحميل الإحصائيات كاملة عندما يتعذر تطبيق الفروق
+function reloadDashboardStats() {
+    dashboardStatsPromise = null;
+    loadDashboardStats()
+        .then(stats => {
+            setDashboardCounter('todayInvoicesCount', stats.today.invoices_count);
+            setDashboardCounter('todayTotalAmount', stats.today.total_amount, formatDashboardAmount);
+            setDashboardCounter('monthTaxAmount', stats.month.vat_amount + stats.month.withholding_amount, formatDashboardAmount);
+            
+            if (dailySalesChartInstance) {
+                dailySalesChartInstance.data.dates = stats.daily.map(item => item.date);
+                dailySalesChartInstance.data.datasets[0].data = stats.daily.map(item => item.total_amount);
+                dailySalesChartInstance.update();
+            }
+            if (taxChartInstance) {
+                taxChartInstance.data.datasets[0].data = [
+                    stats.daily.reduce((sum, item) => sum + item.vat_amount, 0),
+                    stats.daily.reduce((sum, item) => sum + item.withholding_amount, 0)
+                ];
+                taxChartInstance.update();
+            }
+        })
+        .catch(error => console.error('خطأ في تحميل إحصائيات لوحة التحكم:', error));
+}
+
 // تهيئة النماذج
 function initializeForms() {
     // تهيئة نماذج الفواتير
@@ -245,6 +376,62 @@ function initializeForms() {
     initializeAutoFields();
 }
 
+// كتالوج المنتجات: يُحمَّل مرة واحدة لكل صفحة بطلب مشروط (ETag) ويُخزن في localStorage
+const ProductCatalog = {
+    storageKey: 'productCatalog',
+    promise: null,
+    
+    load() {
+        if (this.promise) {
+            return this.promise;
+        }
+        
+        let cached = null;
+        try {
+            cached = JSON.parse(localStorage.getItem(this.storageKey));
+        } catch (e) {
+            cached = null;
+        }
+        
+        const headers = cached ? {'If-None-Match': `"${cached.version}"`} : {};
+        this.promise = fetch('/api/products/catalog', {headers: headers, cache: 'no-cache'})
+            .then(response => {
+                if (response.status === 304 && cached) {
+                    return cached;
+                }
+                if (!response.ok) {
+                    throw new Error(response.statusText);
+                }
+                return response.json().then(data => {
+                    try {
+                        localStorage.setItem(this.storageKey, JSON.stringify(data));
+                    } catch (e) {
+                        // التخزين المحلي غير متاح أو ممتلئ
+                    }
+                    return data;
+                });
+            })
+            .then(data => {
+                const products = {};
+                data.products.forEach(row => {
+                    const product = {};
+                    data.fields.forEach((field, index) => product[field] = row[index]);
+                    products[product.id] = product;
+                });
+                return products;
+            })
+            .catch(error => {
+                this.promise = null;
+                throw error;
+            });
+        return this.promise;
+    },
+    
+    get(productId) {
+        return this.load().then(products => products[productId] || null);
+    }
+};
+
 // تهيئة نماذج الفواتير
 function initializeInvoiceForms() {
     const productSelect = document.getElementById('product_id');
@@ -254,13 +441,16 @@ function initializeInvoiceForms() {
     const totalDisplay = document.getElementById('line_total');
     
     if (productSelect && unitPriceInput) {
+        ProductCatalog.load().catch(error => console.error('خطأ في تحميل كتالوج المنتجات:', error));
+        
         productSelect.addEventListener('change', function() {
             if (this.value) {
-                fetch(`/api/products/${this.value}`)
-                    .then(response => response.json())
+                ProductCatalog.get(this.value)
                     .then(data => {
-                        unitPriceInput.value = data.price;
-                        calculateLineTotal();
+                        if (data) {
+                            unitPriceInput.value = data.price;
+                            calculateLineTotal();
+                        }
                     })
                     .catch(error => console.error('خطأ في تحميل بيانات المنتج:', error));
             }